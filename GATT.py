@@ -12,39 +12,49 @@ from gi.repository import GLib
 import constants
 import exceptions
 import bletools
+import metrics
 
 class Application(dbus.service.Object):
     """
     org.bluez.GattApplication1 interface implementation
     """
-    def __init__(self, bus):
+    def __init__(self, bus, adapter_path=None):
+        ''' adapter_path is looked up when registering if not given '''
         self.eventLoop = bletools.eventLoop()
         self.bus = bus
         self.path = '/'
         self.services = []
         self.srvc_index = 0
-        self.adapter_path = bletools.find_adapter_path(self.bus)
-        self.service_manager = dbus.Interface(
-            self.bus.get_object(constants.BLUEZ_SERVICE_NAME, self.adapter_path),
-            constants.GATT_MANAGER_INTERFACE)
+        self.adapter_path = adapter_path
+        self.service_manager = None
         dbus.service.Object.__init__(self, self.bus, self.path)
 
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
-    def add_service(self, service):
-        srvc = service(self.bus, self.srvc_index)
+    def add_service(self, service, *args):
+        ''' any extra args are passed on to the service constructor '''
+        srvc = service(self.bus, self.srvc_index, *args)
         self.services.append(srvc)
         self.srvc_index += 1
 
     def register_app_cb(self):
         print('GATT application registered')
+        metrics.startup.mark('application_registered')
 
     def register_app_error_cb(self, error):
         print('Failed to register application: ' + str(error))
         self.quit()
 
-    def register(self):
+    def register(self, adapter_path=None):
+        if adapter_path is not None:
+            self.adapter_path = adapter_path
+        if self.adapter_path is None:
+            self.adapter_path = bletools.find_adapter_path(self.bus)
+        # skip introspection, it costs BlueZ a round trip before the first call
+        self.service_manager = dbus.Interface(
+            self.bus.get_object(constants.BLUEZ_SERVICE_NAME, self.adapter_path, introspect=False),
+            constants.GATT_MANAGER_INTERFACE)
         print('Registering GATT application...')
         self.service_manager.RegisterApplication(
             self.get_path(), {},
@@ -113,8 +123,9 @@ class Service(dbus.service.Object):
     def get_path(self):
         return dbus.ObjectPath(self.path)
 
-    def add_characteristic(self, characteristic):
-        chrc = characteristic(self.bus, self.chrc_index, self)
+    def add_characteristic(self, characteristic, *args):
+        ''' any extra args are passed on to the characteristic constructor '''
+        chrc = characteristic(self.bus, self.chrc_index, self, *args)
         self.characteristics.append(chrc)
         self.chrc_index += 1
 
@@ -1,7 +1,14 @@
 # Standard modules
+import time
+# everything before the first advertisement counts, so start the clock first
+startup_time = time.perf_counter()
+
+import metrics
+metrics.startup.start = startup_time
 from smartLightPeripheral import SmartLightPeripheral
 
 def main():
+        metrics.startup.mark('imports')
         smartlight = SmartLightPeripheral()
         smartlight.publish()
 
@@ -9,6 +9,8 @@ from gi.repository import GLib
 import constants
 import exceptions
 import bletools
+import metrics
+from loopprofile import profiler
 
 # much of this code was copied or inspired by test\example-advertisement in the BlueZ source
 class Advertisement(dbus.service.Object):
@@ -19,9 +21,10 @@ class Advertisement(dbus.service.Object):
 
     PATH_BASE = '/org/bluez/ldsg/advertisement'
 
-    def __init__(self,bus, index, advertising_type, name):
+    def __init__(self,bus, index, advertising_type, name, adapter_path=None):
         ''' index should increment for every successive advertisement created
             advertising_type options are 'peripheral','broadcast'
+            adapter_path is looked up on the first register() if not given
         '''
         self.path = self.PATH_BASE + str(index)
         self.bus = bus
@@ -42,16 +45,18 @@ class Advertisement(dbus.service.Object):
         print("creating advertisement at",self.path)
         dbus.service.Object.__init__(self, self.bus, self.path)
 
+        self.adapter_path = adapter_path
         self.adv_mgr_interface = None
         self.connected = 0
+        self.disconnects = 0
         self.bus.add_signal_receiver(
-            self.properties_changed,
+            profiler.timed('Advertisement.properties_changed', self.properties_changed),
             dbus_interface=constants.DBUS_PROPERTIES,
             signal_name = "PropertiesChanged",
             path_keyword = "path")
 
         self.bus.add_signal_receiver(
-            self.interfaces_added,
+            profiler.timed('Advertisement.interfaces_added', self.interfaces_added),
             dbus_interface = constants.DBUS_OM_IFACE,
             signal_name = "InterfacesAdded")
         print("signal receivers added")
@@ -106,14 +111,39 @@ class Advertisement(dbus.service.Object):
     def Release(self):
         print('%s: Released' % self.path)
 
+    @dbus.service.signal(constants.DBUS_PROPERTIES,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+    def update_data(self, manufacturer_data=None, service_data=None):
+        ''' replaces the manufacturer and/or service data of the registered
+            advertisement. BlueZ picks up the PropertiesChanged signal and
+            refreshes the advertising data in place, no need to unregister
+            and register again '''
+        changed = {}
+        if manufacturer_data is not None:
+            self.manufacturer_data = manufacturer_data
+            changed['ManufacturerData'] = dbus.Dictionary(manufacturer_data, signature='qv')
+        if service_data is not None:
+            self.service_data = service_data
+            changed['ServiceData'] = dbus.Dictionary(service_data, signature='sv')
+        if changed:
+            self.PropertiesChanged(constants.ADVERTISEMENT_INTERFACE, changed, [])
+
     def set_connected_status(self, status):
         if status == 1:
             print("Connected!")
+            if self.disconnects:
+                metrics.registry.inc('smartlight_reconnects_total')
             self.connected = 1
+            metrics.registry.set('smartlight_connected', 1)
             self.stop_advertising()
         else:
             print("disconnected")
             self.connected = 0
+            self.disconnects += 1
+            metrics.registry.set('smartlight_connected', 0)
             self.register()
 
     def properties_changed(self, interface, changed, invalidated, path):
@@ -128,6 +158,7 @@ class Advertisement(dbus.service.Object):
 
     def register_ad_cb(self):
         print('Advertisement registered OK')
+        metrics.startup.mark('advertisement_registered')
 
     def register_ad_error_cb(self, error):
         print('Error: Failed to register advertisement: ' + str(error))
@@ -136,13 +167,18 @@ class Advertisement(dbus.service.Object):
         print("Unregistering advertisement",self.get_path())
         self.adv_mgr_interface.UnregisterAdvertisement(self.get_path())
 
-    def register(self):
-        adapter_path = bletools.find_adapter_path(self.bus)
-        print("found adapter at",adapter_path)
-        # get access to adapter object from DBus
-        self.adv_mgr_interface = dbus.Interface(
-            self.bus.get_object(constants.BLUEZ_SERVICE_NAME, adapter_path),
-            constants.ADVERTISING_MANAGER_INTERFACE)
+    def register(self, adapter_path=None):
+        if adapter_path is not None:
+            self.adapter_path = adapter_path
+        if self.adapter_path is None:
+            # the adapter doesn't change, so only look for it once
+            self.adapter_path = bletools.find_adapter_path(self.bus)
+            print("found adapter at",self.adapter_path)
+        # get access to adapter object from DBus, skipping introspection
+        if self.adv_mgr_interface is None:
+            self.adv_mgr_interface = dbus.Interface(
+                self.bus.get_object(constants.BLUEZ_SERVICE_NAME, self.adapter_path, introspect=False),
+                constants.ADVERTISING_MANAGER_INTERFACE)
 
         print("Registering advertisement",self.get_path(),
               "as",self.local_name)
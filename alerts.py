@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+# Local alert outputs.
+#
+# A BLE notification only goes out once a vehicle has cleared. The alert
+# outputs react while it is still passing: as soon as any DistanceMonitor
+# detects an object (state 1) the output plays config.alert_detected_pattern
+# and once a vehicle is confirmed (state 2) alert_violation_pattern, until
+# every sensor is back in state 0.
+#
+# The first edge is switched from inside scan_for_violations, right where
+# the state changes, so the latency is that of the frame itself. The rest of
+# the pattern is played by a thread, the sensor loop never waits on it.
+#
+# Outputs:
+#   GPIOOutput  a rear light or buzzer on a GPIO pin (needs RPi.GPIO)
+#   FileOutput  writes "<time> on|off" lines to a file or fifo, for testing
+import os
+import threading
+import time
+
+import metrics
+from distanceMonitor import MonitorListener
+
+
+class AlertOutput:
+    ''' something that can be switched on and off quickly '''
+
+    def set(self, on):
+        pass
+
+    def close(self):
+        pass
+
+
+class GPIOOutput(AlertOutput):
+
+    def __init__(self, pin):
+        # only available on the pi, and only needed for this output
+        import RPi.GPIO as GPIO
+        self.GPIO = GPIO
+        self.pin = pin
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.OUT, initial=GPIO.LOW)
+
+    def set(self, on):
+        self.GPIO.output(self.pin, self.GPIO.HIGH if on else self.GPIO.LOW)
+
+    def close(self):
+        self.set(False)
+        self.GPIO.cleanup(self.pin)
+
+
+class FileOutput(AlertOutput):
+    ''' a fifo without a reader, or one that stops reading, loses
+        lines rather than blocking the caller '''
+
+    def __init__(self, path):
+        self.path = path
+        self.fd = None
+
+    def set(self, on):
+        line = f"{time.time():.6f} {'on' if on else 'off'}\n".encode()
+        try:
+            if self.fd is None:
+                self.fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_NONBLOCK)
+            os.write(self.fd, line)
+        except BlockingIOError:
+            pass
+        except OSError:
+            # e.g. ENXIO, nobody has the fifo open. try again next time
+            self.close()
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def make_output(config):
+    if config.alert_output == 'gpio':
+        try:
+            return GPIOOutput(config.alert_gpio_pin)
+        except (ImportError, RuntimeError) as e:
+            print("GPIO alert output unavailable:", e)
+    elif config.alert_output == 'file':
+        return FileOutput(config.alert_path)
+    return AlertOutput()
+
+
+class AlertListener(MonitorListener):
+    ''' follows the DistanceMonitor of one sensor '''
+
+    def __init__(self, controller, sensor_name):
+        self.controller = controller
+        self.sensor_name = sensor_name
+
+    def state_changed(self, old_state, new_state, time_of_reading):
+        self.controller.update(self.sensor_name, new_state, time_of_reading)
+
+
+class AlertController:
+    ''' plays the pattern of the highest state of any sensor on the output '''
+
+    def __init__(self, config):
+        self.config = None
+        self.output = None
+        self.states = {}
+        self.level = 0
+        self.pattern = []
+        self.lock = threading.Lock()
+        # set when the pattern changes, wakes the player thread early
+        self.changed = threading.Event()
+        self.running = True
+        self.apply_config(config)
+        threading.Thread(target=self.play, daemon=True).start()
+
+    def listener(self, sensor_name):
+        return AlertListener(self, sensor_name)
+
+    def apply_config(self, config):
+        ''' the running pattern only starts over if the output or the
+            patterns changed, other settings leave it alone '''
+        old = self.config
+        restart = (old is None or old.alert_detected_pattern != config.alert_detected_pattern
+                   or old.alert_violation_pattern != config.alert_violation_pattern)
+        if (old is None or old.alert_output != config.alert_output
+                or old.alert_gpio_pin != config.alert_gpio_pin
+                or old.alert_path != config.alert_path):
+            with self.lock:
+                if self.output is not None:
+                    self.output.close()
+                self.output = make_output(config)
+            restart = True
+        self.config = config
+        if restart:
+            # pick up changed patterns straight away
+            self.set_level(self.level, force=True)
+
+    def update(self, sensor_name, state, time_of_reading):
+        self.states[sensor_name] = state
+        level = max(self.states.values())
+        if level != self.level:
+            self.set_level(level)
+            if level > 0:
+                latency = time.time() - time_of_reading
+                metrics.registry.set('smartlight_alert_latency_seconds', latency)
+                if latency*1000 > self.config.alert_budget_ms:
+                    metrics.registry.inc('smartlight_alerts_late_total')
+
+    def set_level(self, level, force=False):
+        if level == self.level and not force:
+            return
+        pattern = []
+        if level == 1:
+            pattern = self.config.alert_detected_pattern
+        elif level == 2:
+            pattern = self.config.alert_violation_pattern
+        with self.lock:
+            self.level = level
+            self.pattern = pattern
+            # first edge right now, the thread takes it from here
+            self.output.set(bool(pattern))
+        self.changed.set()
+
+    def play(self):
+        ''' player thread: steps through the current pattern, starting
+            over whenever it is replaced '''
+        while self.running:
+            self.changed.wait()
+            self.changed.clear()
+            with self.lock:
+                pattern = self.pattern
+            step = 0
+            while pattern and self.running:
+                # the edge for this step is already set, wait out its time
+                if self.changed.wait(pattern[step]/1000):
+                    break
+                step = (step + 1) % len(pattern)
+                with self.lock:
+                    if self.pattern is not pattern:
+                        break
+                    # even steps are on, odd steps off
+                    self.output.set(step % 2 == 0)
+
+    def close(self):
+        self.running = False
+        self.changed.set()
+        with self.lock:
+            self.output.set(False)
+            self.output.close()
+
+
+def main():
+    ''' plays both patterns of the default config on a file output '''
+    import sys
+    from config import DetectorConfig
+    path = sys.argv[1] if len(sys.argv) > 1 else '/dev/stdout'
+    controller = AlertController(DetectorConfig(alert_output='file', alert_path=path))
+    for state in (1, 2, 0):
+        controller.update('left', state, time.time())
+        time.sleep(1)
+    controller.close()
+
+
+if __name__ == "__main__":
+    main()
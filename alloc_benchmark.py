@@ -0,0 +1,173 @@
+#!/usr/bin/python3
+# Allocations per frame on the sensor hot path.
+#
+# Writes synthetic TFMini Plus frames into a pseudo terminal that a real
+# TFMini reads, one frame per scan_for_violations like the sensor loop, and
+# measures per frame, once the TFMini and DistanceMonitor are warmed up:
+#   - the memory allocated while the frame is handled, with tracemalloc: the
+#     peak of traced memory during scan_for_violations above what was traced
+#     before it. Memory that is freed again within the frame counts too.
+#     CPython keeps freed floats, tuples, lists and dicts on free lists and
+#     reuses them without tracemalloc seeing it, so for this the frames are
+#     fed a second time with the free lists emptied (by a full collection)
+#     before every frame.
+#   - the net number of objects tracked by the garbage collector, from
+#     gc.get_count(). These are what make the collector run.
+#   - the garbage collections that ran. With the startup objects frozen (see
+#     SmartLightPeripheral.publish) there should be none.
+# Passing vehicles are part of the frames, so the state machine and the
+# violation reports are included.
+#
+# A frame can't be free of allocations: CPython allocates every float and
+# every int above 256. What is left, about 206 bytes, is the tuple
+# read_sensor returns, the ints of the frame's distance, strength and
+# checksum, the counter of frames read and the floats of the frame times
+# (TFMini, DistanceMonitor.update_frame_ms and RideStatistics).
+# --max-bytes-per-frame is set just above that, so a list, a dict or
+# anything bigger made per frame fails the benchmark.
+#
+# Exits with status 1 if any of them is over its limit.
+#
+# usage: python3 alloc_benchmark.py [--frames 20000] [--max-bytes-per-frame 216]
+#                                   [--max-objects-per-frame 0.01] [--max-collections 0]
+import argparse
+import contextlib
+import gc
+import os
+import select
+import sys
+import tracemalloc
+
+from config import DetectorConfig
+from distanceMonitor import DistanceMonitor
+from ridestats import RideStatistics
+from tfminiplus import TFMini, FRAME_HEADER
+
+# one vehicle every PERIOD frames: FAR cm, then CLOSE cm for VEHICLE frames
+PERIOD = 400
+VEHICLE = 60
+FAR_CM = 1000
+CLOSE_CM = 120
+STRENGTH = 2000
+
+
+def pack_frame(cm, strength):
+    frame = bytearray([FRAME_HEADER, FRAME_HEADER, cm & 0xFF, cm >> 8,
+                       strength & 0xFF, strength >> 8, 0, 0])
+    frame.append(sum(frame) & 0xFF)
+    return bytes(frame)
+
+
+def make_frames():
+    ''' one period of frames, built before anything is measured '''
+    frames = []
+    for i in range(PERIOD):
+        cm = CLOSE_CM + i % 7 if i < VEHICLE else FAR_CM
+        frames.append(pack_frame(cm, STRENGTH))
+    return frames
+
+
+def run(monitor, master, poller, frames, count, empty_free_lists=False):
+    ''' feeds count frames, returns how many scans found no frame and
+        the bytes allocated while scanning, summed over all frames '''
+    missed = 0
+    allocated = 0
+    write = os.write
+    poll = poller.poll
+    scan = monitor.scan_for_violations
+    sensor = monitor.sensor
+    traced = tracemalloc.get_traced_memory
+    reset_peak = tracemalloc.reset_peak
+    collect = gc.collect
+    for i in range(count):
+        write(master, frames[i % PERIOD])
+        # the pty hands the bytes over asynchronously
+        poll(1000)
+        last_reading = sensor.time_of_reading
+        if empty_free_lists:
+            # see the top of this file
+            collect()
+        # the first call puts the tuple of its result on the free list,
+        # the second one reuses it, so it is already counted in before
+        traced()
+        before, _ = traced()
+        reset_peak()
+        scan()
+        _, peak = traced()
+        allocated += peak - before
+        if sensor.time_of_reading is last_reading:
+            missed += 1
+    return missed, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='measure the allocations per sensor frame')
+    parser.add_argument('--frames', type=int, default=20000)
+    parser.add_argument('--warmup', type=int, default=2*PERIOD)
+    parser.add_argument('--max-bytes-per-frame', type=float, default=216)
+    parser.add_argument('--max-objects-per-frame', type=float, default=0.01)
+    parser.add_argument('--max-collections', type=int, default=0)
+    args = parser.parse_args()
+
+    master, slave = os.openpty()
+    sensor = TFMini(os.ttyname(slave))
+    if not sensor.ready.wait(5):
+        sys.exit("unable to open the pseudo terminal as a sensor")
+    monitor = DistanceMonitor(sensor, DetectorConfig(), 'bench')
+    monitor.add_listener(RideStatistics())
+    poller = select.poll()
+    poller.register(sensor.fileno(), select.POLLIN)
+    frames = make_frames()
+
+    collections = [0]
+    # objects the collector tracked when it ran, it resets the count
+    collected_count = [0]
+
+    def count_collections(phase, info):
+        if phase == 'start':
+            collections[0] += 1
+            collected_count[0] += gc.get_count()[0]
+
+    # the monitor prints on every state change
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        gc.collect()
+        gc.freeze()
+        tracemalloc.start()
+        run(monitor, master, poller, frames, args.warmup)
+        # the collector is watched while the free lists work as usual,
+        # emptying them makes every first float or tuple of a frame count
+        gc.callbacks.append(count_collections)
+        count_before = gc.get_count()[0]
+        missed, _ = run(monitor, master, poller, frames, args.frames)
+        count_after = gc.get_count()[0]
+        gc.callbacks.remove(count_collections)
+        _, allocated = run(monitor, master, poller, frames, args.frames, empty_free_lists=True)
+        tracemalloc.stop()
+
+    sensor.close_port()
+    os.close(master)
+    os.close(slave)
+
+    bytes_per_frame = allocated/args.frames
+    objects_per_frame = (collected_count[0] + count_after - count_before)/args.frames
+    print(f"frames:                 {args.frames} ({missed} scans without a frame)")
+    print(f"vehicles:               {args.frames//PERIOD}")
+    print(f"allocated per frame:    {bytes_per_frame:.1f} bytes")
+    print(f"gc objects per frame:   {objects_per_frame:.3f}")
+    print(f"garbage collections:    {collections[0]}")
+    failed = False
+    if bytes_per_frame > args.max_bytes_per_frame:
+        print(f"FAIL: more than {args.max_bytes_per_frame} bytes allocated per frame")
+        failed = True
+    if objects_per_frame > args.max_objects_per_frame:
+        print(f"FAIL: more than {args.max_objects_per_frame} gc tracked objects per frame")
+        failed = True
+    if collections[0] > args.max_collections:
+        print(f"FAIL: more than {args.max_collections} garbage collections")
+        failed = True
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+# Static background model for the DistanceMonitor.
+#
+# A sideways facing sensor sees walls, parked cars and curbside objects as
+# a constant short distance. BackgroundModel learns such a distance once it
+# has held steady for learn_seconds and from then on marks readings at that
+# distance as background, so only objects closer than it (the moving
+# foreground) reach the state machine. The learned level follows slow drift
+# while it is seen, e.g. a wall the road slowly converges with, and is
+# forgotten once it hasn't been seen for forget_seconds.
+#
+# Memory use is constant: one candidate level and one background level.
+
+# readings may stop matching a candidate for this long without restarting it
+MISS_SECONDS = 0.25
+
+
+class BackgroundModel:
+
+    def __init__(self, learn_seconds=4.0, tolerance=6, forget_seconds=1.0, adapt_rate=0.05):
+        ''' tolerance is how many inches a reading may be off the level and
+            still belong to it. adapt_rate is how fast the background level
+            follows the readings that match it (0 - 1) '''
+        self.learn_seconds = learn_seconds
+        self.tolerance = tolerance
+        self.forget_seconds = forget_seconds
+        self.adapt_rate = adapt_rate
+        # the current stable background, None while there is none
+        self.level = None
+        self.last_seen = None
+        # a distance that may become the background: its level, since when
+        # it has held, and since when readings stopped matching it
+        self.candidate = None
+        self.candidate_since = None
+        self.candidate_miss_since = None
+        # true for the single update that learned a new background
+        self.just_learned = False
+
+    def reset(self):
+        self.level = None
+        self.last_seen = None
+        self.candidate = None
+        self.candidate_since = None
+        self.candidate_miss_since = None
+        self.just_learned = False
+
+    def update(self, time_of_reading, distance):
+        ''' returns True if distance is part of the background '''
+        self.just_learned = False
+        if self.level is not None:
+            if abs(distance - self.level) <= self.tolerance:
+                self.level += self.adapt_rate*(distance - self.level)
+                self.last_seen = time_of_reading
+                return True
+            if time_of_reading - self.last_seen > self.forget_seconds:
+                # the rider has moved past it
+                self.level = None
+        self.learn(time_of_reading, distance)
+        # the reading that completed learning is background too
+        return self.just_learned
+
+    def learn(self, time_of_reading, distance):
+        ''' track how long a distance has been steady. brief misses, like the
+            spurious far readings of the rpi3, don't restart the clock '''
+        if self.candidate is not None and abs(distance - self.candidate) <= self.tolerance:
+            self.candidate += (distance - self.candidate)/8
+            self.candidate_miss_since = None
+            if time_of_reading - self.candidate_since >= self.learn_seconds:
+                # only learn something closer than what is already background
+                if self.level is None or self.candidate < self.level - self.tolerance:
+                    self.level = self.candidate
+                    self.last_seen = time_of_reading
+                    self.just_learned = True
+                self.candidate = None
+            return
+        if self.candidate is not None:
+            if self.candidate_miss_since is None:
+                self.candidate_miss_since = time_of_reading
+            if time_of_reading - self.candidate_miss_since < MISS_SECONDS:
+                return
+        self.candidate = distance
+        self.candidate_since = time_of_reading
+        self.candidate_miss_since = None
@@ -0,0 +1,165 @@
+#!/usr/bin/python3
+# Black-box recorder for violations.
+#
+# FrameRingBuffer keeps the last few seconds of raw sensor frames in
+# preallocated arrays, so recording a frame never allocates. When the
+# DistanceMonitor confirms a vehicle (state 2) the EvidenceRecorder keeps
+# recording for a post-trigger window and then writes the whole window, the
+# detector parameters and a summary to a gzipped JSON evidence file from a
+# background thread, away from the sensor loop.
+import bisect
+import collections
+import dataclasses
+import gzip
+import json
+import os
+import threading
+from array import array
+
+from distanceMonitor import MonitorListener
+
+# stored in place of -1 (sensor error) since the arrays are unsigned
+NO_READING = 0xFFFF
+# recent events kept to match them with the capture they belong to
+RECENT_EVENTS = 8
+# the TFMini Plus frame rate goes up to 1000 Hz and a poll can read several
+# frames, so the ring is sized for the sensor's top rate, not the poll rate
+MAX_FRAMES_PER_SECOND = 1000
+
+
+class FrameRingBuffer:
+    ''' fixed capacity ring of (timestamp, distance, strength) frames.
+        timestamps are microseconds, distances inches and strengths the raw
+        TFMini amplitude, stored in array('q') and array('H') '''
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.timestamps = array('q', bytes(8*capacity))
+        self.distances = array('H', bytes(2*capacity))
+        self.strengths = array('H', bytes(2*capacity))
+        # index the next frame is written to
+        self.head = 0
+        self.count = 0
+
+    def append(self, timestamp_us, distance, strength):
+        head = self.head
+        self.timestamps[head] = timestamp_us
+        self.distances[head] = distance if 0 <= distance < NO_READING else NO_READING
+        self.strengths[head] = strength if 0 <= strength < NO_READING else NO_READING
+        head += 1
+        self.head = 0 if head == self.capacity else head
+        if self.count < self.capacity:
+            self.count += 1
+
+    def snapshot(self, since_us=None):
+        ''' returns copies of the three columns, oldest frame first,
+            only the frames from since_us on if it is given '''
+        start = (self.head - self.count) % self.capacity
+        columns = []
+        for column in (self.timestamps, self.distances, self.strengths):
+            if start + self.count <= self.capacity:
+                columns.append(column[start:start + self.count])
+            else:
+                columns.append(column[start:] + column[:self.head])
+        if since_us is not None:
+            first = bisect.bisect_left(columns[0], since_us)
+            columns = [column[first:] for column in columns]
+        return columns
+
+
+class EvidenceRecorder(MonitorListener):
+    ''' keeps config.evidence_pre_seconds of frames before and
+        config.evidence_post_seconds after a vehicle is confirmed,
+        and exports them as an evidence file. every confirmed vehicle gets
+        its own file, also when it is confirmed while the post window of
+        the one before is still being recorded '''
+
+    def __init__(self, config, evidence_dir):
+        self.evidence_dir = evidence_dir
+        self.config = None
+        self.buffer = None
+        # (trigger time, end of its post window), oldest first
+        self.triggers = []
+        self.events = collections.deque(maxlen=RECENT_EVENTS)
+        self.apply_config(config)
+
+    def apply_config(self, config):
+        ''' the capacity depends on the evidence windows, the buffer is
+            only reallocated (and its contents dropped) if they change.
+            the windows are cut by the frame timestamps, so they hold the
+            promised seconds at any frame rate up to MAX_FRAMES_PER_SECOND '''
+        self.pre_seconds = config.evidence_pre_seconds
+        self.post_seconds = config.evidence_post_seconds
+        capacity = int((self.pre_seconds + self.post_seconds)*MAX_FRAMES_PER_SECOND) + 1
+        if self.buffer is None or self.buffer.capacity != capacity:
+            self.buffer = FrameRingBuffer(capacity)
+            self.triggers = []
+        self.config = config
+
+    def frame(self, time_of_reading, distance, strength):
+        self.buffer.append(int(time_of_reading*1000000), distance, strength)
+        # triggers finish in the order they were queued
+        while self.triggers and time_of_reading >= self.triggers[0][1]:
+            self.export(self.triggers.pop(0)[0])
+
+    def state_changed(self, old_state, new_state, time_of_reading):
+        if new_state == 2:
+            self.triggers.append((time_of_reading, time_of_reading + self.post_seconds))
+
+    def violation(self, event):
+        self.events.append(event)
+
+    def event_for(self, trigger):
+        ''' the reported event of the vehicle confirmed at trigger, None
+            if it hasn't cleared yet '''
+        for event in reversed(self.events):
+            if event.begin_time <= trigger <= event.end_time:
+                return event
+        return None
+
+    def export(self, trigger):
+        ''' snapshot the buffer and hand it to a writer thread '''
+        columns = self.buffer.snapshot(int((trigger - self.pre_seconds)*1000000))
+        summary = {
+            'trigger_time': trigger,
+            'pre_seconds': self.pre_seconds,
+            'post_seconds': self.post_seconds,
+            'num_frames': len(columns[0]),
+        }
+        # the event is only complete if the vehicle cleared within the post window
+        event = self.event_for(trigger)
+        if event is not None:
+            summary['event'] = {
+                'begin_time': event.begin_time,
+                'end_time': event.end_time,
+                'distance': event.distance,
+                'num_readings': event.num_readings,
+                'confidence': event.confidence,
+                'distance_stats': event.stats(),
+            }
+        threading.Thread(
+            target=self.write, args=(columns, summary, dataclasses.asdict(self.config)),
+            daemon=True).start()
+
+    def write(self, columns, summary, parameters):
+        timestamps, distances, strengths = columns
+        path = os.path.join(self.evidence_dir, f"evidence_{int(summary['trigger_time']*1000000)}.json.gz")
+        evidence = {
+            'version': 1,
+            'parameters': parameters,
+            'summary': summary,
+            'samples': {
+                'time_us': timestamps.tolist(),
+                'distance': distances.tolist(),
+                'strength': strengths.tolist(),
+                'no_reading': NO_READING,
+            },
+        }
+        try:
+            os.makedirs(self.evidence_dir, exist_ok=True)
+            with gzip.open(path + '.tmp', 'wt') as f:
+                json.dump(evidence, f, separators=(',', ':'))
+            os.replace(path + '.tmp', path)
+            print("evidence written to", path)
+        except OSError as e:
+            print("unable to write evidence to", path, e)
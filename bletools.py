@@ -5,19 +5,34 @@ from gi.repository import GLib
 #local modules
 import constants
 
+def adapter_path_from_objects(objects):
+    '''returns the path of the first adapter that can advertise'''
+    for o, props in objects.items():
+        if constants.ADVERTISING_MANAGER_INTERFACE in props:
+            return o
+
+    return None
+
 def find_adapter_path(bus):
     '''returns the dbus objectManager adapter'''
     remote_om = dbus.Interface(
-        bus.get_object(constants.BLUEZ_SERVICE_NAME, "/"),
+        bus.get_object(constants.BLUEZ_SERVICE_NAME, "/", introspect=False),
         constants.DBUS_OM_IFACE)
 
     objects = remote_om.GetManagedObjects()
 
-    for o, props in objects.items():
-        if constants.ADVERTISING_MANAGER_INTERFACE in props:
-            return o
+    return adapter_path_from_objects(objects)
 
-    return None
+def find_adapter_path_async(bus, reply_handler, error_handler):
+    '''same as find_adapter_path without waiting for BlueZ.
+       reply_handler is called with the adapter path (or None) from the event loop'''
+    remote_om = dbus.Interface(
+        bus.get_object(constants.BLUEZ_SERVICE_NAME, "/", introspect=False),
+        constants.DBUS_OM_IFACE)
+
+    remote_om.GetManagedObjects(
+        reply_handler=lambda objects: reply_handler(adapter_path_from_objects(objects)),
+        error_handler=error_handler)
 
 class eventLoop:
     """Facade class to help with using GLib event loop"""
@@ -0,0 +1,114 @@
+#!/usr/bin/python3
+# Violation summary in the advertising data.
+#
+# With advertising_mode "hybrid" or "broadcast" (see config.py) the
+# advertisement carries manufacturer data that any scanner can read
+# without connecting, e.g. a bike computer or a roadside logger:
+#
+#   u8   format version (1)
+#   u16  violations since power on, wraps at 65536
+#   u8   sensor index of the latest violation (order of config.sensors)
+#   u8   closest approach of the latest violation in inches, 255 or more is 255
+#   u8   mean distance of the latest violation in inches, 255 or more is 255
+#   u16  duration of the latest violation in ms, saturates at 65535
+#   u8   confidence of the latest violation in percent
+#   u8   battery level in percent, 255 if unknown
+#
+# all little endian, 10 bytes under constants.BROADCAST_COMPANY_ID. Together
+# with the flags and the short name it fits a legacy 31 byte advertisement.
+#
+# The battery level is read from the kernel's power supply class, which
+# battery HATs with a kernel driver fill in. Without one it stays 255.
+import glob
+import os
+import struct
+
+import dbus
+
+import constants
+from distanceMonitor import MonitorListener
+
+FORMAT_VERSION = 1
+LAYOUT = '<BHBBBHBB'
+BATTERY_UNKNOWN = 0xFF
+POWER_SUPPLY_DIR = "/sys/class/power_supply"
+# seconds between two battery readings
+BATTERY_INTERVAL = 60
+
+
+def sysfs_battery_level(power_supply_dir=POWER_SUPPLY_DIR):
+    ''' charge in percent of the first battery the kernel knows of,
+        None if there is none '''
+    for supply in sorted(glob.glob(os.path.join(power_supply_dir, '*'))):
+        try:
+            with open(os.path.join(supply, 'type')) as f:
+                if f.read().strip() != 'Battery':
+                    continue
+            with open(os.path.join(supply, 'capacity')) as f:
+                return int(f.read().strip())
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+class BroadcastListener(MonitorListener):
+    ''' follows the DistanceMonitor of one sensor '''
+
+    def __init__(self, broadcaster, sensor_index):
+        self.broadcaster = broadcaster
+        self.sensor_index = sensor_index
+
+    def violation(self, event):
+        self.broadcaster.violation(self.sensor_index, event)
+
+
+class Broadcaster:
+    ''' keeps the manufacturer data of an advertisement.Advertisement up to date '''
+
+    def __init__(self, advertisement, battery_level=sysfs_battery_level):
+        ''' battery_level is a function returning the battery charge in
+            percent, or None when there is no battery it can read '''
+        self.advertisement = advertisement
+        self.battery_level = battery_level
+        self.violations = 0
+        self.sensor_index = 0
+        self.event = None
+        self.battery = BATTERY_UNKNOWN
+        self.refresh_battery()
+        # the advertisement is registered with this data already in it
+        advertisement.manufacturer_data = self.manufacturer_data()
+
+    def listener(self, sensor_index):
+        return BroadcastListener(self, sensor_index)
+
+    def pack(self):
+        event = self.event
+        if event is None:
+            summary = (0, 0, 0, 0)
+        else:
+            summary = (min(int(event.min_distance), 255),
+                       min(int(event.mean_distance), 255),
+                       min(int((event.end_time - event.begin_time)*1000), 0xFFFF),
+                       int(event.confidence*100))
+        return struct.pack(LAYOUT, FORMAT_VERSION, self.violations & 0xFFFF,
+                           self.sensor_index, *summary, self.battery)
+
+    def manufacturer_data(self):
+        return {constants.BROADCAST_COMPANY_ID:
+                dbus.Array([dbus.Byte(b) for b in self.pack()], signature='y')}
+
+    def violation(self, sensor_index, event):
+        self.violations += 1
+        self.sensor_index = sensor_index
+        self.event = event
+        self.advertisement.update_data(manufacturer_data=self.manufacturer_data())
+
+    def refresh_battery(self):
+        ''' meant to be polled with GLib.timeout_add_seconds, the
+            advertisement is only touched when the level changed '''
+        level = self.battery_level() if self.battery_level is not None else None
+        battery = BATTERY_UNKNOWN if level is None else max(0, min(int(level), 100))
+        if battery != self.battery:
+            self.battery = battery
+            self.advertisement.update_data(manufacturer_data=self.manufacturer_data())
+        return True
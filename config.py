@@ -0,0 +1,314 @@
+#!/usr/bin/python3
+# Detector configuration.
+#
+# Every tuning value of the DistanceMonitor and TFMini lives in a
+# DetectorConfig. It is loaded from a TOML file at startup (see
+# smartlight.toml for the defaults) and can be replaced while the
+# peripheral is running, either by editing the file or by writing to the
+# configuration characteristic. A DetectorConfig is immutable: a change
+# always creates a new, validated object which is then swapped in whole.
+#
+# Changes written over BLE are kept in an overrides file next to the
+# configuration file (smartlight.overrides.toml), so the documented file is
+# never rewritten. Overrides win over the configuration file.
+import dataclasses
+import os
+
+try:
+    import tomllib
+except ImportError: # python < 3.11
+    import tomli as tomllib
+
+import filters
+from background import BackgroundModel
+
+
+@dataclasses.dataclass(frozen=True)
+class DetectorConfig:
+    # a reading below this many inches is a violation. 73 inches is 6 feet, 1 inch
+    violation_threshold: int = 73
+    # consecutive readings needed to move from one state to another
+    consecutive_readings: int = 5
+    # close readings needed before an object is confirmed as a vehicle (state 2)
+    confirmation_readings: int = 24
+    # "readings" counts frames with the two settings above. "time" uses the
+    # frame timestamps instead, so the behaviour doesn't depend on the frame
+    # rate: an object is tracked after being closer than violation_threshold
+    # for enter_debounce_ms, confirmed after confirmation_ms and cleared once
+    # it has been at or beyond exit_threshold for exit_debounce_ms
+    detector_mode: str = 'readings'
+    exit_threshold: int = 79
+    enter_debounce_ms: int = 50
+    confirmation_ms: int = 240
+    exit_debounce_ms: int = 50
+    # in time mode a frame accounts for the time since the previous one, but
+    # no more than this: a longer gap (sensor stall, port reopen) isn't time
+    # seen. has to be above the frame period, e.g. 300 for a sensor at 5 Hz
+    max_frame_gap_ms: int = 100
+    # sensor range in inches, anything outside is reported as -1
+    distance_min: int = 4
+    distance_max: int = 480
+    # how often the sensor is polled
+    poll_interval_ms: int = 10
+    # TFMini Plus amplitude limits. Below strength_min the return is too weak
+    # (wet asphalt, dark paint) and 65535 means the receiver saturated
+    # (retroreflective plates); the distance is unreliable in both cases.
+    # a frame at or above strength_confident is fully trusted
+    strength_min: int = 100
+    strength_max: int = 65535
+    strength_confident: int = 1000
+    # one of filters.FILTERS, filter_params are passed to its constructor
+    filter: str = 'none'
+    filter_params: dict = dataclasses.field(default_factory=dict)
+    # learn stationary objects (walls, parked cars) as background so only
+    # closer, moving objects reach the state machine, see background.py.
+    # a distance steady within background_tolerance inches for
+    # background_learn_seconds becomes background, and is forgotten after
+    # not being seen for background_forget_seconds
+    background_model: bool = False
+    background_learn_seconds: float = 4.0
+    background_tolerance: int = 6
+    background_forget_seconds: float = 1.0
+    background_adapt_rate: float = 0.05
+    # split a line of vehicles into one violation per vehicle. in state 2 a
+    # gap of at least platoon_gap_ms, or readings at least platoon_jump_inches
+    # off the vehicle being tracked for platoon_jump_ms, start the next vehicle.
+    # the gap has to be shorter than it takes to clear (consecutive_readings
+    # or exit_debounce_ms) to ever be seen
+    platoon_segmentation: bool = False
+    platoon_gap_ms: int = 30
+    platoon_jump_inches: int = 12
+    platoon_jump_ms: int = 50
+    # one {name, port} table per sensor, e.g. [[sensors]] name = "left" port = "/dev/ttyAMA1"
+    # without any, a single sensor called "left" is used on the UART picked from
+    # the rpi model. changes take effect after a restart
+    sensors: list = dataclasses.field(default_factory=list)
+    # frames kept before and after a vehicle is confirmed, see blackbox.py
+    evidence_pre_seconds: float = 5.0
+    evidence_post_seconds: float = 2.0
+    # local warning as soon as an object is detected (state 1) and while a
+    # vehicle is confirmed (state 2), see alerts.py. alert_output is none,
+    # gpio (alert_gpio_pin, BCM numbering) or file (alert_path, may be a fifo).
+    # patterns are on/off times in ms, repeated for as long as the state lasts
+    alert_output: str = 'none'
+    alert_gpio_pin: int = 18
+    alert_path: str = '/run/smartlight/alert'
+    alert_detected_pattern: list = dataclasses.field(default_factory=lambda: [100, 400])
+    alert_violation_pattern: list = dataclasses.field(default_factory=lambda: [50, 50])
+    # frame to alert output latency that is counted as too slow
+    alert_budget_ms: int = 20
+    # "peripheral" advertises for connections only, "hybrid" also puts a
+    # violation summary in the advertising data (see broadcast.py) and
+    # "broadcast" only does that, without accepting connections.
+    # changes take effect after a restart
+    advertising_mode: str = 'peripheral'
+
+    def validate(self):
+        ''' raises ValueError if any value is of the wrong type or out of range '''
+        for field in dataclasses.fields(self):
+            value = getattr(self, field.name)
+            expected = field.type
+            if expected is float and isinstance(value, int) and not isinstance(value, bool):
+                value = float(value)
+            # bool is an int subclass but True is never a sensible threshold
+            if not isinstance(value, expected) or (isinstance(value, bool) and expected is not bool):
+                raise ValueError(f"{field.name} must be of type {expected.__name__}, got {value!r}")
+
+        if not 0 < self.distance_min < self.distance_max:
+            raise ValueError("distance_min must be positive and less than distance_max")
+        if not self.distance_min < self.violation_threshold <= self.distance_max:
+            raise ValueError("violation_threshold must be within distance_min and distance_max")
+        if self.consecutive_readings < 1:
+            raise ValueError("consecutive_readings must be at least 1")
+        if self.confirmation_readings <= self.consecutive_readings:
+            raise ValueError("confirmation_readings must be greater than consecutive_readings")
+        if self.detector_mode not in ('readings', 'time'):
+            raise ValueError("detector_mode must be readings or time")
+        if not self.violation_threshold <= self.exit_threshold <= self.distance_max:
+            raise ValueError("exit_threshold must be within violation_threshold and distance_max")
+        if not 0 <= self.enter_debounce_ms < self.confirmation_ms <= 10000:
+            raise ValueError("enter_debounce_ms must be less than confirmation_ms, at most 10 seconds")
+        if not 0 <= self.exit_debounce_ms <= 10000:
+            raise ValueError("exit_debounce_ms must be between 0 and 10 seconds")
+        if not 1 <= self.max_frame_gap_ms <= 10000:
+            raise ValueError("max_frame_gap_ms must be between 1 ms and 10 seconds")
+        if not 1 <= self.poll_interval_ms <= 1000:
+            raise ValueError("poll_interval_ms must be between 1 and 1000")
+        if not 0 <= self.strength_min < self.strength_confident <= self.strength_max:
+            raise ValueError("strength limits must satisfy strength_min < strength_confident <= strength_max")
+        if not (self.evidence_pre_seconds >= 0 and self.evidence_post_seconds >= 0
+                and self.evidence_pre_seconds + self.evidence_post_seconds <= 60):
+            raise ValueError("evidence windows must be positive and at most 60 seconds in total")
+        if not 0 < self.background_learn_seconds <= 600:
+            raise ValueError("background_learn_seconds must be between 0 and 600")
+        if not 0 < self.background_forget_seconds <= 600:
+            raise ValueError("background_forget_seconds must be between 0 and 600")
+        if self.background_tolerance < 1:
+            raise ValueError("background_tolerance must be at least 1")
+        if not 0 <= self.background_adapt_rate <= 1:
+            raise ValueError("background_adapt_rate must be between 0 and 1")
+        if self.platoon_gap_ms < 1 or self.platoon_jump_ms < 1 or self.platoon_jump_inches < 1:
+            raise ValueError("platoon_gap_ms, platoon_jump_inches and platoon_jump_ms must be at least 1")
+        if self.alert_output not in ('none', 'gpio', 'file'):
+            raise ValueError("alert_output must be none, gpio or file")
+        if not 0 <= self.alert_gpio_pin <= 27:
+            raise ValueError("alert_gpio_pin must be a BCM pin number between 0 and 27")
+        for name in ('alert_detected_pattern', 'alert_violation_pattern'):
+            pattern = getattr(self, name)
+            if (len(pattern) % 2 or len(pattern) > 32
+                    or not all(isinstance(ms, int) and not isinstance(ms, bool) and 0 < ms <= 10000
+                               for ms in pattern)):
+                raise ValueError(f"{name} must be pairs of on/off times between 1 and 10000 ms")
+        if self.alert_budget_ms < 1:
+            raise ValueError("alert_budget_ms must be at least 1")
+        if self.advertising_mode not in ('peripheral', 'hybrid', 'broadcast'):
+            raise ValueError("advertising_mode must be peripheral, hybrid or broadcast")
+        names = set()
+        for sensor in self.sensors:
+            if (not isinstance(sensor, dict) or set(sensor) != {'name', 'port'}
+                    or not all(isinstance(v, str) and v for v in sensor.values())):
+                raise ValueError(f"every sensor needs exactly a name and a port, got {sensor!r}")
+            if sensor['name'] in names:
+                raise ValueError(f"sensor name {sensor['name']} is used twice")
+            names.add(sensor['name'])
+        # building the filter checks its name and parameters
+        try:
+            self.make_filter()
+        except TypeError as e:
+            raise ValueError(f"invalid filter_params for {self.filter}: {e}")
+        return self
+
+    def make_filter(self):
+        return filters.make_filter(self.filter, **self.filter_params)
+
+    def make_background_model(self):
+        ''' None unless background_model is on '''
+        if not self.background_model:
+            return None
+        return BackgroundModel(self.background_learn_seconds, self.background_tolerance,
+                               self.background_forget_seconds, self.background_adapt_rate)
+
+    def replace(self, **changes):
+        ''' returns a new, validated config with `changes` applied '''
+        unknown = set(changes) - {field.name for field in dataclasses.fields(self)}
+        if unknown:
+            raise ValueError(f"unknown configuration keys: {sorted(unknown)}")
+        return dataclasses.replace(self, **changes).validate()
+
+    def to_toml(self, names=None):
+        ''' serialises the config as TOML, the format load_config reads.
+            names limits it to those keys '''
+        lines = []
+        for field in dataclasses.fields(self):
+            if names is None or field.name in names:
+                lines.append(f"{field.name} = {_toml_value(getattr(self, field.name))}")
+        return '\n'.join(lines) + '\n'
+
+    def changed_from(self, base):
+        ''' names of the fields whose value differs from base '''
+        return [field.name for field in dataclasses.fields(self)
+                if getattr(self, field.name) != getattr(base, field.name)]
+
+
+def _toml_value(value):
+    if isinstance(value, str):
+        return '"' + value.replace('\\', '\\\\').replace('"', '\\"') + '"'
+    if isinstance(value, dict):
+        return '{' + ', '.join(f"{k} = {_toml_value(v)}" for k, v in value.items()) + '}'
+    if isinstance(value, list):
+        return '[' + ', '.join(_toml_value(v) for v in value) + ']'
+    return repr(value)
+
+
+def parse_config(text, base=None):
+    ''' parses TOML text into a DetectorConfig.
+        keys missing from text keep their value from base (or the defaults) '''
+    base = base if base is not None else DetectorConfig()
+    try:
+        values = tomllib.loads(text)
+    except tomllib.TOMLDecodeError as e:
+        raise ValueError(f"invalid TOML: {e}")
+    return base.replace(**values)
+
+
+def load_config(path):
+    with open(path) as f:
+        return parse_config(f.read())
+
+
+class ConfigStore:
+    ''' owns the current DetectorConfig of the running peripheral.
+        listeners are called with every new config once it is validated,
+        from the GLib loop, i.e. always between two sensor samples '''
+
+    def __init__(self, path=None, overrides_path=None):
+        ''' overrides_path defaults to <path without .toml>.overrides.toml '''
+        self.path = path
+        if overrides_path is None and path is not None:
+            overrides_path = os.path.splitext(path)[0] + '.overrides.toml'
+        self.overrides_path = overrides_path
+        self.listeners = []
+        self.mtime = None
+        # the configuration file alone, without the overrides
+        self.base = DetectorConfig()
+        if path is not None and os.path.exists(path):
+            self.base = load_config(path)
+            self.mtime = os.path.getmtime(path)
+            print("loaded configuration from", path)
+        self.config = self.base
+        if overrides_path is not None and os.path.exists(overrides_path):
+            try:
+                with open(overrides_path) as f:
+                    self.config = parse_config(f.read(), self.base)
+                print("applied configuration overrides from", overrides_path)
+            except (OSError, ValueError) as e:
+                print("ignoring configuration overrides in", overrides_path, e)
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    def update(self, new_config, persist=True):
+        ''' swaps in new_config. raises ValueError if new_config is
+            invalid and OSError if it can't be saved, in both cases
+            nothing changes '''
+        new_config.validate()
+        if persist and self.overrides_path is not None:
+            self.save(new_config)
+        self.config = new_config
+        for listener in self.listeners:
+            listener(new_config)
+        print("configuration updated")
+
+    def update_from_text(self, text):
+        self.update(parse_config(text, self.config))
+
+    def save(self, config):
+        ''' writes what config changes on top of the configuration file '''
+        os.makedirs(os.path.dirname(self.overrides_path) or '.', exist_ok=True)
+        tmp_path = self.overrides_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write("# written by the Smart-Light when its configuration is changed over BLE.\n"
+                    f"# overrides {self.path}, delete this file to go back to it\n")
+            f.write(config.to_toml(config.changed_from(self.base)))
+        os.replace(tmp_path, self.overrides_path)
+
+    def reload_if_changed(self):
+        ''' meant to be polled with GLib.timeout_add_seconds.
+            an invalid file is reported and ignored, the running
+            config stays in place until the file is fixed '''
+        if self.path is None or not os.path.exists(self.path):
+            return True
+        try:
+            mtime = os.path.getmtime(self.path)
+            if mtime != self.mtime:
+                self.mtime = mtime
+                base = load_config(self.path)
+                # keep the overrides on top of the edited file
+                overrides = self.config.changed_from(self.base)
+                config = base.replace(**{name: getattr(self.config, name) for name in overrides})
+                self.base = base
+                self.update(config, persist=False)
+        except (OSError, ValueError) as e:
+            print("unable to reload configuration from", self.path, e)
+        # keep the GLib timer running
+        return True
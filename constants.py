@@ -62,8 +62,40 @@ DISTANCE_CHR_VALUE = [0x06, 0x00, 0xA2, 0x27, 0x00, 0x00, 0x00]
 
 # Bluetooth SIG adopted UUID for Characteristic Presentation Format
 CHR_PRES_FMT_UUID = "2904"
+# Bluetooth SIG adopted UUID for Characteristic User Description
+CHR_USER_DESC_UUID = "2901"
 
 
 
 LED_SVC_UUID = "e95dd91d-251d-470a-a062-fa1922dfa9a8"
 LED_TEXT_CHR_UUID = "e95d93ee-251d-470a-a062-fa1922dfa9a8"
+
+DIAGNOSTICS_SVC_UUID = "5b1f0c2e-7d43-4f6a-9a0e-3c51d2b8e700"
+DIAGNOSTICS_CHRC_UUID = "5b1f0c2e-7d43-4f6a-9a0e-3c51d2b8e701"
+
+# where the metrics exporter publishes the runtime counters
+METRICS_TEXTFILE_PATH = "/run/smartlight/metrics.prom"
+METRICS_SOCKET_PATH = "/run/smartlight/metrics.sock"
+# manufacturer data of the broadcast modes, see broadcast.py.
+# 0xFFFF is the company ID the Bluetooth SIG reserves for testing
+BROADCAST_COMPANY_ID = 0xFFFF
+# short enough to leave room for the manufacturer data
+BROADCAST_NAME = "SmartLight"
+
+# frames and events for local consumers, see pubsub.py
+EVENTS_SOCKET_PATH = "/run/smartlight/events.sock"
+
+CONFIG_CHRC_UUID = "adee5748-a528-4a95-bdc1-a770520cf416"
+RIDE_SUMMARY_CHRC_UUID = "adee5748-a528-4a95-bdc1-a770520cf417"
+ROLLUP_QUERY_CHRC_UUID = "adee5748-a528-4a95-bdc1-a770520cf418"
+# detector configuration, see config.py
+CONFIG_PATH = "/etc/smartlight/smartlight.toml"
+
+# UART of the distance sensor, detected once from /proc/cpuinfo
+PORT_CACHE_PATH = "/var/cache/smartlight/port"
+
+# per-violation evidence files written by blackbox.EvidenceRecorder
+EVIDENCE_DIR = "/var/lib/smartlight/evidence"
+
+# per-minute/hour/day violation history, see rollups.py
+ROLLUP_DB_PATH = "/var/lib/smartlight/rollups.db"
@@ -2,18 +2,116 @@ import dbus
 import dbus.service
 from time import sleep
 from tfminiplus import TFMini
+import metrics
+from config import DetectorConfig
+from streamstats import DistanceStats
+
+class ViolationEvent():
+    ''' summary of a single reported violation '''
+
+    __slots__ = ('sensor_name', 'begin_time', 'end_time', 'distance', 'num_readings',
+                 'confidence', 'min_distance', 'max_distance', 'mean_distance',
+                 'distance_variance', 'median_distance', 'p10_distance')
+
+    def __init__(self, begin_time, end_time, distance, num_readings, confidence,
+                 sensor_name=None, stats=None):
+        ''' distance is the average in whole inches, as sent over BLE.
+            stats is a streamstats.DistanceStats summary of the close readings '''
+        self.sensor_name = sensor_name
+        self.begin_time = begin_time
+        self.end_time = end_time
+        self.distance = distance
+        self.num_readings = num_readings
+        # 0.0 - 1.0, how much the sensor amplitude supports this event
+        self.confidence = confidence
+        stats = stats if stats is not None else {}
+        # the closest approach
+        self.min_distance = stats.get('min', distance)
+        self.max_distance = stats.get('max', distance)
+        self.mean_distance = stats.get('mean', distance)
+        self.distance_variance = stats.get('variance', 0.0)
+        self.median_distance = stats.get('median', distance)
+        self.p10_distance = stats.get('p10', distance)
+
+    def stats(self):
+        ''' the distance statistics as a dict, e.g. for evidence files '''
+        return {
+            'min': self.min_distance,
+            'max': self.max_distance,
+            'mean': self.mean_distance,
+            'variance': self.distance_variance,
+            'median': self.median_distance,
+            'p10': self.p10_distance,
+        }
+
+    def __repr__(self):
+        return (f"ViolationEvent(sensor={self.sensor_name}, distance={self.distance}, "
+                f"min={self.min_distance}, "
+                f"duration={self.end_time - self.begin_time:.3f}, "
+                f"readings={self.num_readings}, confidence={self.confidence:.2f})")
+
+
+class MonitorListener():
+    ''' base class for anything that follows a DistanceMonitor.
+        override the methods of interest, they are all called from
+        scan_for_violations so they must be quick '''
+
+    def frame(self, time_of_reading, distance, strength):
+        ''' every raw frame read from the sensor, including -1 readings '''
+
+    def state_changed(self, old_state, new_state, time_of_reading):
+        pass
+
+    def violation(self, event):
+        ''' a ViolationEvent has just been reported '''
+
 
 class DistanceMonitor():
     '''represents the car detection monitor part of the smart-light'''
 
-    def __init__(self):
-        self.sensor = TFMini()
+    def __init__(self, sensor=None, config=None, name=None):
+        ''' sensor defaults to the TFMini on the rpi UART, any object with the
+            same read_sensor/distance/time_of_reading interface can be used,
+            e.g. traces.TraceSensor to replay a recorded ride.
+            config is a config.DetectorConfig, the defaults are used if omitted.
+            name identifies the sensor when there is more than one '''
+        self.name = name
+        self.sensor = sensor if sensor is not None else TFMini()
+        self.config = None
+        self.filter = None
+        self.background = None
+        self.apply_config(config if config is not None else DetectorConfig())
+        self.listeners = []
+        self.last_event = None
+        self.confidence_sum = 0
+        self.num_gated_readings = 0
         self.violation_begin_time = -1
         self.violation_end_time = -1
         self.violation_distance = -1
         self.close_readings = 0
         self.num_close_readings = 0
+        # min/max/mean/variance and quantiles of the close readings,
+        # reused for every event so long events don't grow memory
+        self.distance_stats = DistanceStats()
         self.num_far_readings = 0
+        # time mode: milliseconds covered by close readings and by the
+        # current run of far readings, see frame_ms
+        self.close_ms = 0
+        self.far_ms = 0
+        self.frame_ms = 0
+        self.last_frame_time = None
+        # time of the latest close reading, where a vehicle ends when
+        # the next one follows right behind it
+        self.last_close_time = -1
+        # platoon segmentation: close readings in state 2 that don't fit
+        # the vehicle being tracked, they may be the start of the next one
+        self.pending_stats = DistanceStats()
+        self.pending_readings = 0
+        self.num_pending_readings = 0
+        self.pending_confidence_sum = 0
+        self.pending_ms = 0
+        self.pending_begin_time = -1
+        self.pending_end_time = -1
         self.state = 0
         self.state_close_readings = 0
 
@@ -25,8 +123,65 @@ class DistanceMonitor():
         self.violation_distance = -1
         self.close_readings = 0
         self.num_close_readings = 0
+        self.distance_stats.reset()
         self.num_far_readings = 0
-        self.state = 0
+        self.close_ms = 0
+        self.far_ms = 0
+        self.last_close_time = -1
+        self.confidence_sum = 0
+        self.num_gated_readings = 0
+        self.drop_pending()
+        self.set_state(0)
+
+    def apply_config(self, config):
+        ''' switch to a new DetectorConfig.
+            only ever called between two calls to scan_for_violations, so a
+            sample is always classified with one consistent configuration.
+            the filter and background model are only rebuilt when their
+            settings changed, so their history survives unrelated changes '''
+        old_config = self.config
+        if (old_config is None or old_config.filter != config.filter
+                or old_config.filter_params != config.filter_params):
+            self.filter = config.make_filter()
+        background_settings = ('background_model', 'background_learn_seconds', 'background_tolerance',
+                               'background_forget_seconds', 'background_adapt_rate')
+        if old_config is None or any(getattr(old_config, name) != getattr(config, name)
+                                     for name in background_settings):
+            self.background = config.make_background_model()
+        if hasattr(self.sensor, 'distance_min'):
+            self.sensor.distance_min = config.distance_min
+            self.sensor.distance_max = config.distance_max
+        self.config = config
+
+    def frame_confidence(self, strength):
+        ''' 0.0 at strength_min rising linearly to 1.0 at strength_confident '''
+        config = self.config
+        if strength >= config.strength_confident:
+            return 1.0
+        return (strength - config.strength_min)/(config.strength_confident - config.strength_min)
+
+    def event_confidence(self):
+        ''' average confidence of the frames that made up the current event,
+            scaled down by the share of its frames that had to be gated out '''
+        if self.num_close_readings == 0:
+            return 0.0
+        mean_confidence = self.confidence_sum/self.num_close_readings
+        valid_share = self.num_close_readings/(self.num_close_readings + self.num_gated_readings)
+        return mean_confidence*valid_share
+
+    def add_listener(self, listener):
+        ''' listener is a MonitorListener '''
+        self.listeners.append(listener)
+
+    def set_state(self, state):
+        ''' every state change goes through here so it is counted '''
+        old_state = self.state
+        self.state = state
+        if state != old_state:
+            metrics.registry.inc('smartlight_state_transitions_total')
+            metrics.registry.set('smartlight_detector_state', state)
+            for listener in self.listeners:
+                listener.state_changed(old_state, state, self.sensor.time_of_reading)
 
     def consecutive_readings(self, readings):
         ''' check to see if enough readings of the same value have been
@@ -36,8 +191,137 @@ class DistanceMonitor():
            This will only return true on the exact 5th reading, so 
            calling this function for consecutive readings > 5 in a row will return false
            Thus the state only changes on the 5th reading in a row
+           (5 is the default config.consecutive_readings)
         '''
-        return readings == 5
+        return readings == self.config.consecutive_readings
+
+    def update_frame_ms(self):
+        ''' time mode counts time instead of readings: every reading stands
+            for the time since the previous frame, so at 10 ms per frame
+            5 readings are 50 ms and so are 25 readings at 2 ms per frame '''
+        time_of_reading = self.sensor.time_of_reading
+        if self.last_frame_time is None:
+            self.frame_ms = 0
+        else:
+            # a longer gap (sensor stall, port reopen) isn't time seen
+            self.frame_ms = min((time_of_reading - self.last_frame_time)*1000,
+                                self.config.max_frame_gap_ms)
+        self.last_frame_time = time_of_reading
+
+    def threshold(self):
+        ''' in time mode an object that has been detected has to move
+            beyond exit_threshold to count as gone, so a vehicle passing
+            right at violation_threshold doesn't flap between states '''
+        config = self.config
+        if config.detector_mode == 'time' and self.state > 0:
+            return config.exit_threshold
+        return config.violation_threshold
+
+    def entered(self):
+        ''' an object has been close long enough to move to state 1 '''
+        if self.config.detector_mode == 'time':
+            return self.close_ms >= self.config.enter_debounce_ms
+        return self.consecutive_readings(self.num_close_readings)
+
+    def confirmed(self):
+        ''' an object has been close long enough to be a vehicle (state 2) '''
+        if self.config.detector_mode == 'time':
+            return self.close_ms >= self.config.confirmation_ms
+        # the next vehicle of a platoon starts with the readings that split it off
+        return self.num_close_readings >= self.config.confirmation_readings
+
+    def cleared(self):
+        ''' the object has been far long enough to be gone '''
+        if self.config.detector_mode == 'time':
+            return self.far_ms >= self.config.exit_debounce_ms
+        return self.consecutive_readings(self.num_far_readings)
+
+    def far_reading(self):
+        self.num_far_readings += 1
+        self.far_ms += self.frame_ms
+
+    def close_reading(self, distance, strength):
+        self.close_readings += distance
+        self.confidence_sum += self.frame_confidence(strength)
+        self.num_close_readings += 1
+        self.distance_stats.add(distance)
+        self.close_ms += self.frame_ms
+        self.last_close_time = self.sensor.time_of_reading
+        # always reset far readings counter when a close reading is seen
+        # The sensor occasionally returns false large-distance readings on the rpi3
+        # but rarely seems to return false short-distance readings
+        # essentially ignores the occasional far-distance sensor reading
+        self.num_far_readings = 0
+        self.far_ms = 0
+
+    def pending_reading(self, distance, strength):
+        ''' a close reading too far off the vehicle being tracked '''
+        if self.num_pending_readings == 0:
+            self.pending_begin_time = self.sensor.time_of_reading
+            self.pending_end_time = self.last_close_time
+        self.pending_readings += distance
+        self.pending_confidence_sum += self.frame_confidence(strength)
+        self.num_pending_readings += 1
+        self.pending_stats.add(distance)
+        self.pending_ms += self.frame_ms
+        self.num_far_readings = 0
+        self.far_ms = 0
+
+    def drop_pending(self):
+        ''' the vehicle came back into line, those readings were outliers '''
+        self.pending_readings = 0
+        self.num_pending_readings = 0
+        self.pending_confidence_sum = 0
+        self.pending_ms = 0
+        self.pending_stats.reset()
+
+    def split(self, end_time, begin_time):
+        ''' the vehicle being tracked ended at end_time and another one
+            began at begin_time. reports the first and starts tracking the
+            second from the pending readings, which still has to be confirmed.
+            returns the distance of the reported violation '''
+        violation_distance = self.report_violation(end_time)
+        self.close_readings = self.pending_readings
+        self.num_close_readings = self.num_pending_readings
+        self.confidence_sum = self.pending_confidence_sum
+        self.close_ms = self.pending_ms
+        self.num_gated_readings = 0
+        self.violation_begin_time = begin_time
+        # swap so the next vehicle keeps the pending statistics
+        self.distance_stats, self.pending_stats = self.pending_stats, self.distance_stats
+        self.drop_pending()
+        metrics.registry.inc('smartlight_platoon_splits_total')
+        print("next vehicle right behind")
+        self.set_state(1)
+        return violation_distance
+
+    def report_violation(self, end_time):
+        ''' creates the ViolationEvent of the vehicle being tracked and hands
+            it to the listeners. returns its distance.
+            end_time is the time of the vehicle's last close reading, both
+            when it cleared and when the next vehicle split it off, so the
+            far readings that confirm it left are never part of an event '''
+        avg_distance = self.close_readings//self.num_close_readings
+        self.violation_end_time = end_time
+        self.last_event = ViolationEvent(
+            self.violation_begin_time, self.violation_end_time,
+            avg_distance, self.num_close_readings, self.event_confidence(), self.name,
+            self.distance_stats.summary())
+        print("3-feet violation reported!")
+        print(f"closest approach: {self.last_event.min_distance}")
+        print("total time:",self.violation_end_time - self.violation_begin_time)
+        print(f"confidence: {self.last_event.confidence:.2f}")
+        for listener in self.listeners:
+            listener.violation(self.last_event)
+        metrics.registry.inc('smartlight_violations_total')
+        return avg_distance
+
+    def platoon_gap(self):
+        ''' the far readings that a close reading just ended were a gap
+            between two vehicles rather than a glitch '''
+        config = self.config
+        return (config.platoon_segmentation and self.num_far_readings > 0
+                and self.far_ms >= config.platoon_gap_ms)
 
     def scan_for_violations(self, test=False):
         ''' function that monitors for vehicles that
@@ -64,67 +348,96 @@ class DistanceMonitor():
 
                 must have 5 consecutive readings in order to transition
                 from one state to another
+
+            all of the above is in readings, which assumes one frame every
+            10 ms. with config.detector_mode "time" the readings are weighed
+            by the time between frame timestamps and the same steps are taken
+            after enter_debounce_ms, confirmation_ms and exit_debounce_ms.
+            a detected object is then only gone once it is at or beyond
+            exit_threshold, see threshold()
+
+            with config.platoon_segmentation a line of vehicles is split
+            in state 2: a gap of platoon_gap_ms, or a distance that stays
+            platoon_jump_inches off the vehicle for platoon_jump_ms,
+            ends one vehicle and starts tracking the next, see split()
         '''
         violation_distance = -1
+        config = self.config
         res = self.sensor.read_sensor()
+        if res is None:
+            # no new frame since the last call, nothing happened
+            return violation_distance
         # when testing, bogus values returned from sensor tend to be very large
         if test and res[0]>1000:
             print("distance:",res[0],'\n','strength',res[1],'\n')
+        for listener in self.listeners:
+            listener.frame(self.sensor.time_of_reading, self.sensor.distance, self.sensor.strength)
+        # both are -1 for a dropout in a trace, that isn't a frame to time
+        if self.sensor.distance != -1 or self.sensor.strength != -1:
+            self.update_frame_ms()
         # -1 is sensor err code
         # if the sensor returns an error code, skip this reading entirely. This will add 10ms of dead space
         # shouldn't be an issue except in certain edge cases. Probably not worth it to try to engineer for these
         # rather extreme edge cases. Something to be aware of though as more testing happens
         if self.sensor.distance < 0:
             return violation_distance
+        # low or saturated amplitude, the distance can't be trusted either
+        # remember it happened so the confidence of the event reflects it
+        strength = self.sensor.strength
+        if not config.strength_min <= strength < config.strength_max:
+            metrics.registry.inc('smartlight_low_confidence_readings_total')
+            if self.num_close_readings > 0:
+                self.num_gated_readings += 1
+            return violation_distance
+        distance = int(self.filter.update(self.sensor.distance))
+        # a learned stationary object is no object at all
+        if self.background is not None and self.background.update(self.sensor.time_of_reading, distance):
+            metrics.registry.inc('smartlight_background_readings_total')
+            if self.background.just_learned and self.state > 0:
+                # what has been tracked so far was this object, not a vehicle
+                print("stationary object, not a vehicle")
+                metrics.registry.inc('smartlight_background_events_discarded_total')
+                self.reset_violation_detector()
+                return violation_distance
+            distance = config.distance_max
         # 73 inches is 6 feet, 1 inch
-        violation = self.sensor.distance < 73
+        violation = distance < self.threshold()
 
         ######################## state 0 ########################
         if self.state == 0 and violation:
             # detected a distance < 6 feet,
             # inspiration from this came from the streaming average data structure
-            self.close_readings += self.sensor.distance
-            self.num_close_readings += 1
+            self.close_reading(distance, strength)
             if self.num_close_readings == 1:
                 self.violation_begin_time = self.sensor.time_of_reading
-            elif self.consecutive_readings(self.num_close_readings):
+            # not an elif: with consecutive_readings = 1 (or enter_debounce_ms
+            # reached by the first frame) the first close reading is enough
+            if self.entered():
                 print("Object detected!")
-                self.state = 1
-            # always reset far_readings counter when a close reading is recorded
-            # The sensor occasionally returns false large-distance readings on the rpi3
-            # but rarely seems to return false short-distance readings
-            # essentially ignores the occasional far-distance reading.
-            self.num_far_readings = 0
+                self.set_state(1)
         # consecutive readings verification
         elif self.state == 0 and not violation:
             if self.num_close_readings > 0:
-                self.num_far_readings += 1
-                if self.consecutive_readings(self.num_far_readings):
+                self.far_reading()
+                if self.cleared():
                     self.reset_violation_detector()
         #########################################################
 
 
         ######################## state 1 ########################
         elif self.state == 1 and violation:
-            self.close_readings += self.sensor.distance
-            self.num_close_readings += 1
-            if self.num_close_readings == 24:
+            self.close_reading(distance, strength)
+            if self.confirmed():
                 print("3-feet violation detected!")
-                print(f"distance (integer): {self.sensor.distance}")
+                print(f"distance (integer): {distance}")
 
                 if test: sleep(5)
 
-                self.state = 2
-
-            # always reset far readings counter when a close reading is seen
-            # The sensor occasionally returns false large-distance readings on the rpi3
-            # but rarely seems to return false short-distance readings
-            # essentially ignores the occasional far-distance sensor reading
-            self.num_far_readings = 0
+                self.set_state(2)
 
         elif self.state == 1 and not violation:
-            self.num_far_readings += 1
-            if self.consecutive_readings(self.num_far_readings):
+            self.far_reading()
+            if self.cleared():
                 print("object cleared. Probably not a vehicle")
                 self.reset_violation_detector()
         #########################################################
@@ -132,21 +445,26 @@ class DistanceMonitor():
 
         ######################## state 2 ########################
         elif self.state == 2 and violation:
-            self.close_readings += self.sensor.distance
-            self.num_close_readings += 1
-            self.num_far_readings = 0
+            if self.platoon_gap():
+                # the vehicle left the beam and the next one is already here
+                violation_distance = self.split(self.last_close_time, self.sensor.time_of_reading)
+                self.close_reading(distance, strength)
+            elif (config.platoon_segmentation
+                    and abs(distance - self.distance_stats.stats.mean) > config.platoon_jump_inches):
+                self.pending_reading(distance, strength)
+                if self.pending_ms >= config.platoon_jump_ms:
+                    violation_distance = self.split(self.pending_end_time, self.pending_begin_time)
+            else:
+                self.drop_pending()
+                self.close_reading(distance, strength)
 
         elif self.state == 2 and not violation:
-            self.num_far_readings += 1
-            if self.consecutive_readings(self.num_far_readings):
+            self.far_reading()
+            if self.cleared():
                 # vehicle has cleared the violation zone
                 # incident report will be created
-                avg_distance = self.close_readings//self.num_close_readings
-                self.violation_end_time = self.sensor.time_of_reading
-                print("3-feet violation reported!")
-                print("total time:",self.violation_end_time - self.violation_begin_time)
+                violation_distance = self.report_violation(self.last_close_time)
                 self.reset_violation_detector()
-                violation_distance = avg_distance
         #########################################################
         # returns -1 except in the case an actual violation is detected, in which it returns a positive number
         return violation_distance
@@ -162,7 +480,11 @@ def main():
     # dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     # bus = dbus.SystemBus()
     import sys
+    from traces import TraceRecorder
     monitor = DistanceMonitor()
+    # optionally record every frame, e.g. python3 distanceMonitor.py ride.csv
+    if len(sys.argv) > 1:
+        monitor.sensor = TraceRecorder(monitor.sensor)
     # print("running main loop...")
     # mainloop = GLib.MainLoop()
     try:
@@ -172,6 +494,9 @@ def main():
             print("violation distance ='",violation_distance,"'")
             sleep(.01)
     except KeyboardInterrupt:
+        if len(sys.argv) > 1:
+            monitor.sensor.save(sys.argv[1])
+            print("trace saved to", sys.argv[1])
         monitor.shutdown()
         print("\nsuccessful exit. Goodbye...")
         sys.exit(0)
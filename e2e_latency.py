@@ -0,0 +1,129 @@
+#!/usr/bin/python3
+# End-to-end latency test of the peripheral without a phone or a radio.
+#
+# Starts a private D-Bus daemon, fakebluez.py (fake BlueZ plus a scripted
+# central) and a SmartLightPeripheral on that bus whose sensor replays a
+# synthetic traffic scenario in real time. Reports the delay from the sensor
+# frame that completed a violation to the notification arriving at the
+# central, and how long reconnect cycles take.
+#
+# usage: python3 e2e_latency.py [--cycles 5] [--hold 10] [--seed 0]
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import dbus.bus
+from gi.repository import GLib
+
+from distanceMonitor import MonitorListener
+from simulation import ScenarioGenerator
+from smartLightPeripheral import SmartLightPeripheral
+from traces import TraceSensor
+
+
+class LiveTraceSensor(TraceSensor):
+    ''' replays a trace one frame per read, stamped with the wall clock
+        so frame times can be compared with the central's receive times.
+        starts over when the trace runs out '''
+
+    def read_sensor(self):
+        if self.exhausted():
+            self.index = 0
+        res = super().read_sensor()
+        self.time_of_reading = time.time()
+        return res
+
+
+class ReportTimes(MonitorListener):
+    ''' remembers the time of the frame that completed each violation.
+        that is the sensor's latest frame, the event ends at the vehicle's
+        last close reading before it '''
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.frame_times = []
+
+    def violation(self, event):
+        self.frame_times.append(self.sensor.time_of_reading)
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p/100*len(values)))]
+
+
+def wait_for_name(address, name, timeout=10.0):
+    bus = dbus.bus.BusConnection(address)
+    deadline = time.time() + timeout
+    while not bus.name_has_owner(name):
+        if time.time() > deadline:
+            raise RuntimeError(f"{name} did not appear on {address}")
+        time.sleep(0.05)
+    bus.close()
+
+
+def print_report(results, frame_times):
+    latencies = []
+    for received, _ in results['notifications']:
+        sent = [t for t in frame_times if t <= received]
+        if sent:
+            latencies.append(received - sent[-1])
+    print(f"notifications received:  {len(results['notifications'])}")
+    print(f"violations detected:     {len(frame_times)}")
+    if latencies:
+        print(f"frame to notification:   min {min(latencies)*1000:.1f} ms, "
+              f"median {percentile(latencies, 50)*1000:.1f} ms, "
+              f"p95 {percentile(latencies, 95)*1000:.1f} ms, "
+              f"max {max(latencies)*1000:.1f} ms")
+    if results['start_notify_rtt']:
+        print(f"StartNotify round trip:  median {percentile(results['start_notify_rtt'], 50)*1000:.1f} ms")
+    if results['readvertise_time']:
+        print(f"disconnect to advertise: median {percentile(results['readvertise_time'], 50)*1000:.1f} ms, "
+              f"max {max(results['readvertise_time'])*1000:.1f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='end-to-end latency against a fake BlueZ')
+    parser.add_argument('--cycles', type=int, default=5, help='connect/disconnect cycles')
+    parser.add_argument('--hold', type=float, default=10.0, help='seconds connected per cycle')
+    parser.add_argument('--seed', type=int, default=0, help='traffic scenario seed')
+    args = parser.parse_args()
+
+    daemon = subprocess.Popen(['dbus-daemon', '--session', '--nofork', '--print-address=1'],
+                              stdout=subprocess.PIPE, text=True)
+    address = daemon.stdout.readline().strip()
+    results_path = os.path.join(tempfile.mkdtemp(), 'results.json')
+    fakebluez = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakebluez.py')
+    central = subprocess.Popen([sys.executable, fakebluez, '--address', address,
+                                '--cycles', str(args.cycles), '--hold', str(args.hold),
+                                '--results', results_path])
+    try:
+        wait_for_name(address, 'org.bluez')
+        times, distances, strengths, _ = ScenarioGenerator(
+            seed=args.seed, duration=120, mean_spacing=3.0).generate()
+        sensor = LiveTraceSensor(times, distances, strengths, port='scenario')
+        smartlight = SmartLightPeripheral(config_path=None, bus_address=address, sensor=sensor)
+        report = ReportTimes(sensor)
+        for service in smartlight.app.services:
+            for chrc in service.characteristics:
+                if hasattr(chrc, 'monitor'):
+                    chrc.monitor.add_listener(report)
+        # the central exits once it has run all its cycles
+        GLib.child_watch_add(central.pid, lambda pid, status: smartlight.app.quit())
+        smartlight.publish()
+        central.wait()
+        with open(results_path) as f:
+            results = json.load(f)
+        print_report(results, report.frame_times)
+    finally:
+        if central.poll() is None:
+            central.terminate()
+        daemon.terminate()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/python3
+# Local stand-in for the parts of BlueZ the smart-light uses, plus a
+# scripted central.
+#
+# FakeBluez claims org.bluez on a private bus and implements the
+# ObjectManager, LEAdvertisingManager1 and GattManager1 interfaces of a
+# single adapter. Once the peripheral has registered its advertisement and
+# application, FakeCentral plays a phone: it "connects" (a Device1 object
+# with Connected=True), calls StartNotify on the distance characteristic,
+# records every PropertiesChanged notification, then disconnects and
+# repeats for the requested number of cycles.
+#
+# usage: python3 fakebluez.py --address ADDRESS [--cycles 5] [--hold 10]
+#                             [--results results.json]
+# e2e_latency.py starts the private bus, this process and the peripheral.
+#
+# Everything the peripheral calls here is answered without blocking, and
+# every call back into the peripheral is made asynchronously, as BlueZ does.
+import argparse
+import json
+import time
+
+import dbus
+import dbus.bus
+import dbus.service
+import dbus.mainloop.glib
+from gi.repository import GLib
+
+import constants
+import exceptions
+
+ADAPTER_PATH = constants.BLUEZ_NAMESPACE + constants.ADAPTER_NAME
+
+
+class FakeDevice(dbus.service.Object):
+    ''' org.bluez.Device1 of a connected central '''
+
+    def __init__(self, bus, index):
+        self.path = ADAPTER_PATH + '/dev_00_00_00_00_00_%02X' % index
+        self.connected = False
+        dbus.service.Object.__init__(self, bus, self.path)
+
+    def get_properties(self):
+        return {
+            constants.DEVICE_INTERFACE: {
+                'Adapter': dbus.ObjectPath(ADAPTER_PATH),
+                'Address': self.path[-17:].replace('_', ':'),
+                'Connected': dbus.Boolean(self.connected),
+            }
+        }
+
+    @dbus.service.method(constants.DBUS_PROPERTIES,
+                         in_signature='s',
+                         out_signature='a{sv}')
+    def GetAll(self, interface):
+        if interface != constants.DEVICE_INTERFACE:
+            raise exceptions.InvalidArgsException()
+        return self.get_properties()[constants.DEVICE_INTERFACE]
+
+    def set_connected(self, connected):
+        self.connected = connected
+        self.PropertiesChanged(constants.DEVICE_INTERFACE,
+                               {'Connected': dbus.Boolean(connected)}, [])
+
+    @dbus.service.signal(constants.DBUS_PROPERTIES,
+                         signature='sa{sv}as')
+    def PropertiesChanged(self, interface, changed, invalidated):
+        pass
+
+
+class FakeBluez(dbus.service.Object):
+    ''' the org.bluez root object manager. owns the hci0 FakeAdapter
+        and any FakeDevice a central has connected from '''
+
+    def __init__(self, bus):
+        self.bus = bus
+        self.bus_name = dbus.service.BusName(constants.BLUEZ_SERVICE_NAME, bus)
+        self.devices = []
+        # (sender, path) of the registered advertisement and application
+        self.advertisement = None
+        self.application = None
+        # characteristic UUID -> path, filled in from GetManagedObjects
+        self.characteristics = {}
+        self.on_ready = None
+        self.on_advertising = None
+        dbus.service.Object.__init__(self, bus, '/')
+        self.adapter = FakeAdapter(bus, self)
+
+    @dbus.service.method(constants.DBUS_OM_IFACE,
+                         out_signature='a{oa{sa{sv}}}')
+    def GetManagedObjects(self):
+        objects = {
+            ADAPTER_PATH: {
+                constants.ADAPTER_INTERFACE: {'Address': '00:00:00:00:00:00'},
+                constants.ADVERTISING_MANAGER_INTERFACE: {},
+                constants.GATT_MANAGER_INTERFACE: {},
+            }
+        }
+        for device in self.devices:
+            objects[device.path] = device.get_properties()
+        return objects
+
+    @dbus.service.signal(constants.DBUS_OM_IFACE,
+                         signature='oa{sa{sv}}')
+    def InterfacesAdded(self, path, interfaces):
+        pass
+
+    def add_device(self):
+        device = FakeDevice(self.bus, len(self.devices))
+        self.devices.append(device)
+        return device
+
+    def advertisement_registered(self, sender, path):
+        self.advertisement = (sender, path)
+        # read the advertisement back like BlueZ does, just to check it works
+        self.bus.get_object(sender, path, introspect=False).GetAll(
+            constants.ADVERTISEMENT_INTERFACE,
+            dbus_interface=constants.DBUS_PROPERTIES,
+            reply_handler=lambda props: print("fake bluez: advertising", dict(props)),
+            error_handler=lambda e: print("fake bluez: advertisement GetAll failed", e))
+        if self.on_advertising is not None:
+            self.on_advertising()
+
+    def application_registered(self, sender, path):
+        self.application = (sender, path)
+        self.bus.get_object(sender, path, introspect=False).GetManagedObjects(
+            dbus_interface=constants.DBUS_OM_IFACE,
+            reply_handler=self.application_objects_cb,
+            error_handler=lambda e: print("fake bluez: GetManagedObjects failed", e))
+
+    def application_objects_cb(self, objects):
+        for path, interfaces in objects.items():
+            chrc = interfaces.get(constants.GATT_CHARACTERISTIC_INTERFACE)
+            if chrc is not None:
+                self.characteristics[str(chrc['UUID'])] = path
+        print("fake bluez: application exposes", len(self.characteristics), "characteristics")
+        if self.on_ready is not None:
+            self.on_ready()
+
+
+class FakeAdapter(dbus.service.Object):
+    ''' org.bluez.LEAdvertisingManager1 and org.bluez.GattManager1 of hci0 '''
+
+    def __init__(self, bus, bluez):
+        self.bluez = bluez
+        dbus.service.Object.__init__(self, bus, ADAPTER_PATH)
+
+    @dbus.service.method(constants.ADVERTISING_MANAGER_INTERFACE,
+                         in_signature='oa{sv}', sender_keyword='sender')
+    def RegisterAdvertisement(self, path, options, sender=None):
+        print("fake bluez: RegisterAdvertisement", path)
+        # reply first, then talk back to the peripheral from the loop
+        GLib.idle_add(self.bluez.advertisement_registered, sender, path)
+
+    @dbus.service.method(constants.ADVERTISING_MANAGER_INTERFACE,
+                         in_signature='o')
+    def UnregisterAdvertisement(self, path):
+        print("fake bluez: UnregisterAdvertisement", path)
+        self.bluez.advertisement = None
+
+    @dbus.service.method(constants.GATT_MANAGER_INTERFACE,
+                         in_signature='oa{sv}', sender_keyword='sender')
+    def RegisterApplication(self, path, options, sender=None):
+        print("fake bluez: RegisterApplication", path)
+        GLib.idle_add(self.bluez.application_registered, sender, path)
+
+    @dbus.service.method(constants.GATT_MANAGER_INTERFACE,
+                         in_signature='o')
+    def UnregisterApplication(self, path):
+        print("fake bluez: UnregisterApplication", path)
+        self.bluez.application = None
+
+
+class FakeCentral:
+    ''' scripted phone: connect, StartNotify, collect notifications for
+        `hold` seconds, StopNotify, disconnect, and again for `cycles` times '''
+
+    def __init__(self, bluez, mainloop, cycles=5, hold=10.0):
+        self.bluez = bluez
+        self.bus = bluez.bus
+        self.mainloop = mainloop
+        self.cycles = cycles
+        self.hold = hold
+        self.cycle = 0
+        self.device = None
+        self.chrc = None
+        self.disconnect_time = None
+        self.results = {
+            'notifications': [],
+            'start_notify_rtt': [],
+            'readvertise_time': [],
+        }
+
+    def start(self):
+        ''' connects once the peripheral is advertising and its
+            application is registered, whichever comes last '''
+        self.bluez.on_ready = self.advertising
+        self.bluez.on_advertising = self.advertising
+
+    def advertising(self):
+        if self.bluez.application is None or self.bluez.advertisement is None:
+            return
+        if self.disconnect_time is not None:
+            self.results['readvertise_time'].append(time.time() - self.disconnect_time)
+            self.disconnect_time = None
+            self.connect()
+        elif self.cycle == 0:
+            self.connect()
+
+    def connect(self):
+        self.cycle += 1
+        print(f"fake central: connect {self.cycle}/{self.cycles}")
+        if self.device is None:
+            self.device = self.bluez.add_device()
+            self.device.connected = True
+            self.bluez.InterfacesAdded(self.device.path, self.device.get_properties())
+        else:
+            self.device.set_connected(True)
+
+        sender = self.bluez.application[0]
+        path = self.bluez.characteristics[constants.DISTANCE_CHRC_UUID]
+        self.chrc = self.bus.get_object(sender, path, introspect=False)
+        self.match = self.bus.add_signal_receiver(
+            self.notification_cb,
+            dbus_interface=constants.DBUS_PROPERTIES,
+            signal_name='PropertiesChanged',
+            bus_name=sender, path=path)
+        sent = time.time()
+        self.chrc.StartNotify(
+            dbus_interface=constants.GATT_CHARACTERISTIC_INTERFACE,
+            reply_handler=lambda: self.results['start_notify_rtt'].append(time.time() - sent),
+            error_handler=lambda e: print("fake central: StartNotify failed", e))
+        GLib.timeout_add(int(self.hold*1000), self.disconnect)
+
+    def notification_cb(self, interface, changed, invalidated):
+        received = time.time()
+        if 'Value' in changed:
+            value = [int(b) for b in changed['Value']]
+            self.results['notifications'].append((received, value))
+            print("fake central: notification", value)
+
+    def disconnect(self):
+        self.chrc.StopNotify(
+            dbus_interface=constants.GATT_CHARACTERISTIC_INTERFACE,
+            reply_handler=lambda: None,
+            error_handler=lambda e: print("fake central: StopNotify failed", e))
+        self.match.remove()
+        print(f"fake central: disconnect {self.cycle}/{self.cycles}")
+        if self.cycle >= self.cycles:
+            self.mainloop.quit()
+        else:
+            self.disconnect_time = time.time()
+            self.device.set_connected(False)
+        return False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='fake BlueZ with a scripted central')
+    parser.add_argument('--address', required=True, help='address of the private bus')
+    parser.add_argument('--cycles', type=int, default=5, help='connect/disconnect cycles')
+    parser.add_argument('--hold', type=float, default=10.0, help='seconds to stay connected')
+    parser.add_argument('--results', help='write the measurements to this JSON file')
+    args = parser.parse_args()
+
+    dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
+    bus = dbus.bus.BusConnection(args.address)
+    mainloop = GLib.MainLoop()
+    bluez = FakeBluez(bus)
+    central = FakeCentral(bluez, mainloop, args.cycles, args.hold)
+    central.start()
+    print("fake bluez: running on", args.address)
+    try:
+        mainloop.run()
+    except KeyboardInterrupt:
+        pass
+    if args.results:
+        with open(args.results, 'w') as f:
+            json.dump(central.results, f)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+# Compares the signal filters of filters.py on recorded traces.
+#
+# usage: python3 filter_benchmark.py ride1.csv [ride2.csv ...]
+#
+# For every filter the trace is replayed through a DistanceMonitor and the
+# number of reported violations and the detector throughput are printed,
+# followed by the raw throughput of the filter on its own.
+import argparse
+import contextlib
+import io
+import time
+
+import filters
+from config import DetectorConfig
+from traces import load_trace, TraceSensor
+from distanceMonitor import DistanceMonitor
+
+
+def run_monitor(trace, filter_name):
+    ''' replays a trace through a DistanceMonitor.
+        returns the list of reported violation distances and the seconds taken '''
+    monitor = DistanceMonitor(TraceSensor(*trace), DetectorConfig(filter=filter_name))
+    violations = []
+    start = time.perf_counter()
+    # the monitor prints on every state change, keep that out of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        while not monitor.sensor.exhausted():
+            violation_distance = monitor.scan_for_violations()
+            if violation_distance > 0:
+                violations.append(violation_distance)
+    return violations, time.perf_counter() - start
+
+
+def run_filter(distances, signal_filter):
+    start = time.perf_counter()
+    update = signal_filter.update
+    for d in distances:
+        if d >= 0:
+            update(d)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='compare signal filters on recorded traces')
+    parser.add_argument('traces', nargs='+', help='trace files recorded with distanceMonitor.py')
+    args = parser.parse_args()
+
+    for path in args.traces:
+        trace = load_trace(path)
+        num_samples = len(trace[1])
+        print(f"{path}: {num_samples} samples")
+        print(f"    {'filter':<8}{'violations':>12}{'monitor samples/s':>20}{'filter samples/s':>20}")
+        for name in sorted(filters.FILTERS):
+            violations, monitor_time = run_monitor(trace, name)
+            filter_time = run_filter(trace[1], filters.make_filter(name))
+            print(f"    {name:<8}{len(violations):>12}"
+                  f"{num_samples/monitor_time:>20,.0f}"
+                  f"{num_samples/max(filter_time, 1e-9):>20,.0f}")
+
+
+if __name__ == "__main__":
+    main()
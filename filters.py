@@ -0,0 +1,108 @@
+#!/usr/bin/python3
+# Streaming filters that sit between the TFMini and the DistanceMonitor
+# state machine.
+#
+# Every filter takes one distance (inches) per call to update() and returns
+# the filtered distance. The work done per sample does not depend on how
+# many samples have been seen, so a filter can run on every frame.
+import bisect
+from collections import deque
+
+
+class PassThroughFilter:
+    ''' no filtering, the detector sees the raw sensor readings '''
+
+    def update(self, distance):
+        return distance
+
+    def reset(self):
+        pass
+
+
+class RollingMedianFilter:
+    ''' median of the last `window` readings.
+        removes single spurious far readings (like the ones the rpi3 produces)
+        without smearing the edges of a passing car the way an average does '''
+
+    def __init__(self, window=5):
+        if window < 1:
+            raise ValueError("window must be at least 1")
+        self.window = window
+        self.reset()
+
+    def update(self, distance):
+        if len(self.readings) == self.window:
+            oldest = self.readings.popleft()
+            del self.ordered[bisect.bisect_left(self.ordered, oldest)]
+        self.readings.append(distance)
+        bisect.insort(self.ordered, distance)
+        return self.ordered[len(self.ordered)//2]
+
+    def reset(self):
+        # readings in arrival order, and the same readings kept sorted
+        self.readings = deque()
+        self.ordered = []
+
+
+class ExponentialFilter:
+    ''' exponential smoothing, alpha close to 1 follows the sensor closely,
+        alpha close to 0 smooths heavily '''
+
+    def __init__(self, alpha=0.5):
+        if not 0 < alpha <= 1:
+            raise ValueError("alpha must be in (0, 1]")
+        self.alpha = alpha
+        self.reset()
+
+    def update(self, distance):
+        if self.estimate is None:
+            self.estimate = distance
+        else:
+            self.estimate += self.alpha*(distance - self.estimate)
+        return self.estimate
+
+    def reset(self):
+        self.estimate = None
+
+
+class KalmanFilter:
+    ''' 1-D Kalman filter with a constant distance model.
+        process_variance is how much the true distance is expected to move
+        between two frames, measurement_variance is the sensor noise (inches^2) '''
+
+    def __init__(self, process_variance=4.0, measurement_variance=16.0):
+        self.process_variance = process_variance
+        self.measurement_variance = measurement_variance
+        self.reset()
+
+    def update(self, distance):
+        if self.estimate is None:
+            self.estimate = distance
+            self.error = self.measurement_variance
+            return self.estimate
+        # predict
+        self.error += self.process_variance
+        # correct
+        gain = self.error/(self.error + self.measurement_variance)
+        self.estimate += gain*(distance - self.estimate)
+        self.error *= 1 - gain
+        return self.estimate
+
+    def reset(self):
+        self.estimate = None
+        self.error = None
+
+
+FILTERS = {
+    'none': PassThroughFilter,
+    'median': RollingMedianFilter,
+    'ema': ExponentialFilter,
+    'kalman': KalmanFilter,
+}
+
+
+def make_filter(name='none', **params):
+    ''' returns a new filter by name, params are passed to its constructor '''
+    if name not in FILTERS:
+        raise ValueError(f"unknown filter '{name}', choose from {sorted(FILTERS)}")
+    return FILTERS[name](**params)
@@ -0,0 +1,430 @@
+#!/usr/bin/python3
+# Violation data of a fleet of Smart-Lights in one dataset.
+#
+# ingest reads what many units exported, in parallel across files, and
+# writes a columnar dataset: one .npy file per column, which Dataset opens
+# memory mapped, so a query only reads the pages of the columns and rows it
+# scans. The rows of every table are sorted by unit and time and each table
+# has a per-unit offset index, so selecting a unit is a slice and a time
+# range a binary search within it. Queries like closest_passes are numpy
+# reductions over those slices, no row ever becomes a Python object.
+#
+# The export directory has one directory per unit, named after it:
+#
+#   <unit>/**/*.jsonl                event logs, EventHub messages one per line
+#   <unit>/**/evidence_*.json.gz     evidence files of blackbox.py, in the
+#                                    directory named after their sensor
+#   <unit>/**/ride_<unix time>.bin   values of the ride summary characteristic
+#
+# Tables:
+#   events   one row per violation, from event logs and evidence files. a
+#            violation that is in both is kept once
+#   frames   the raw frames of the evidence files
+#   rides    one row per ride summary
+#
+# numpy is only needed here, on the analyst's machine, not on the units.
+#
+# usage: python3 fleet.py ingest EXPORT_DIR DATASET_DIR [--jobs N]
+#        python3 fleet.py closest DATASET_DIR [--period week] [--unit NAME ...]
+import argparse
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import shutil
+import time
+
+import numpy as np
+
+from blackbox import NO_READING
+from distanceMonitor import ViolationEvent
+from ridestats import RideStatistics, PASS_DISTANCE_BINS, PASS_DURATION_BINS, DISTANCE_BANDS, NO_PASS
+
+DATASET_VERSION = 1
+
+# column name: (dtype, width), width is None for plain columns.
+# unit and sensor are indexes into the unit and sensor names of the dataset
+TABLES = {
+    'events': {
+        'unit': ('u2', None),
+        'sensor': ('u1', None),
+        'begin_time': ('f8', None),
+        'end_time': ('f8', None),
+        'distance': ('u2', None),
+        'num_readings': ('u4', None),
+        'confidence': ('f4', None),
+        'min_distance': ('f4', None),
+        'max_distance': ('f4', None),
+        'mean_distance': ('f4', None),
+        'distance_variance': ('f4', None),
+        'median_distance': ('f4', None),
+        'p10_distance': ('f4', None),
+    },
+    'frames': {
+        'unit': ('u2', None),
+        'sensor': ('u1', None),
+        'time_us': ('i8', None),
+        'distance': ('u2', None),
+        'strength': ('u2', None),
+    },
+    'rides': {
+        'unit': ('u2', None),
+        'sensor': ('u1', None),
+        'time': ('f8', None),
+        'ride_seconds': ('u4', None),
+        'uptime_seconds': ('u4', None),
+        'violations': ('u2', None),
+        'closest_pass': ('u2', None),
+        'distance_histogram': ('u2', len(PASS_DISTANCE_BINS) + 1),
+        'duration_histogram': ('u2', len(PASS_DURATION_BINS) + 1),
+        'band_seconds': ('f4', len(DISTANCE_BANDS)),
+    },
+}
+# the column each table is sorted by within a unit
+TIME_COLUMNS = {'events': 'begin_time', 'frames': 'time_us', 'rides': 'time'}
+# rows that are the same thing seen twice, within the same unit and sensor
+DUPLICATE_RESOLUTION = {'events': 1000, 'frames': 1, 'rides': 1}
+
+HOUR = 3600
+DAY = 86400
+WEEK = 7*DAY
+PERIODS = {'hour': HOUR, 'day': DAY, 'week': WEEK}
+# weeks start on Monday, 1970-01-05 UTC
+PERIOD_ORIGIN = 4*DAY
+
+RIDE_NAME = re.compile(r'ride_(\d+)\.bin$')
+
+
+def find_files(export_dir):
+    ''' returns (kind, unit, sensor, path) for every file of an export.
+        sensor is None where the file itself names it '''
+    files = []
+    for unit in sorted(os.listdir(export_dir)):
+        unit_dir = os.path.join(export_dir, unit)
+        if not os.path.isdir(unit_dir):
+            continue
+        for root, _, names in os.walk(unit_dir):
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                if name.endswith('.jsonl'):
+                    files.append(('log', unit, None, path))
+                elif name.startswith('evidence_') and name.endswith('.json.gz'):
+                    # EvidenceRecorder writes to a directory per sensor
+                    sensor = os.path.basename(root) if root != unit_dir else ''
+                    files.append(('evidence', unit, sensor, path))
+                elif RIDE_NAME.match(name):
+                    files.append(('ride', unit, '', path))
+    return files
+
+
+def event_row(event):
+    ''' the events columns after unit and sensor of a ViolationEvent '''
+    return (event.begin_time, event.end_time, event.distance, event.num_readings,
+            event.confidence, event.min_distance, event.max_distance, event.mean_distance,
+            event.distance_variance, event.median_distance, event.p10_distance)
+
+
+def make_event(message):
+    ''' a ViolationEvent from an event log message or an evidence summary.
+        distance_stats is missing in files of older units '''
+    return ViolationEvent(message['begin_time'], message['end_time'], message['distance'],
+                          message['num_readings'], message['confidence'],
+                          message.get('sensor'), message.get('distance_stats'))
+
+
+def read_log(path):
+    events = []
+    with open(path) as f:
+        for line in f:
+            # frames are most of a log, skip them without decoding
+            if '"type":"violation"' not in line:
+                continue
+            try:
+                message = json.loads(line)
+            except ValueError:
+                # the unit lost power in the middle of a line
+                continue
+            events.append((message.get('sensor') or '', event_row(make_event(message))))
+    return {'events': events}
+
+
+def read_evidence(path, sensor):
+    with gzip.open(path, 'rt') as f:
+        evidence = json.load(f)
+    samples = evidence['samples']
+    tables = {'frames': [(sensor, (np.asarray(samples['time_us'], dtype='i8'),
+                                   np.asarray(samples['distance'], dtype='u2'),
+                                   np.asarray(samples['strength'], dtype='u2')))]}
+    event = evidence['summary'].get('event')
+    # only complete if the vehicle cleared within the post window
+    if event is not None:
+        tables['events'] = [(sensor, event_row(make_event(event)))]
+    return tables
+
+
+def read_ride(path, sensor):
+    with open(path, 'rb') as f:
+        stats = RideStatistics.unpack(f.read())
+    ride_time = int(RIDE_NAME.match(os.path.basename(path)).group(1))
+    closest_pass = NO_PASS if stats.closest_pass is None else stats.closest_pass
+    return {'rides': [(sensor, (ride_time, stats.ride_seconds, stats.uptime_seconds,
+                                stats.violations, closest_pass, stats.distance_histogram,
+                                stats.duration_histogram, stats.band_seconds))]}
+
+
+def read_file(task):
+    ''' runs in a worker process. returns (unit, path, tables, error),
+        tables maps a table name to a list of (sensor, row or columns) '''
+    kind, unit, sensor, path = task
+    try:
+        if kind == 'log':
+            tables = read_log(path)
+        elif kind == 'evidence':
+            tables = read_evidence(path, sensor)
+        else:
+            tables = read_ride(path, sensor)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        return unit, path, {}, str(e)
+    return unit, path, tables, None
+
+
+class TableBuilder:
+    ''' collects the rows of one table from every file '''
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = TABLES[name]
+        self.units = []
+        self.sensors = []
+        # values of the columns after unit and sensor, row by row or, for
+        # frames, as arrays of a whole file
+        self.rows = []
+        self.chunks = []
+
+    def add(self, unit_id, sensor_id, values):
+        if self.name == 'frames':
+            count = len(values[0])
+            self.units.append(np.full(count, unit_id, dtype='u2'))
+            self.sensors.append(np.full(count, sensor_id, dtype='u1'))
+            self.chunks.append(values)
+        else:
+            self.units.append(unit_id)
+            self.sensors.append(sensor_id)
+            self.rows.append(values)
+
+    def build(self):
+        ''' returns the columns sorted by unit and time, without duplicates '''
+        names = list(self.columns)[2:]
+        if self.name == 'frames':
+            units = np.concatenate(self.units) if self.units else np.empty(0, 'u2')
+            sensors = np.concatenate(self.sensors) if self.sensors else np.empty(0, 'u1')
+            values = [np.concatenate([chunk[i] for chunk in self.chunks]) if self.chunks
+                      else np.empty(0) for i in range(len(names))]
+        else:
+            units = np.asarray(self.units, dtype='u2')
+            sensors = np.asarray(self.sensors, dtype='u1')
+            values = [[row[i] for row in self.rows] for i in range(len(names))]
+        columns = {'unit': units, 'sensor': sensors}
+        for name, value in zip(names, values):
+            dtype, width = self.columns[name]
+            shape = (len(units), width) if width else (len(units),)
+            columns[name] = np.asarray(value, dtype=dtype).reshape(shape)
+
+        times = columns[TIME_COLUMNS[self.name]]
+        order = np.lexsort((sensors, times, units))
+        columns = {name: column[order] for name, column in columns.items()}
+        # the same violation from an event log and an evidence file, or the
+        # same frame in the evidence of two vehicles right behind each other
+        key = np.floor(columns[TIME_COLUMNS[self.name]]*DUPLICATE_RESOLUTION[self.name]).astype('i8')
+        keep = np.ones(len(key), dtype=bool)
+        keep[1:] = ((key[1:] != key[:-1]) | (columns['unit'][1:] != columns['unit'][:-1])
+                    | (columns['sensor'][1:] != columns['sensor'][:-1]))
+        return {name: column[keep] for name, column in columns.items()}
+
+
+def ingest(export_dir, dataset_dir, jobs=None):
+    ''' reads every file of export_dir and (re)writes the dataset.
+        returns the number of files that couldn't be read '''
+    files = find_files(export_dir)
+    unit_names = sorted({task[1] for task in files})
+    unit_ids = {name: i for i, name in enumerate(unit_names)}
+    sensor_ids = {'': 0}
+    builders = {name: TableBuilder(name) for name in TABLES}
+    errors = 0
+    start = time.perf_counter()
+    with multiprocessing.Pool(jobs) as pool:
+        for unit, path, tables, error in pool.imap_unordered(read_file, files, chunksize=16):
+            if error is not None:
+                print("unable to read", path, error)
+                errors += 1
+                continue
+            for name, rows in tables.items():
+                for sensor, values in rows:
+                    sensor_id = sensor_ids.setdefault(sensor, len(sensor_ids))
+                    builders[name].add(unit_ids[unit], sensor_id, values)
+    read_seconds = time.perf_counter() - start
+
+    # written next to the old dataset and swapped in when complete
+    tmp_dir = dataset_dir.rstrip('/') + '.tmp'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tables = {}
+    for name, builder in builders.items():
+        columns = builder.build()
+        table_dir = os.path.join(tmp_dir, name)
+        os.makedirs(table_dir)
+        for column, values in columns.items():
+            np.save(os.path.join(table_dir, column + '.npy'), values)
+        offsets = np.searchsorted(columns['unit'], np.arange(len(unit_names) + 1))
+        np.save(os.path.join(table_dir, 'unit_offsets.npy'), offsets)
+        tables[name] = {'rows': len(columns['unit']), 'time_column': TIME_COLUMNS[name]}
+    meta = {
+        'version': DATASET_VERSION,
+        'units': unit_names,
+        'sensors': sorted(sensor_ids, key=sensor_ids.get),
+        'tables': tables,
+        'no_reading': NO_READING,
+        'no_pass': NO_PASS,
+    }
+    with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+        json.dump(meta, f, indent=1)
+    shutil.rmtree(dataset_dir, ignore_errors=True)
+    os.replace(tmp_dir, dataset_dir)
+
+    print(f"{len(files)} files of {len(unit_names)} units read in {read_seconds:.1f} s"
+          f" ({errors} unreadable)")
+    for name, info in tables.items():
+        print(f"  {name:<8}{info['rows']:>12} rows")
+    return errors
+
+
+class Table:
+    ''' the columns of one table, each memory mapped on first use '''
+
+    def __init__(self, path, info):
+        self.path = path
+        self.rows = info['rows']
+        self.time_column = info['time_column']
+        self.offsets = np.load(os.path.join(path, 'unit_offsets.npy'))
+        self.columns = {}
+
+    def column(self, name):
+        if name not in self.columns:
+            self.columns[name] = np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r')
+        return self.columns[name]
+
+    def unit_range(self, unit_id, begin=None, end=None):
+        ''' the rows of a unit whose time is in [begin, end), as (first, last + 1) '''
+        first, last = int(self.offsets[unit_id]), int(self.offsets[unit_id + 1])
+        times = self.column(self.time_column)[first:last]
+        lo = first if begin is None else first + int(np.searchsorted(times, begin))
+        hi = last if end is None else first + int(np.searchsorted(times, end))
+        return lo, hi
+
+
+class Dataset:
+    ''' a dataset written by ingest '''
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        if meta['version'] != DATASET_VERSION:
+            raise ValueError(f"unknown dataset version {meta['version']}")
+        self.units = meta['units']
+        self.sensors = meta['sensors']
+        self.tables = {name: Table(os.path.join(path, name), info)
+                       for name, info in meta['tables'].items()}
+
+    def unit_ids(self, units=None):
+        ''' ids of the named units, all of them if units is None '''
+        if units is None:
+            return list(range(len(self.units)))
+        try:
+            return sorted(self.units.index(unit) for unit in units)
+        except ValueError:
+            raise KeyError(f"no such unit in {units}")
+
+    def select(self, table, columns, units=None, begin=None, end=None):
+        ''' returns {column: array} for the rows of the named units with a
+            time in [begin, end), sorted by unit and time. times are unix
+            seconds, microseconds for frames. a single unit comes back as
+            views of the mapped files, nothing is copied '''
+        table = self.tables[table]
+        ranges = [table.unit_range(unit_id, begin, end) for unit_id in self.unit_ids(units)]
+        selected = {}
+        for name in columns:
+            column = table.column(name)
+            parts = [column[lo:hi] for lo, hi in ranges]
+            if len(parts) == 1:
+                selected[name] = parts[0]
+            else:
+                selected[name] = np.concatenate(parts) if parts else column[:0]
+        return selected
+
+
+def period_starts(times, period):
+    ''' start of the hour, day or week (starting Monday, UTC) of each time '''
+    return (times - PERIOD_ORIGIN)//period*period + PERIOD_ORIGIN
+
+
+def group_starts(*keys):
+    ''' indexes where a run of equal keys starts, for sorted keys '''
+    if len(keys[0]) == 0:
+        return np.empty(0, dtype=np.intp)
+    change = np.zeros(len(keys[0]), dtype=bool)
+    change[0] = True
+    for key in keys:
+        change[1:] |= key[1:] != key[:-1]
+    return np.flatnonzero(change)
+
+
+def closest_passes(dataset, period=WEEK, units=None, begin=None, end=None):
+    ''' per unit and period: the number of violations, the closest approach
+        and the mean closest approach. returns {column: array} '''
+    events = dataset.select('events', ['unit', 'begin_time', 'min_distance'], units, begin, end)
+    unit = events['unit']
+    starts_of = period_starts(events['begin_time'], period)
+    # rows are sorted by unit and time, so every group is one run of rows
+    starts = group_starts(unit, starts_of)
+    counts = np.diff(np.append(starts, len(unit)))
+    closest = events['min_distance']
+    return {
+        'unit': unit[starts],
+        'period_start': starts_of[starts],
+        'violations': counts,
+        'closest': np.minimum.reduceat(closest, starts) if len(starts) else closest[:0],
+        'mean_closest': np.add.reduceat(closest.astype('f8'), starts)/counts if len(starts) else closest[:0],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='build and query the fleet dataset')
+    commands = parser.add_subparsers(dest='command', required=True)
+    ingest_parser = commands.add_parser('ingest', help='read the exports of all units')
+    ingest_parser.add_argument('export_dir')
+    ingest_parser.add_argument('dataset_dir')
+    ingest_parser.add_argument('--jobs', type=int, default=None,
+                               help='worker processes, one per CPU by default')
+    closest_parser = commands.add_parser('closest', help='closest passes per unit and period')
+    closest_parser.add_argument('dataset_dir')
+    closest_parser.add_argument('--period', choices=list(PERIODS), default='week')
+    closest_parser.add_argument('--unit', action='append', dest='units')
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        ingest(args.export_dir, args.dataset_dir, args.jobs)
+        return
+    dataset = Dataset(args.dataset_dir)
+    unknown = [unit for unit in args.units or [] if unit not in dataset.units]
+    if unknown:
+        closest_parser.error(f"no such unit: {', '.join(unknown)}, the dataset has {', '.join(dataset.units)}")
+    result = closest_passes(dataset, PERIODS[args.period], args.units)
+    print(f"{'unit':<20}{args.period + ' of':<18}{'violations':>11}{'closest':>9}{'mean':>8}")
+    for i in range(len(result['unit'])):
+        start = time.strftime('%Y-%m-%d %H:%M', time.gmtime(result['period_start'][i]))
+        print(f"{dataset.units[result['unit'][i]]:<20}{start:<18}{result['violations'][i]:>11}"
+              f"{result['closest'][i]:>9.0f}{result['mean_closest'][i]:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
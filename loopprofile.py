@@ -0,0 +1,198 @@
+#!/usr/bin/python3
+# Optional latency profiler for the GLib main loop.
+#
+# The sensor timer, the D-Bus method handlers and the signal handlers all
+# run on the one GLib loop, so any of them running long delays all the
+# others. With SMARTLIGHT_PROFILE=1 in the environment every callback
+# scheduled through `profiler` records how long it ran, and timers also
+# record their scheduling lag: how late they ran compared to the interval
+# they were added with. Both go into fixed bucket histograms per callback,
+# and any callback running longer than the budget (SMARTLIGHT_PROFILE_BUDGET_MS,
+# 5 ms by default) is printed as it happens.
+#
+# Without the environment variable the profiler hands callbacks to GLib
+# unchanged, so it costs nothing.
+import os
+import time
+
+# upper bucket edges in milliseconds, the last bucket takes everything above
+BUCKETS_MS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 1000]
+
+
+class Histogram:
+
+    def __init__(self, bounds=BUCKETS_MS):
+        self.bounds = bounds
+        self.counts = [0]*(len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, ms):
+        i = 0
+        while i < len(self.bounds) and ms > self.bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        self.count += 1
+        self.total += ms
+        if ms > self.max:
+            self.max = ms
+
+    def mean(self):
+        return self.total/self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        ''' upper edge of the bucket holding the given fraction of samples '''
+        rank = fraction*self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+
+class CallbackProfile:
+    ''' what the profiler knows about one callback '''
+
+    def __init__(self, name):
+        self.name = name
+        self.runtime = Histogram()
+        # only timers have an intended time to be late against
+        self.lag = Histogram()
+        self.over_budget = 0
+
+
+class LoopProfiler:
+
+    def __init__(self, enabled=False, budget_ms=5.0):
+        self.enabled = enabled
+        self.budget_ms = budget_ms
+        self.callbacks = {}
+        self._dbus_instrumented = False
+
+    def profile(self, name):
+        profile = self.callbacks.get(name)
+        if profile is None:
+            profile = self.callbacks[name] = CallbackProfile(name)
+        return profile
+
+    def record(self, name, runtime_ms, lag_ms=None):
+        profile = self.profile(name)
+        profile.runtime.observe(runtime_ms)
+        if lag_ms is not None:
+            profile.lag.observe(lag_ms)
+        if runtime_ms > self.budget_ms:
+            profile.over_budget += 1
+            print(f"loop profiler: {name} ran {runtime_ms:.1f} ms, budget is {self.budget_ms:g} ms")
+
+    def timed(self, name, callback):
+        ''' returns callback wrapped to record its runtime,
+            e.g. for signal receivers and io watches '''
+        if not self.enabled:
+            return callback
+
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return callback(*args, **kwargs)
+            finally:
+                self.record(name, (time.perf_counter() - start)*1000)
+        return wrapper
+
+    def timeout_add(self, interval_ms, callback, *args, name=None):
+        ''' GLib.timeout_add that also records the callback's lag '''
+        from gi.repository import GLib
+        if not self.enabled:
+            return GLib.timeout_add(interval_ms, callback, *args)
+        return GLib.timeout_add(interval_ms, self._timer(name, interval_ms, callback), *args)
+
+    def timeout_add_seconds(self, interval, callback, *args, name=None):
+        ''' GLib.timeout_add_seconds that also records the callback's lag.
+            GLib lets these drift by up to a second to group wakeups,
+            so their lag is only meaningful in whole seconds '''
+        from gi.repository import GLib
+        if not self.enabled:
+            return GLib.timeout_add_seconds(interval, callback, *args)
+        return GLib.timeout_add_seconds(interval, self._timer(name, interval*1000, callback), *args)
+
+    def _timer(self, name, interval_ms, callback):
+        name = name or getattr(callback, '__qualname__', repr(callback))
+        # GLib schedules the next run one interval after the previous one was dispatched
+        expected = time.monotonic() + interval_ms/1000
+
+        def wrapper(*args):
+            nonlocal expected
+            start = time.monotonic()
+            lag_ms = max(start - expected, 0)*1000
+            keep = callback(*args)
+            self.record(name, (time.monotonic() - start)*1000, lag_ms)
+            expected = start + interval_ms/1000
+            return keep
+        return wrapper
+
+    def instrument_dbus(self):
+        ''' time every D-Bus method call into this process's objects.
+            dbus-python calls a subclass's undecorated override (e.g. the
+            ReadValue of each characteristic), not the decorated method of
+            GATT.py, so the calls are timed where dbus-python dispatches them.
+            objects bind their dispatcher when they are exported, so call
+            this before creating any dbus.service.Object '''
+        if not self.enabled or self._dbus_instrumented:
+            return
+        import dbus.service
+        message_cb = dbus.service.Object._message_cb
+        profiler = self
+
+        def _message_cb(obj, connection, message):
+            start = time.perf_counter()
+            try:
+                return message_cb(obj, connection, message)
+            finally:
+                name = f"{type(obj).__name__}.{message.get_member()}"
+                profiler.record(name, (time.perf_counter() - start)*1000)
+        dbus.service.Object._message_cb = _message_cb
+        self._dbus_instrumented = True
+
+    def render_prometheus(self):
+        ''' both histograms of every callback, in seconds, for metrics.MetricsExporter '''
+        lines = []
+        for metric, attr, help_text in (
+                ('smartlight_loop_callback_seconds', 'runtime', 'time a main loop callback ran'),
+                ('smartlight_loop_lag_seconds', 'lag', 'how late a main loop timer ran')):
+            lines.append(f"# HELP {metric} {help_text}")
+            lines.append(f"# TYPE {metric} histogram")
+            for name, profile in self.callbacks.items():
+                histogram = getattr(profile, attr)
+                if not histogram.count:
+                    continue
+                cumulative = 0
+                for bound, count in zip(histogram.bounds + ['+Inf'], histogram.counts):
+                    cumulative += count
+                    le = bound if bound == '+Inf' else f"{bound/1000:g}"
+                    lines.append(f'{metric}_bucket{{callback="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{metric}_sum{{callback="{name}"}} {histogram.total/1000:g}')
+                lines.append(f'{metric}_count{{callback="{name}"}} {histogram.count}')
+        metric = 'smartlight_loop_over_budget_total'
+        lines.append(f"# HELP {metric} callbacks that ran longer than the loop budget")
+        lines.append(f"# TYPE {metric} counter")
+        for name, profile in self.callbacks.items():
+            lines.append(f'{metric}{{callback="{name}"}} {profile.over_budget}')
+        return '\n'.join(lines) + '\n'
+
+    def report(self):
+        if not self.enabled:
+            return
+        print(f"{'callback':<40}{'calls':>8}{'mean ms':>9}{'p99 ms':>8}{'max ms':>8}"
+              f"{'lag p99':>9}{'lag max':>9}{'over':>6}")
+        for name, profile in sorted(self.callbacks.items(), key=lambda c: -c[1].runtime.max):
+            runtime, lag = profile.runtime, profile.lag
+            lag_columns = f"{lag.percentile(0.99):>9g}{lag.max:>9.1f}" if lag.count else f"{'-':>9}{'-':>9}"
+            print(f"{name:<40}{runtime.count:>8}{runtime.mean():>9.2f}{runtime.percentile(0.99):>8g}"
+                  f"{runtime.max:>8.1f}{lag_columns}{profile.over_budget:>6}")
+
+
+# shared by every module of the peripheral process
+profiler = LoopProfiler(
+    enabled=os.environ.get('SMARTLIGHT_PROFILE', '') not in ('', '0'),
+    budget_ms=float(os.environ.get('SMARTLIGHT_PROFILE_BUDGET_MS', 5)))
@@ -0,0 +1,239 @@
+#!/usr/bin/python3
+# Runtime counters and gauges for the smart-light peripheral.
+#
+# Every module bumps counters on the shared `registry` object. The registry
+# itself has no dependencies so it can be imported from the sensor code;
+# MetricsExporter publishes it as a Prometheus text file and on a local
+# Unix socket from inside the GLib event loop.
+import os
+import socket
+import struct
+import time
+
+import constants
+
+# (name, help text). The order of this list is also the order in which
+# counters are packed into the diagnostics characteristic, so only append.
+COUNTERS = [
+    ('smartlight_frames_read_total',
+        'frames read from the TFMini sensor'),
+    ('smartlight_header_resync_retries_total',
+        'bytes skipped to find a valid 0x59 0x59 frame'),
+    ('smartlight_out_of_range_readings_total',
+        'frames outside the sensor distance_min/distance_max range'),
+    ('smartlight_error_readings_total',
+        'reads of the sensor port that failed'),
+    ('smartlight_state_transitions_total',
+        'state changes of the DistanceMonitor state machine'),
+    ('smartlight_violations_total',
+        'violations emitted by the DistanceMonitor'),
+    ('smartlight_notifications_sent_total',
+        'violation notifications sent over BLE'),
+    ('smartlight_notifications_dropped_total',
+        'violations that could not be sent over BLE'),
+    ('smartlight_reconnects_total',
+        'BLE connections seen after a previous disconnect'),
+    ('smartlight_low_confidence_readings_total',
+        'frames discarded because the sensor strength was too low or saturated'),
+    ('smartlight_sensor_stalls_total',
+        'times the sensor stopped sending frames'),
+    ('smartlight_sensor_reopens_total',
+        'times the sensor port was closed and reopened'),
+    ('smartlight_event_frames_skipped_total',
+        'frames not sent to an event hub client that was behind'),
+    ('smartlight_event_subscribers_dropped_total',
+        'event hub clients disconnected for not reading'),
+    ('smartlight_alerts_late_total',
+        'alert outputs switched later than alert_budget_ms after the frame'),
+    ('smartlight_background_readings_total',
+        'readings of a learned stationary background, not passed to the detector'),
+    ('smartlight_background_events_discarded_total',
+        'detections dropped because the object turned out to be stationary'),
+    ('smartlight_platoon_splits_total',
+        'violations ended because the next vehicle followed right behind'),
+]
+
+GAUGES = [
+    ('smartlight_detector_state',
+        'current DistanceMonitor state (0, 1 or 2)'),
+    ('smartlight_connected',
+        '1 while a BLE central is connected'),
+    ('smartlight_sensor_health',
+        'sensor health: 0 starting, 1 ok, 2 stalled, 3 reconnecting'),
+    ('smartlight_event_subscribers',
+        'clients connected to the event hub'),
+    ('smartlight_alert_latency_seconds',
+        'time from the frame to the alert output of the last alert'),
+    ('smartlight_start_time_seconds',
+        'unix time the peripheral process started'),
+    ('smartlight_startup_imports_seconds',
+        'seconds from process start until all modules were imported'),
+    ('smartlight_startup_adapter_found_seconds',
+        'seconds from process start until the bluetooth adapter was found'),
+    ('smartlight_startup_sensor_ready_seconds',
+        'seconds from process start until the sensor port was open'),
+    ('smartlight_startup_advertisement_registered_seconds',
+        'seconds from process start until the first advertisement was registered'),
+    ('smartlight_startup_application_registered_seconds',
+        'seconds from process start until the GATT application was registered'),
+]
+
+
+class MetricsRegistry:
+    ''' holds every counter and gauge of the running peripheral.
+        counters only ever go up, gauges can be set to any value '''
+
+    def __init__(self):
+        self.help = {}
+        # functions returning more exposition text, e.g. histograms
+        self.collectors = []
+        self.counters = {}
+        self.gauges = {}
+        for name, help_text in COUNTERS:
+            self.counters[name] = 0
+            self.help[name] = help_text
+        for name, help_text in GAUGES:
+            self.gauges[name] = 0
+            self.help[name] = help_text
+
+    def inc(self, name, amount=1):
+        self.counters[name] += amount
+
+    def set(self, name, value):
+        self.gauges[name] = value
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def get(self, name):
+        if name in self.counters:
+            return self.counters[name]
+        return self.gauges[name]
+
+    def render_prometheus(self):
+        ''' returns all metrics in the Prometheus text exposition format '''
+        lines = []
+        for name, value in self.counters.items():
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} counter")
+            lines.append(f"{name} {value}")
+        for name, value in self.gauges.items():
+            lines.append(f"# HELP {name} {self.help[name]}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        text = '\n'.join(lines) + '\n'
+        for collector in self.collectors:
+            text += collector()
+        return text
+
+    def pack_counters(self):
+        ''' packs every counter as a little endian uint32 in COUNTERS order.
+            used as the value of the diagnostics characteristic, which has to
+            stay well below the 512 byte limit of a GATT attribute '''
+        values = [self.counters[name] & 0xFFFFFFFF for name, _ in COUNTERS]
+        return struct.pack('<%dI' % len(values), *values)
+
+
+class StartupTimer:
+    ''' records when each startup phase finished, relative to `start`
+        (a time.perf_counter() value, SmartLight.py sets it before its imports).
+        only the first time a phase is marked counts '''
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+        self.start = time.perf_counter()
+        self.phases = {}
+
+    def mark(self, phase):
+        if phase in self.phases:
+            return
+        elapsed = time.perf_counter() - self.start
+        self.phases[phase] = elapsed
+        self.metrics.set(f"smartlight_startup_{phase}_seconds", elapsed)
+        print(f"startup: {phase} after {elapsed*1000:.0f} ms")
+
+
+# shared by every module of the peripheral process
+registry = MetricsRegistry()
+registry.set('smartlight_start_time_seconds', int(time.time()))
+startup = StartupTimer(registry)
+
+
+class MetricsExporter:
+    ''' exports a MetricsRegistry from inside the GLib event loop.
+        the text file is rewritten every `interval` seconds and every
+        connection to the Unix socket receives the current metrics
+        and is then closed, so neither path ever blocks the loop '''
+
+    def __init__(self, metrics=registry,
+                 textfile_path=constants.METRICS_TEXTFILE_PATH,
+                 socket_path=constants.METRICS_SOCKET_PATH,
+                 interval=10):
+        self.metrics = metrics
+        self.textfile_path = textfile_path
+        self.socket_path = socket_path
+        self.interval = interval
+        self._sock = None
+
+    def start(self):
+        # imported here so the registry stays usable without GLib
+        from gi.repository import GLib
+        from loopprofile import profiler
+        if self.textfile_path is not None:
+            self.write_textfile()
+            profiler.timeout_add_seconds(self.interval, self.write_textfile,
+                                         name='MetricsExporter.write_textfile')
+        if self.socket_path is not None:
+            try:
+                self._sock = self.open_socket()
+            except OSError as e:
+                print("unable to open metrics socket", self.socket_path, e)
+            else:
+                GLib.io_add_watch(self._sock.fileno(), GLib.IO_IN,
+                                  profiler.timed('MetricsExporter.accept_cb', self.accept_cb))
+        print("metrics exporter started")
+
+    def write_textfile(self):
+        ''' write to a temporary file first so scrapers never see a partial file '''
+        try:
+            os.makedirs(os.path.dirname(self.textfile_path), exist_ok=True)
+            tmp_path = self.textfile_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(self.metrics.render_prometheus())
+            os.replace(tmp_path, self.textfile_path)
+        except OSError as e:
+            print("unable to write metrics to", self.textfile_path, e)
+        # keep the GLib timer running
+        return True
+
+    def open_socket(self):
+        os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.socket_path)
+        sock.listen(4)
+        sock.setblocking(False)
+        return sock
+
+    def accept_cb(self, fd, condition):
+        try:
+            conn, _ = self._sock.accept()
+        except BlockingIOError:
+            return True
+        try:
+            conn.setblocking(False)
+            conn.send(self.metrics.render_prometheus().encode())
+        except OSError:
+            # reader went away or is too slow, it will get the next scrape
+            pass
+        finally:
+            conn.close()
+        return True
+
+    def stop(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -0,0 +1,249 @@
+#!/usr/bin/python3
+# Local fan-out of sensor frames and detector events.
+#
+# EventHub listens on a Unix socket inside the peripheral process. Every
+# DistanceMonitor gets a publisher (a MonitorListener) and every connected
+# client receives one JSON object per line:
+#
+#   {"type": "frame", "seq": 1, "sensor": "left", "time": ..., "distance": 120, "strength": 2400}
+#   {"type": "state", "seq": 2, "sensor": "left", "time": ..., "old": 0, "new": 1}
+#   {"type": "violation", "seq": 3, "sensor": "left", "begin_time": ..., "end_time": ...,
+#    "distance": 41, "num_readings": 30, "confidence": 0.93, "distance_stats": {"min": 35, ...}}
+#
+# seq counts every message of the hub that some client wanted, so a client
+# can tell when it missed some. A client only wanting some types writes "subscribe state violation\n".
+#
+# Nothing a client does can hold up the sensor loop: sockets are
+# non-blocking and unsent data is queued per client and sent as soon as
+# the socket is writable again. A client whose queue
+# grows past SKIP_BYTES doesn't get frames until it catches up, and one
+# past MAX_BYTES is disconnected.
+#
+# usage: python3 pubsub.py [TYPE ...]   prints the messages of a running peripheral
+import json
+import os
+import socket
+import sys
+
+import constants
+import metrics
+from distanceMonitor import MonitorListener
+
+MESSAGE_TYPES = ('frame', 'state', 'violation')
+# queued bytes after which a client misses frames, events are still queued
+SKIP_BYTES = 16*1024
+# queued bytes after which a client is disconnected
+MAX_BYTES = 256*1024
+
+
+class Subscriber:
+    ''' one connected client '''
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.types = set(MESSAGE_TYPES)
+        self.pending = bytearray()
+        self.received = b''
+        self.watch = None
+        # only while pending holds data the socket didn't take
+        self.write_watch = None
+
+
+class HubPublisher(MonitorListener):
+    ''' follows the DistanceMonitor of one sensor and publishes to the hub '''
+
+    def __init__(self, hub, sensor_name):
+        self.hub = hub
+        self.sensor_name = sensor_name
+
+    def frame(self, time_of_reading, distance, strength):
+        # frames are the bulk of the traffic, don't build them for nobody
+        if self.hub.wanted['frame']:
+            self.hub.publish({'type': 'frame', 'sensor': self.sensor_name, 'time': time_of_reading,
+                              'distance': distance, 'strength': strength})
+
+    def state_changed(self, old_state, new_state, time_of_reading):
+        self.hub.publish({'type': 'state', 'sensor': self.sensor_name, 'time': time_of_reading,
+                          'old': old_state, 'new': new_state})
+
+    def violation(self, event):
+        self.hub.publish({'type': 'violation', 'sensor': self.sensor_name,
+                          'begin_time': event.begin_time, 'end_time': event.end_time,
+                          'distance': event.distance, 'num_readings': event.num_readings,
+                          'confidence': event.confidence, 'distance_stats': event.stats()})
+
+
+class EventHub:
+    ''' serves frames and events to local clients from inside the GLib loop '''
+
+    def __init__(self, socket_path=constants.EVENTS_SOCKET_PATH):
+        self.socket_path = socket_path
+        self.subscribers = []
+        # how many subscribers want each message type
+        self.wanted = dict.fromkeys(MESSAGE_TYPES, 0)
+        self.seq = 0
+        self._sock = None
+
+    def publisher(self, sensor_name):
+        return HubPublisher(self, sensor_name)
+
+    def count_wanted(self):
+        ''' called whenever a subscriber comes, goes or subscribes '''
+        for message_type in MESSAGE_TYPES:
+            self.wanted[message_type] = sum(message_type in subscriber.types
+                                            for subscriber in self.subscribers)
+
+    def start(self):
+        from gi.repository import GLib
+        from loopprofile import profiler
+        try:
+            os.makedirs(os.path.dirname(self.socket_path), exist_ok=True)
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.bind(self.socket_path)
+            self._sock.listen(8)
+            self._sock.setblocking(False)
+        except OSError as e:
+            print("unable to open event socket", self.socket_path, e)
+            self._sock = None
+            return
+        GLib.io_add_watch(self._sock.fileno(), GLib.IO_IN,
+                          profiler.timed('EventHub.accept_cb', self.accept_cb))
+        print("event hub listening on", self.socket_path)
+
+    def accept_cb(self, fd, condition):
+        from gi.repository import GLib
+        try:
+            conn, _ = self._sock.accept()
+        except BlockingIOError:
+            return True
+        conn.setblocking(False)
+        subscriber = Subscriber(conn)
+        subscriber.watch = GLib.io_add_watch(
+            conn.fileno(), GLib.IO_IN | GLib.IO_HUP | GLib.IO_ERR,
+            self.client_cb, subscriber)
+        self.subscribers.append(subscriber)
+        self.count_wanted()
+        metrics.registry.set('smartlight_event_subscribers', len(self.subscribers))
+        return True
+
+    def client_cb(self, fd, condition, subscriber):
+        ''' a client wrote a subscribe line or hung up '''
+        try:
+            data = subscriber.conn.recv(1024)
+        except BlockingIOError:
+            return True
+        except OSError:
+            data = b''
+        if not data:
+            # returning False removes the watch
+            subscriber.watch = None
+            self.remove(subscriber)
+            return False
+        subscriber.received += data
+        while b'\n' in subscriber.received:
+            line, subscriber.received = subscriber.received.split(b'\n', 1)
+            words = line.decode(errors='replace').split()
+            if words[:1] == ['subscribe']:
+                subscriber.types = set(words[1:]) & set(MESSAGE_TYPES)
+                self.count_wanted()
+        # a client that never sends a newline doesn't get to fill our memory
+        subscriber.received = subscriber.received[-1024:]
+        return True
+
+    def publish(self, message):
+        if not self.wanted[message['type']]:
+            return
+        self.seq += 1
+        message['seq'] = self.seq
+        line = (json.dumps(message, separators=(',', ':')) + '\n').encode()
+        for subscriber in list(self.subscribers):
+            if message['type'] not in subscriber.types:
+                continue
+            if message['type'] == 'frame' and len(subscriber.pending) > SKIP_BYTES:
+                metrics.registry.inc('smartlight_event_frames_skipped_total')
+                continue
+            subscriber.pending += line
+            # with a write watch the socket is full, writable_cb sends it
+            if subscriber.write_watch is None:
+                self.flush(subscriber)
+            else:
+                self.drop_if_stalled(subscriber)
+
+    def flush(self, subscriber):
+        from gi.repository import GLib
+        try:
+            sent = subscriber.conn.send(subscriber.pending)
+        except BlockingIOError:
+            sent = 0
+        except OSError:
+            self.remove(subscriber)
+            return
+        del subscriber.pending[:sent]
+        if self.drop_if_stalled(subscriber):
+            return
+        if subscriber.pending and subscriber.write_watch is None:
+            subscriber.write_watch = GLib.io_add_watch(
+                subscriber.conn.fileno(), GLib.IO_OUT, self.writable_cb, subscriber)
+        elif not subscriber.pending and subscriber.write_watch is not None:
+            GLib.source_remove(subscriber.write_watch)
+            subscriber.write_watch = None
+
+    def drop_if_stalled(self, subscriber):
+        ''' removes a client whose queue grew past MAX_BYTES '''
+        if len(subscriber.pending) <= MAX_BYTES:
+            return False
+        print("event hub: dropping a client that stopped reading")
+        metrics.registry.inc('smartlight_event_subscribers_dropped_total')
+        self.remove(subscriber)
+        return True
+
+    def writable_cb(self, fd, condition, subscriber):
+        ''' the socket of a client with queued data takes more '''
+        # returning False removes this watch, flush adds a new one if
+        # the queue still isn't empty
+        subscriber.write_watch = None
+        self.flush(subscriber)
+        return False
+
+    def remove(self, subscriber):
+        from gi.repository import GLib
+        if subscriber not in self.subscribers:
+            return
+        self.subscribers.remove(subscriber)
+        self.count_wanted()
+        if subscriber.watch is not None:
+            GLib.source_remove(subscriber.watch)
+            subscriber.watch = None
+        if subscriber.write_watch is not None:
+            GLib.source_remove(subscriber.write_watch)
+            subscriber.write_watch = None
+        subscriber.conn.close()
+        metrics.registry.set('smartlight_event_subscribers', len(self.subscribers))
+
+    def stop(self):
+        for subscriber in list(self.subscribers):
+            self.remove(subscriber)
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+
+
+def main():
+    types = sys.argv[1:]
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(constants.EVENTS_SOCKET_PATH)
+    if types:
+        sock.sendall(('subscribe ' + ' '.join(types) + '\n').encode())
+    try:
+        for line in sock.makefile():
+            print(line, end='')
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
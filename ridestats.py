@@ -0,0 +1,132 @@
+#!/usr/bin/python3
+# Ride statistics kept on the device.
+#
+# RideStatistics follows one DistanceMonitor for the whole ride (from power
+# on) and keeps running totals in fixed size counters and histograms, so its
+# memory use doesn't grow with the length of the ride. The summary is packed
+# into a small binary record for the ride summary characteristic:
+#
+#   u8   format version (1)
+#   u32  ride length in seconds
+#   u32  sensor uptime in seconds (time the sensor delivered valid frames)
+#   u16  number of violations
+#   u16  closest pass in inches (0xFFFF if there was none)
+#   u16  x len(PASS_DISTANCE_BINS)  passes per bin of closest approach
+#   u16  x len(PASS_DURATION_BINS)  passes per duration bin
+#   u32  x len(DISTANCE_BANDS)      tenths of a second with an object in each band
+#
+# all little endian. Counters saturate instead of wrapping.
+import bisect
+import struct
+
+from distanceMonitor import MonitorListener
+
+FORMAT_VERSION = 1
+# upper edges in inches, the last bin takes everything above
+PASS_DISTANCE_BINS = [12, 24, 36, 48, 60, 73]
+# upper edges in seconds
+PASS_DURATION_BINS = [0.25, 0.5, 1.0, 2.0, 5.0]
+# (low, high) inches, time is counted while the sensor sees something in the band
+DISTANCE_BANDS = [(0, 36), (36, 48), (48, 60), (60, 73), (73, 120)]
+# the bands are contiguous, a frame's band is found by bisecting their edges
+BAND_LOW = DISTANCE_BANDS[0][0]
+BAND_EDGES = [high for _, high in DISTANCE_BANDS]
+# frames further apart than this are a gap in the data, not time in a band
+MAX_FRAME_GAP = 0.5
+
+NO_PASS = 0xFFFF
+
+LAYOUT = '<BIIHH%dH%dH%dI' % (len(PASS_DISTANCE_BINS) + 1, len(PASS_DURATION_BINS) + 1,
+                              len(DISTANCE_BANDS))
+
+
+class RideStatistics(MonitorListener):
+
+    def __init__(self):
+        self.start_time = None
+        self.last_time = None
+        self.ride_seconds = 0.0
+        self.uptime_seconds = 0.0
+        self.violations = 0
+        self.closest_pass = None
+        self.distance_histogram = [0]*(len(PASS_DISTANCE_BINS) + 1)
+        self.duration_histogram = [0]*(len(PASS_DURATION_BINS) + 1)
+        self.band_seconds = [0.0]*len(DISTANCE_BANDS)
+
+    def frame(self, time_of_reading, distance, strength):
+        if self.start_time is None:
+            self.start_time = time_of_reading
+        else:
+            dt = time_of_reading - self.last_time
+            if 0 < dt <= MAX_FRAME_GAP and distance >= 0:
+                self.uptime_seconds += dt
+                if distance >= BAND_LOW:
+                    band = bisect.bisect_right(BAND_EDGES, distance)
+                    if band < len(BAND_EDGES):
+                        self.band_seconds[band] += dt
+        self.last_time = time_of_reading
+        self.ride_seconds = time_of_reading - self.start_time
+
+    def violation(self, event):
+        self.violations += 1
+        # a pass counts by its closest approach
+        distance = event.min_distance
+        if self.closest_pass is None or distance < self.closest_pass:
+            self.closest_pass = distance
+        self.distance_histogram[bisect.bisect_left(PASS_DISTANCE_BINS, distance)] += 1
+        duration = event.end_time - event.begin_time
+        self.duration_histogram[bisect.bisect_left(PASS_DURATION_BINS, duration)] += 1
+
+    @classmethod
+    def merge(cls, stats):
+        ''' combines the statistics of several sensors into one ride summary.
+            band times add up (sensor-seconds), uptime is that of the
+            sensor with the least of it '''
+        merged = cls()
+        stats = list(stats)
+        if not stats:
+            return merged
+        merged.ride_seconds = max(s.ride_seconds for s in stats)
+        merged.uptime_seconds = min(s.uptime_seconds for s in stats)
+        merged.violations = sum(s.violations for s in stats)
+        closest = [s.closest_pass for s in stats if s.closest_pass is not None]
+        merged.closest_pass = min(closest) if closest else None
+        for s in stats:
+            for i, count in enumerate(s.distance_histogram):
+                merged.distance_histogram[i] += count
+            for i, count in enumerate(s.duration_histogram):
+                merged.duration_histogram[i] += count
+            for i, seconds in enumerate(s.band_seconds):
+                merged.band_seconds[i] += seconds
+        return merged
+
+    def pack(self):
+        u16 = lambda v: min(int(v), 0xFFFF)
+        u32 = lambda v: min(int(v), 0xFFFFFFFF)
+        values = [FORMAT_VERSION, u32(self.ride_seconds), u32(self.uptime_seconds),
+                  u16(self.violations),
+                  NO_PASS if self.closest_pass is None else u16(self.closest_pass)]
+        values += [u16(count) for count in self.distance_histogram]
+        values += [u16(count) for count in self.duration_histogram]
+        values += [u32(seconds*10) for seconds in self.band_seconds]
+        return struct.pack(LAYOUT, *values)
+
+    @classmethod
+    def unpack(cls, data):
+        ''' the inverse of pack, e.g. for a summary read from a unit.
+            raises ValueError if data isn't a summary of this format '''
+        try:
+            values = struct.unpack(LAYOUT, data)
+        except struct.error as e:
+            raise ValueError(f"not a ride summary: {e}")
+        if values[0] != FORMAT_VERSION:
+            raise ValueError(f"unknown ride summary version {values[0]}")
+        stats = cls()
+        stats.ride_seconds, stats.uptime_seconds, stats.violations, closest_pass = values[1:5]
+        stats.closest_pass = None if closest_pass == NO_PASS else closest_pass
+        i = 5
+        for histogram in (stats.distance_histogram, stats.duration_histogram):
+            histogram[:] = values[i:i + len(histogram)]
+            i += len(histogram)
+        stats.band_seconds = [tenths/10 for tenths in values[i:]]
+        return stats
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+# Violation history in per-minute, per-hour and per-day rollups.
+#
+# RollupStore follows every DistanceMonitor and adds each violation to one
+# bucket of every tier of an SQLite database: the number of violations, the
+# closest approach and a histogram of closest approaches (the bins of
+# ridestats.PASS_DISTANCE_BINS). Empty buckets are never stored. Writes
+# happen on a background thread so the sensor loop never waits for the SD
+# card. Minute buckets are kept for MINUTE_RETENTION, hour buckets for
+# HOUR_RETENTION and day buckets forever. Buckets are aligned to UTC.
+#
+# query(begin, end) answers from the coarsest tier whose buckets line up
+# with the range, so months of history are a few dozen day buckets. A range
+# that doesn't line up with any tier is widened to whole buckets of the
+# coarsest tier it spans, and a tier is only used while its retention still
+# covers the start of the range.
+#
+# usage: python3 rollups.py [--db PATH] [--days 7]   prints the stored history
+import argparse
+import bisect
+import os
+import queue
+import sqlite3
+import struct
+import threading
+import time
+
+import constants
+from distanceMonitor import MonitorListener
+from ridestats import PASS_DISTANCE_BINS
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+# coarsest first
+TIERS = (DAY, HOUR, MINUTE)
+MINUTE_RETENTION = 7*DAY
+HOUR_RETENTION = 366*DAY
+# seconds a tier keeps its buckets, None for forever
+RETENTION = {MINUTE: MINUTE_RETENTION, HOUR: HOUR_RETENTION, DAY: None}
+
+HISTOGRAM_COLUMNS = [f"h{i}" for i in range(len(PASS_DISTANCE_BINS) + 1)]
+
+SCHEMA = f'''
+CREATE TABLE IF NOT EXISTS rollups (
+    tier INTEGER NOT NULL,
+    bucket_start INTEGER NOT NULL,
+    violations INTEGER NOT NULL,
+    closest INTEGER NOT NULL,
+    {', '.join(f'{column} INTEGER NOT NULL' for column in HISTOGRAM_COLUMNS)},
+    PRIMARY KEY (tier, bucket_start)
+)'''
+
+UPSERT = f'''
+INSERT INTO rollups VALUES (?, ?, 1, ?, {', '.join('?' for _ in HISTOGRAM_COLUMNS)})
+ON CONFLICT (tier, bucket_start) DO UPDATE SET
+    violations = violations + 1,
+    closest = min(closest, excluded.closest),
+    {', '.join(f'{c} = {c} + excluded.{c}' for c in HISTOGRAM_COLUMNS)}'''
+
+
+def connect(path):
+    db = sqlite3.connect(path)
+    # readers don't wait for the writer thread and the other way round
+    db.execute('PRAGMA journal_mode=WAL')
+    db.execute(SCHEMA)
+    return db
+
+
+def retained(tier, begin, now):
+    ''' whether the bucket holding begin is still kept '''
+    retention = RETENTION[tier]
+    return retention is None or begin - begin % tier >= now - retention
+
+
+def choose_tier(begin, end, now=None):
+    ''' the coarsest retained tier whose buckets begin and end fall on,
+        else the coarsest retained tier the range spans a bucket of '''
+    if now is None:
+        now = time.time()
+    tiers = [tier for tier in TIERS if retained(tier, begin, now)]
+    for tier in tiers:
+        if end - begin >= tier and begin % tier == 0 and end % tier == 0:
+            return tier
+    for tier in tiers:
+        if end - begin >= tier:
+            return tier
+    return tiers[-1]
+
+
+class RollupStore(MonitorListener):
+
+    def __init__(self, path=constants.ROLLUP_DB_PATH):
+        self.path = path
+        self.queue = queue.Queue()
+        self.db = None
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.db = connect(path)
+        except (OSError, sqlite3.Error) as e:
+            print("unable to open rollup store", path, e)
+            return
+        threading.Thread(target=self.write, daemon=True).start()
+
+    def violation(self, event):
+        self.queue.put((event.begin_time, int(event.min_distance)))
+
+    def write(self):
+        ''' writer thread, with its own connection '''
+        db = connect(self.path)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            event_time, closest = item
+            histogram = [0]*len(HISTOGRAM_COLUMNS)
+            histogram[bisect.bisect_left(PASS_DISTANCE_BINS, closest)] = 1
+            try:
+                with db:
+                    for tier in TIERS:
+                        bucket_start = int(event_time) - int(event_time) % tier
+                        db.execute(UPSERT, (tier, bucket_start, closest, *histogram))
+                    now = time.time()
+                    for tier, retention in RETENTION.items():
+                        if retention is not None:
+                            db.execute('DELETE FROM rollups WHERE tier = ? AND bucket_start < ?',
+                                       (tier, now - retention))
+            except sqlite3.Error as e:
+                print("unable to store rollup", e)
+        db.close()
+
+    def query(self, begin, end, limit=None):
+        ''' returns (tier, rows) for the buckets overlapping [begin, end),
+            oldest first. a row is (bucket_start, violations, closest, histogram) '''
+        tier = choose_tier(begin, end)
+        begin -= begin % tier
+        if self.db is None:
+            return tier, []
+        sql = (f"SELECT bucket_start, violations, closest, {', '.join(HISTOGRAM_COLUMNS)} "
+               "FROM rollups WHERE tier = ? AND bucket_start >= ? AND bucket_start < ? "
+               "ORDER BY bucket_start")
+        params = [tier, begin, end]
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        rows = [(row[0], row[1], row[2], list(row[3:]))
+                for row in self.db.execute(sql, params)]
+        return tier, rows
+
+    def close(self):
+        self.queue.put(None)
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+# binary layout of the rollup query characteristic, all little endian:
+#   u8   format version (1)
+#   u32  tier of the buckets in seconds (60, 3600 or 86400)
+#   u32  start of the next bucket to ask for if the answer was cut short, else 0
+#   u8   number of buckets
+#   then per bucket:
+#   u32  bucket start, unix time
+#   u16  violations
+#   u16  closest approach in inches
+#   u16  x len(PASS_DISTANCE_BINS) + 1  violations per bin of closest approach
+QUERY_FORMAT_VERSION = 1
+QUERY_HEADER = '<BIIB'
+QUERY_BUCKET = '<IHH%dH' % len(HISTOGRAM_COLUMNS)
+# what fits in the 512 bytes of a GATT attribute
+MAX_QUERY_BUCKETS = (512 - struct.calcsize(QUERY_HEADER))//struct.calcsize(QUERY_BUCKET)
+
+
+def pack_query(store, begin, end):
+    tier, rows = store.query(begin, end, MAX_QUERY_BUCKETS + 1)
+    next_begin = 0
+    if len(rows) > MAX_QUERY_BUCKETS:
+        next_begin = rows[MAX_QUERY_BUCKETS][0]
+        rows = rows[:MAX_QUERY_BUCKETS]
+    data = struct.pack(QUERY_HEADER, QUERY_FORMAT_VERSION, tier, next_begin, len(rows))
+    for bucket_start, violations, closest, histogram in rows:
+        data += struct.pack(QUERY_BUCKET, bucket_start, min(violations, 0xFFFF),
+                            min(closest, 0xFFFF), *(min(count, 0xFFFF) for count in histogram))
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description='print the stored violation history')
+    parser.add_argument('--db', default=constants.ROLLUP_DB_PATH)
+    parser.add_argument('--days', type=int, default=7)
+    args = parser.parse_args()
+    store = RollupStore(args.db)
+    end = int(time.time()) // DAY * DAY + DAY
+    tier, rows = store.query(end - args.days*DAY, end)
+    edges = [f"<{edge}" for edge in PASS_DISTANCE_BINS] + [f">={PASS_DISTANCE_BINS[-1]}"]
+    print(f"{'bucket':<20}{'violations':>11}{'closest':>8}" + ''.join(f"{e:>6}" for e in edges))
+    for bucket_start, violations, closest, histogram in rows:
+        start = time.strftime('%Y-%m-%d %H:%M', time.localtime(bucket_start))
+        print(f"{start:<20}{violations:>11}{closest:>8}" + ''.join(f"{n:>6}" for n in histogram))
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
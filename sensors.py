@@ -0,0 +1,135 @@
+#!/usr/bin/python3
+# Any number of distance sensors read from one loop.
+#
+# Every sensor configured in DetectorConfig.sensors becomes a SensorChannel
+# with its own TFMini, DistanceMonitor and evidence recorder. SensorArray
+# polls all of them from a single GLib timer: a selector tells it which
+# serial ports have bytes waiting, only those channels are scanned, and the
+# others only get their stall watchdog run.
+import os
+import selectors
+
+import constants
+from loopprofile import profiler
+from tfminiplus import TFMini
+from distanceMonitor import DistanceMonitor
+from blackbox import EvidenceRecorder
+from ridestats import RideStatistics
+
+
+class SensorChannel:
+    ''' one sensor and the detector state that belongs to it '''
+
+    def __init__(self, name, sensor, config):
+        self.name = name
+        self.sensor = sensor
+        self.monitor = DistanceMonitor(sensor, config, name)
+        # keeps the raw waveform around every confirmed vehicle
+        self.evidence = EvidenceRecorder(config, os.path.join(constants.EVIDENCE_DIR, name))
+        self.monitor.add_listener(self.evidence)
+        # running totals for the ride summary
+        self.ride = RideStatistics()
+        self.monitor.add_listener(self.ride)
+        # called with the violation distance from the sensor loop
+        self.violation_handlers = []
+        # file descriptor currently registered with the selector
+        self.fd = None
+
+    def fileno(self):
+        ''' the serial port fd, or None while the port is closed.
+            sensors without one (e.g. a TraceSensor) are read every tick '''
+        fileno = getattr(self.sensor, 'fileno', None)
+        return fileno() if fileno is not None else None
+
+    def scan(self):
+        violation_distance = self.monitor.scan_for_violations()
+        # monitor returns -1 except the exact moment it records a violation.
+        if violation_distance > 0:
+            for handler in self.violation_handlers:
+                handler(violation_distance)
+
+    def apply_config(self, config):
+        self.monitor.apply_config(config)
+        self.evidence.apply_config(config)
+
+
+class SensorArray:
+    ''' builds a SensorChannel for every configured sensor and
+        reads them all from a single GLib timer '''
+
+    def __init__(self, config, sensor=None):
+        ''' sensor replaces the configured sensors with a single channel,
+            e.g. to replay a trace '''
+        self.config = config
+        self.selector = selectors.DefaultSelector()
+        self.channels = []
+        self.poll_interval = None
+        self.running = False
+        if sensor is not None:
+            self.channels.append(SensorChannel('left', sensor, config))
+        elif not config.sensors:
+            # the original single sensor, UART picked from the rpi model
+            self.channels.append(SensorChannel('left', TFMini(), config))
+        else:
+            for sensor_config in config.sensors:
+                self.channels.append(SensorChannel(
+                    sensor_config['name'], TFMini(sensor_config['port']), config))
+        print("sensors:", ', '.join(channel.name for channel in self.channels))
+
+    def start(self):
+        self.running = True
+        # every 10 ms by default
+        self.poll_interval = self.config.poll_interval_ms
+        profiler.timeout_add(self.poll_interval, self.poll_cb, name='SensorArray.poll_cb')
+
+    def stop(self):
+        self.running = False
+
+    def update_selector(self, channel):
+        ''' keep the selector in step with ports being closed and reopened '''
+        fd = channel.fileno()
+        if fd == channel.fd:
+            return
+        if channel.fd is not None:
+            self.selector.unregister(channel.fd)
+        if fd is not None:
+            self.selector.register(fd, selectors.EVENT_READ, channel)
+        channel.fd = fd
+
+    def poll_cb(self):
+        if not self.running:
+            return False
+        for channel in self.channels:
+            self.update_selector(channel)
+        ready = set()
+        if self.selector.get_map():
+            ready = {key.data for key, _ in self.selector.select(0)}
+        for channel in self.channels:
+            if channel in ready or channel.fd is None:
+                channel.scan()
+            else:
+                # nothing arrived, only check if the sensor stalled
+                channel.sensor.watchdog()
+        if self.poll_interval != self.config.poll_interval_ms:
+            # poll interval was reconfigured, replace this timer with a new one
+            self.start()
+            return False
+        return True
+
+    def ride_summary(self):
+        ''' statistics of every channel combined, see ridestats.RideStatistics.merge '''
+        return RideStatistics.merge(channel.ride for channel in self.channels)
+
+    def apply_config(self, config):
+        ''' called between two polls, see config.ConfigStore '''
+        if config.sensors != self.config.sensors:
+            print("sensor changes take effect after a restart")
+        self.config = config
+        for channel in self.channels:
+            channel.apply_config(config)
+
+    def shutdown(self):
+        self.stop()
+        for channel in self.channels:
+            channel.monitor.shutdown()
+        self.selector.close()
@@ -0,0 +1,251 @@
+#!/usr/bin/python3
+# Synthetic traffic scenarios for the DistanceMonitor.
+#
+# ScenarioGenerator produces the distance stream a sideways facing TFMini
+# would see while cars overtake the rider, including sensor noise, dropouts
+# (-1 readings) and the spurious far readings the rpi3 produces, and
+# optionally stationary objects like walls and parked cars. The stream
+# is replayed through a DistanceMonitor much faster than real time and the
+# reported violations are scored against the known vehicles.
+#
+# usage: python3 simulation.py [--duration 600] [--seed 1] [--stationary 60] [--save DIR]
+import argparse
+import contextlib
+import io
+import os
+import random
+import time
+
+from config import DetectorConfig
+from distanceMonitor import DistanceMonitor
+from traces import TraceSensor, save_trace, save_labels, labels_path
+
+MPH_TO_INCHES_PER_SEC = 17.6
+
+
+class Vehicle:
+    ''' a single overtaking vehicle.
+        lateral_distance is the gap to the sensor in inches '''
+
+    def __init__(self, arrival_time, lateral_distance, speed_mph, length_inches):
+        self.arrival_time = arrival_time
+        self.lateral_distance = lateral_distance
+        self.speed_mph = speed_mph
+        self.length_inches = length_inches
+
+    @property
+    def departure_time(self):
+        ''' the beam is a point, so the vehicle is seen for length/speed seconds '''
+        return self.arrival_time + self.length_inches/(self.speed_mph*MPH_TO_INCHES_PER_SEC)
+
+
+class ScenarioGenerator:
+    ''' builds a random but reproducible traffic scenario.
+        every range is a (low, high) tuple that values are drawn uniformly from '''
+
+    def __init__(self, seed=0, duration=600, sample_rate=100,
+                 lateral_distance=(20, 150), speed_mph=(15, 50),
+                 length_inches=(150, 240), mean_spacing=8.0,
+                 background_distance=400, noise_inches=2.0,
+                 dropout_rate=0.01, spurious_far_rate=0.03,
+                 strength=(300, 3000), stationary_spacing=None,
+                 stationary_duration=(3, 20), stationary_distance=(20, 70)):
+        ''' stationary_spacing is the mean number of seconds between
+            stationary objects, None for a scenario without any '''
+        self.random = random.Random(seed)
+        self.duration = duration
+        self.sample_rate = sample_rate
+        self.lateral_distance = lateral_distance
+        self.speed_mph = speed_mph
+        self.length_inches = length_inches
+        self.mean_spacing = mean_spacing
+        self.background_distance = background_distance
+        self.noise_inches = noise_inches
+        self.dropout_rate = dropout_rate
+        self.spurious_far_rate = spurious_far_rate
+        self.strength = strength
+        self.stationary_spacing = stationary_spacing
+        self.stationary_duration = stationary_duration
+        self.stationary_distance = stationary_distance
+        # (begin, end, distance) of every stationary object, set by generate()
+        self.stationary = []
+
+    def vehicles(self):
+        ''' vehicles arrive with exponentially distributed gaps.
+            they never overlap, a single beam can only see the nearest one '''
+        vehicles = []
+        t = self.random.expovariate(1/self.mean_spacing)
+        while t < self.duration:
+            vehicle = Vehicle(
+                t,
+                self.random.uniform(*self.lateral_distance),
+                self.random.uniform(*self.speed_mph),
+                self.random.uniform(*self.length_inches))
+            if vehicle.departure_time >= self.duration:
+                break
+            vehicles.append(vehicle)
+            t = vehicle.departure_time + self.random.expovariate(1/self.mean_spacing)
+        return vehicles
+
+    def stationary_objects(self):
+        ''' walls, parked cars and the like. they aren't violations, a
+            vehicle passing in front of one is seen if it is closer '''
+        objects = []
+        if not self.stationary_spacing:
+            return objects
+        t = self.random.expovariate(1/self.stationary_spacing)
+        while t < self.duration:
+            end = t + self.random.uniform(*self.stationary_duration)
+            objects.append((t, end, self.random.uniform(*self.stationary_distance)))
+            t = end + self.random.expovariate(1/self.stationary_spacing)
+        return objects
+
+    def generate(self, start_time=0.0):
+        ''' returns (times, distances, strengths, vehicles).
+            every time, of samples and vehicles alike, is offset by start_time '''
+        rnd = self.random
+        vehicles = self.vehicles()
+        self.stationary = self.stationary_objects()
+        num_samples = int(self.duration*self.sample_rate)
+        period = 1/self.sample_rate
+        times = []
+        distances = []
+        strengths = []
+        v = 0
+        s = 0
+        for i in range(num_samples):
+            t = i*period
+            while v < len(vehicles) and vehicles[v].departure_time < t:
+                v += 1
+            while s < len(self.stationary) and self.stationary[s][1] < t:
+                s += 1
+            if s < len(self.stationary) and self.stationary[s][0] <= t:
+                true_distance = self.stationary[s][2]
+            else:
+                true_distance = self.background_distance
+            if v < len(vehicles) and vehicles[v].arrival_time <= t:
+                true_distance = min(true_distance, vehicles[v].lateral_distance)
+
+            r = rnd.random()
+            if r < self.dropout_rate:
+                distance = -1
+                strength = -1
+            elif r < self.dropout_rate + self.spurious_far_rate:
+                # the sensor occasionally reports a far distance while an
+                # object is right in front of it, never the other way round
+                distance = rnd.randint(max(int(true_distance), 300), 470)
+                strength = rnd.randint(self.strength[0], self.strength[0]*2)
+            else:
+                distance = max(5, int(rnd.gauss(true_distance, self.noise_inches)))
+                # closer objects return more light
+                strength = int(self.strength[1] - (self.strength[1] - self.strength[0])
+                               * min(distance, 480)/480)
+            times.append(start_time + t)
+            distances.append(distance)
+            strengths.append(strength)
+        # the ground truth goes on the same clock as the samples
+        for vehicle in vehicles:
+            vehicle.arrival_time += start_time
+        self.stationary = [(begin + start_time, end + start_time, distance)
+                           for begin, end, distance in self.stationary]
+        return times, distances, strengths, vehicles
+
+
+def run_detector(times, distances, strengths, config=None):
+    ''' replays a stream through a DistanceMonitor.
+        returns the reported ViolationEvents and the seconds it took '''
+    monitor = DistanceMonitor(TraceSensor(times, distances, strengths), config)
+    events = []
+    start = time.perf_counter()
+    # the monitor prints on every state change, keep that out of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        while not monitor.sensor.exhausted():
+            if monitor.scan_for_violations() > 0:
+                events.append(monitor.last_event)
+    return events, time.perf_counter() - start
+
+
+def score(events, labels, threshold, tolerance=0.5):
+    ''' matches reported events to labelled vehicle passes (begin, end, distance).
+        an event matches a labelled violation if their time spans overlap,
+        allowing `tolerance` seconds of slack. each label matches at most once.
+        returns a dict of precision, recall and begin/end timing errors '''
+    violations = [label for label in labels if label[2] < threshold]
+    matched = set()
+    begin_errors = []
+    end_errors = []
+    true_positives = 0
+    for event in events:
+        for i, (begin, end, _) in enumerate(violations):
+            if i in matched:
+                continue
+            if event.begin_time <= end + tolerance and event.end_time >= begin - tolerance:
+                matched.add(i)
+                true_positives += 1
+                begin_errors.append(event.begin_time - begin)
+                end_errors.append(event.end_time - end)
+                break
+    return {
+        'events': len(events),
+        'violations': len(violations),
+        'true_positives': true_positives,
+        'precision': true_positives/len(events) if events else 1.0,
+        'recall': true_positives/len(violations) if violations else 1.0,
+        'mean_begin_error': sum(begin_errors)/len(begin_errors) if begin_errors else 0.0,
+        'mean_end_error': sum(end_errors)/len(end_errors) if end_errors else 0.0,
+        'max_abs_begin_error': max(map(abs, begin_errors), default=0.0),
+    }
+
+
+def print_report(result, num_samples, elapsed, duration):
+    print(f"vehicles in violation:  {result['violations']}")
+    print(f"events reported:        {result['events']}")
+    print(f"precision:              {result['precision']:.3f}")
+    print(f"recall:                 {result['recall']:.3f}")
+    print(f"mean begin error:       {result['mean_begin_error']*1000:+.0f} ms")
+    print(f"mean end error:         {result['mean_end_error']*1000:+.0f} ms")
+    print(f"max begin error:        {result['max_abs_begin_error']*1000:.0f} ms")
+    print(f"samples processed:      {num_samples}")
+    print(f"samples/s:              {num_samples/elapsed:,.0f}")
+    print(f"faster than real time:  {duration/elapsed:,.0f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='score the DistanceMonitor on a synthetic traffic scenario')
+    parser.add_argument('--duration', type=float, default=600, help='scenario length in seconds')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spacing', type=float, default=8.0, help='mean seconds between vehicles')
+    parser.add_argument('--noise', type=float, default=2.0, help='sensor noise in inches')
+    parser.add_argument('--dropouts', type=float, default=0.01, help='share of -1 readings')
+    parser.add_argument('--spurious', type=float, default=0.03, help='share of spurious far readings')
+    parser.add_argument('--stationary', type=float, help='mean seconds between stationary objects')
+    parser.add_argument('--config', help='detector configuration TOML file')
+    parser.add_argument('--save', metavar='DIR', help='also save the trace and its labels to DIR')
+    args = parser.parse_args()
+
+    config = DetectorConfig()
+    if args.config:
+        from config import load_config
+        config = load_config(args.config)
+
+    generator = ScenarioGenerator(
+        seed=args.seed, duration=args.duration, mean_spacing=args.spacing,
+        noise_inches=args.noise, dropout_rate=args.dropouts,
+        spurious_far_rate=args.spurious, stationary_spacing=args.stationary)
+    times, distances, strengths, vehicles = generator.generate()
+    labels = [(v.arrival_time, v.departure_time, int(v.lateral_distance)) for v in vehicles]
+
+    if args.save:
+        os.makedirs(args.save, exist_ok=True)
+        trace_path = os.path.join(args.save, f"scenario_{args.seed}.csv")
+        save_trace(trace_path, times, distances, strengths)
+        save_labels(labels_path(trace_path), labels)
+        print("saved", trace_path)
+
+    events, elapsed = run_detector(times, distances, strengths, config)
+    result = score(events, labels, config.violation_threshold)
+    print_report(result, len(distances), elapsed, args.duration)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,20 +1,89 @@
+import gc
+
 import dbus
+import dbus.bus
 
 from advertisement import Advertisement
 import smartlightGATT
 import bletools
+import metrics
+import constants
+from config import ConfigStore
+from pubsub import EventHub
+from broadcast import Broadcaster, BATTERY_INTERVAL
+from loopprofile import profiler
 
 class SmartLightPeripheral:
-      def __init__(self):
+      def __init__(self, config_path=constants.CONFIG_PATH, bus_address=None, sensor=None):
+            ''' bus_address selects a bus other than the system bus,
+                e.g. the private bus of fakebluez.py. sensor replaces the
+                TFMini, e.g. to replay a recorded trace '''
+            self.config_store = ConfigStore(config_path)
+            # only with SMARTLIGHT_PROFILE=1, see loopprofile.py.
+            # has to happen before any D-Bus object is created
+            profiler.instrument_dbus()
             self.eventLoop = bletools.eventLoop() # do this before accessing the system bus
-            self.bus = dbus.SystemBus()
-            self.advertisement = Advertisement(self.bus, 0,'peripheral','Consense Smart-Light')
-            self.advertisement.register()
-            self.app = smartlightGATT.SmartLightApplication(self.bus)
-            self.app.register()
+            if bus_address is None:
+                self.bus = dbus.SystemBus()
+            else:
+                self.bus = dbus.bus.BusConnection(bus_address)
+            # ask BlueZ for the adapter first and build everything else while it answers.
+            # the TFMini created by the application opens its port on its own thread
+            bletools.find_adapter_path_async(self.bus, self.adapter_found_cb, self.adapter_error_cb)
+            mode = self.config_store.config.advertising_mode
+            if mode == 'peripheral':
+                self.advertisement = Advertisement(self.bus, 0,'peripheral','Consense Smart-Light')
+            else:
+                # broadcast advertisements can't be connected to
+                ad_type = 'broadcast' if mode == 'broadcast' else 'peripheral'
+                self.advertisement = Advertisement(self.bus, 0, ad_type, constants.BROADCAST_NAME)
+            self.app = smartlightGATT.SmartLightApplication(self.bus, self.config_store, sensor)
+            self.broadcaster = None
+            if mode != 'peripheral':
+                self.broadcaster = Broadcaster(self.advertisement)
+                for index, channel in enumerate(self.app.sensors.channels):
+                    channel.monitor.add_listener(self.broadcaster.listener(index))
+                profiler.timeout_add_seconds(BATTERY_INTERVAL, self.broadcaster.refresh_battery,
+                                             name='Broadcaster.refresh_battery')
+            # pick up edits to the configuration file without a restart
+            profiler.timeout_add_seconds(2, self.config_store.reload_if_changed,
+                                         name='ConfigStore.reload_if_changed')
+            if profiler.enabled:
+                metrics.registry.add_collector(profiler.render_prometheus)
+            self.metrics_exporter = metrics.MetricsExporter()
+            self.metrics_exporter.start()
+            # frames and events for other local processes
+            self.event_hub = EventHub()
+            for channel in self.app.sensors.channels:
+                channel.monitor.add_listener(self.event_hub.publisher(channel.name))
+            self.event_hub.start()
+
+      def adapter_found_cb(self, adapter_path):
+            metrics.startup.mark('adapter_found')
+            if adapter_path is None:
+                print("no bluetooth adapter with advertising support found")
+                self.app.quit()
+                return
+            print("found adapter at",adapter_path)
+            # both registrations are asynchronous, BlueZ handles them concurrently
+            self.advertisement.register(adapter_path)
+            self.app.register(adapter_path)
+
+      def adapter_error_cb(self, error):
+            print("unable to find bluetooth adapter:", error)
+            self.app.quit()
 
       def publish(self):
+            # everything built during startup lives until exit. moving it out
+            # of the collector's reach keeps gen 2 collections from walking
+            # it in the middle of a sensor poll
+            gc.collect()
+            gc.freeze()
+            print(f"{gc.get_freeze_count()} startup objects frozen")
             try:
                 self.app.run()
             except KeyboardInterrupt:
+                self.metrics_exporter.stop()
+                self.event_hub.stop()
                 self.app.quit()
+                profiler.report()
@@ -1,10 +1,18 @@
+import struct
+
 import dbus
 from gi.repository import GLib
+
 import GATT
 import constants
 import bletools
+import exceptions
+import metrics
 from advertisement import Advertisement
-from distanceMonitor import DistanceMonitor
+from sensors import SensorArray
+from alerts import AlertController
+from rollups import RollupStore, pack_query
+from loopprofile import profiler
 
 class DistanceDescriptor(GATT.Descriptor):
     ''' Descriptor to tell clients The distance
@@ -23,43 +31,110 @@ class DistanceDescriptor(GATT.Descriptor):
     def ReadValue(self):
         return self.value
 
+class SensorNameDescriptor(GATT.Descriptor):
+    ''' Characteristic User Description, tells clients which
+        sensor a distance characteristic belongs to '''
+
+    def __init__(self, bus, index, characteristic):
+        GATT.Descriptor.__init__(
+            self, bus, index,
+            constants.CHR_USER_DESC_UUID,
+            [dbus.Byte(b) for b in characteristic.channel.name.encode()],
+            ['read'],
+            characteristic
+        )
+
+    def ReadValue(self, options):
+        return self.value
+
+# every value a distance notification can carry
+NOTIFY_BYTES = [dbus.Byte(b) for b in range(256)]
+
+# a long write arrives as several chunks and nothing marks the last one,
+# it is complete once no further chunk arrived for this long
+WRITE_SETTLE_MS = 200
+
+
+class LongWrite:
+    ''' collects the chunks of writes to a characteristic by their offset
+        and calls apply with the whole value once the write is complete.
+        a chunk at offset 0 starts a new value '''
+
+    def __init__(self, name, apply):
+        self.name = name
+        self.apply = apply
+        self.data = bytearray()
+        self.timer = None
+
+    def add(self, value, options):
+        offset = int(options.get('offset', 0))
+        if offset == 0:
+            self.data.clear()
+        elif offset != len(self.data):
+            expected = len(self.data)
+            self.data.clear()
+            raise exceptions.InvalidOffsetException(f"expected offset {expected}, got {offset}")
+        self.data += bytes(value)
+        if self.timer is not None:
+            GLib.source_remove(self.timer)
+        self.timer = profiler.timeout_add(WRITE_SETTLE_MS, self.complete, name=self.name)
+
+    def complete(self):
+        self.timer = None
+        data = bytes(self.data)
+        self.data.clear()
+        self.apply(data)
+        return False
+
+
+
 class DistanceCharacteristic(GATT.Characteristic):
     ''' Notify only Characteristic
         sends a PropertiesChanged Signal whenever a
         car has been detected to come within 6.5 feet
-        of the smart-light '''
+        of the sensor it belongs to. There is one per sensor '''
 
-    def __init__(self, bus, index, service):
-        print("Initialising DistanceCharacteristic object at",constants.DISTANCE_CHRC_UUID)
+    def __init__(self, bus, index, service, channel):
+        print("Initialising DistanceCharacteristic object at",constants.DISTANCE_CHRC_UUID,"for sensor",channel.name)
+        self.channel = channel
         GATT.Characteristic.__init__(
             self, bus, index,
             constants.DISTANCE_CHRC_UUID,
             ['notify'], service)
         self.notifying = False
-        self.monitor = DistanceMonitor()
+        self.monitor = channel.monitor
+        # the signal arguments are built once and only the byte is swapped
+        self.value = [dbus.Byte(0)]
+        self.changed = {'Value': self.value}
+        self.invalidated = []
+        channel.violation_handlers.append(self.notify_violation)
         self.add_descriptor(DistanceDescriptor)
+        self.add_descriptor(SensorNameDescriptor)
 
-
-    def distance_violation_cb(self):
-        violation_distance = self.monitor.scan_for_violations()
-        # monitor returns -1 except the exact moment it records a violation.
-        if violation_distance > 0:
-            print("Sending notification!")
-            print("distance =",violation_distance)
-            self.PropertiesChanged(
-                constants.GATT_CHARACTERISTIC_INTERFACE,
-                {'Value': [dbus.Byte(violation_distance)]}, [])
-            print("    DONE!")
-            # have to reset the value here or else we can't
-            # both access it here and reset it in DistanceMonitor
-            self.monitor.violation_distance = -1
-        return self.notifying
-
-    def monitor_distance(self):
+    def notify_violation(self, violation_distance):
+        ''' called from the sensor loop whenever the channel reports a violation '''
         if not self.notifying:
+            print("no client listening, violation not sent")
+            metrics.registry.inc('smartlight_notifications_dropped_total')
+            return
+        # dbus.Byte only holds 0-255 inches, anything else is lost
+        if not 0 <= violation_distance < 256:
+            print("distance out of range, violation not sent:", violation_distance)
+            metrics.registry.inc('smartlight_notifications_dropped_total')
             return
-        # turn on DistanceMonitor scanning
-        GLib.timeout_add(10,self.distance_violation_cb) #10 ms
+        print("Sending notification!")
+        print("distance =",violation_distance)
+        try:
+            self.value[0] = NOTIFY_BYTES[violation_distance]
+            self.PropertiesChanged(
+                constants.GATT_CHARACTERISTIC_INTERFACE,
+                self.changed, self.invalidated)
+        except dbus.exceptions.DBusException as e:
+            print("unable to send notification:", e)
+            metrics.registry.inc('smartlight_notifications_dropped_total')
+        else:
+            metrics.registry.inc('smartlight_notifications_sent_total')
+        print("    DONE!")
 
     def StartNotify(self):
         if self.notifying:
@@ -67,7 +142,6 @@ class DistanceCharacteristic(GATT.Characteristic):
             return
         print("notifications activated!")
         self.notifying = True
-        self.monitor_distance()
 
     def StopNotify(self):
         if not self.notifying:
@@ -78,15 +152,188 @@ class DistanceCharacteristic(GATT.Characteristic):
         self.notifying = False
 
 
-class DistanceService(GATT.Service):
+class ConfigCharacteristic(GATT.Characteristic):
+    ''' Read/Write Characteristic
+        reading returns the detector configuration as UTF-8 TOML text,
+        writing TOML text (e.g. "violation_threshold = 70") updates only
+        the keys it contains. A long write is applied once all of it
+        has arrived, see LongWrite, so read the configuration back to
+        see whether it was accepted. Invalid values are rejected and the
+        running configuration stays untouched '''
+
+    def __init__(self, bus, index, service, config_store):
+        print("Initialising ConfigCharacteristic object at",constants.CONFIG_CHRC_UUID)
+        GATT.Characteristic.__init__(
+            self, bus, index,
+            constants.CONFIG_CHRC_UUID,
+            ['read', 'write'], service)
+        self.config_store = config_store
+        self.write = LongWrite('ConfigCharacteristic.apply', self.apply)
+
+    def ReadValue(self, options):
+        text = self.config_store.config.to_toml()
+        offset = int(options.get('offset', 0))
+        return [dbus.Byte(b) for b in text.encode()[offset:]]
+
+    def WriteValue(self, value, options):
+        self.write.add(value, options)
+
+    def apply(self, data):
+        try:
+            self.config_store.update_from_text(data.decode())
+        except (UnicodeDecodeError, ValueError, OSError) as e:
+            print("rejected configuration update:", e)
+
+
+class RideSummaryCharacteristic(GATT.Characteristic):
+    ''' Read only Characteristic
+        returns the statistics of the ride so far, from all sensors,
+        in the binary layout described in ridestats.py '''
+
+    def __init__(self, bus, index, service, sensors):
+        print("Initialising RideSummaryCharacteristic object at",constants.RIDE_SUMMARY_CHRC_UUID)
+        GATT.Characteristic.__init__(
+            self, bus, index,
+            constants.RIDE_SUMMARY_CHRC_UUID,
+            ['read'], service)
+        self.sensors = sensors
+
+    def ReadValue(self, options):
+        summary = self.sensors.ride_summary().pack()
+        offset = int(options.get('offset', 0))
+        return [dbus.Byte(b) for b in summary[offset:]]
+
+
+class RollupQueryCharacteristic(GATT.Characteristic):
+    ''' Read/Write Characteristic
+        write a time range as two little endian uint32 unix times,
+        begin and end, then read the violation history of that range in
+        the layout described in rollups.py. an answer with a non-zero
+        next bucket was cut short, ask again from there '''
+
+    def __init__(self, bus, index, service, rollups):
+        print("Initialising RollupQueryCharacteristic object at",constants.ROLLUP_QUERY_CHRC_UUID)
+        GATT.Characteristic.__init__(
+            self, bus, index,
+            constants.ROLLUP_QUERY_CHRC_UUID,
+            ['read', 'write'], service)
+        self.rollups = rollups
+        self.answer = b''
+
+    def ReadValue(self, options):
+        offset = int(options.get('offset', 0))
+        return [dbus.Byte(b) for b in self.answer[offset:]]
+
+    def WriteValue(self, value, options):
+        if len(value) != 8:
+            raise exceptions.FailedException("expected begin and end as two uint32")
+        begin, end = struct.unpack('<II', bytes(value))
+        if end <= begin:
+            raise exceptions.FailedException("end must be after begin")
+        self.answer = pack_query(self.rollups, begin, end)
+
+
+class DiagnosticsCharacteristic(GATT.Characteristic):
+    ''' Read only Characteristic
+        returns every runtime counter of metrics.COUNTERS
+        as a little endian uint32, in that order '''
+
+    def __init__(self, bus, index, service):
+        print("Initialising DiagnosticsCharacteristic object at",constants.DIAGNOSTICS_CHRC_UUID)
+        GATT.Characteristic.__init__(
+            self, bus, index,
+            constants.DIAGNOSTICS_CHRC_UUID,
+            ['read'], service)
+
+    def ReadValue(self, options):
+        counters = metrics.registry.pack_counters()
+        offset = int(options.get('offset', 0))
+        return [dbus.Byte(b) for b in counters[offset:]]
+
+
+class DiagnosticsService(GATT.Service):
     def __init__(self, bus, index):
+        print("Initialising DiagnosticsService object at",constants.DIAGNOSTICS_SVC_UUID)
+        self.local_name = "DiagnosticsService"
+        GATT.Service.__init__(
+            self, bus, index,
+            constants.DIAGNOSTICS_SVC_UUID, primary = True)
+        print("Adding Diagnostics Characteristic")
+        self.add_characteristic(DiagnosticsCharacteristic)
+
+
+class LEDTextCharacteristic(GATT.Characteristic):
+    ''' Read/Write Characteristic
+        the alert patterns as UTF-8 text, one line per pattern:
+        "detected 100,400" and "violation 50,50" (on/off times in ms).
+        writing such a line replaces that pattern, "detected" on its
+        own turns the alert for that state off. A long write is applied
+        once all of it has arrived, see LongWrite '''
+
+    PATTERNS = {'detected': 'alert_detected_pattern', 'violation': 'alert_violation_pattern'}
+
+    def __init__(self, bus, index, service, config_store):
+        print("Initialising LEDTextCharacteristic object at",constants.LED_TEXT_CHR_UUID)
+        GATT.Characteristic.__init__(
+            self, bus, index,
+            constants.LED_TEXT_CHR_UUID,
+            ['read', 'write'], service)
+        self.config_store = config_store
+        self.write = LongWrite('LEDTextCharacteristic.apply', self.apply)
+
+    def ReadValue(self, options):
+        config = self.config_store.config
+        text = '\n'.join(f"{name} {','.join(map(str, getattr(config, key)))}"
+                         for name, key in self.PATTERNS.items())
+        offset = int(options.get('offset', 0))
+        return [dbus.Byte(b) for b in text.encode()[offset:]]
+
+    def WriteValue(self, value, options):
+        self.write.add(value, options)
+
+    def apply(self, data):
+        try:
+            changes = {}
+            for line in data.decode().splitlines():
+                words = line.split()
+                if not words:
+                    continue
+                if words[0] not in self.PATTERNS or len(words) > 2:
+                    raise ValueError(f"expected 'detected|violation ON,OFF,...', got {line!r}")
+                times = words[1].split(',') if len(words) == 2 else []
+                changes[self.PATTERNS[words[0]]] = [int(ms) for ms in times]
+            self.config_store.update(self.config_store.config.replace(**changes))
+        except (UnicodeDecodeError, ValueError, OSError) as e:
+            print("rejected alert pattern:", e)
+
+
+class LEDService(GATT.Service):
+    def __init__(self, bus, index, config_store):
+        print("Initialising LEDService object at",constants.LED_SVC_UUID)
+        self.local_name = "LEDService"
+        GATT.Service.__init__(
+            self, bus, index,
+            constants.LED_SVC_UUID, primary = True)
+        print("Adding LED Text Characteristic")
+        self.add_characteristic(LEDTextCharacteristic, config_store)
+
+
+class DistanceService(GATT.Service):
+    def __init__(self, bus, index, config_store, sensors, rollups):
         print("Initialising DistanceService object at",constants.DISTANCE_SVC_UUID)
         self.local_name = "DistanceService"
         GATT.Service.__init__(
             self, bus, index,
             constants.DISTANCE_SVC_UUID, primary = True)
-        print("Adding Distance Characteristic")
-        self.add_characteristic(DistanceCharacteristic)
+        for channel in sensors.channels:
+            print("Adding Distance Characteristic for sensor",channel.name)
+            self.add_characteristic(DistanceCharacteristic, channel)
+        print("Adding Config Characteristic")
+        self.add_characteristic(ConfigCharacteristic, config_store)
+        print("Adding Ride Summary Characteristic")
+        self.add_characteristic(RideSummaryCharacteristic, sensors)
+        print("Adding Rollup Query Characteristic")
+        self.add_characteristic(RollupQueryCharacteristic, rollups)
         # add more characteristics here
         # TODO: add BatteryCharacteristic to monitor smartLight battery
         #       will need to look at PiSugar documentation for this
@@ -96,17 +343,33 @@ class DistanceService(GATT.Service):
 
 
 class SmartLightApplication(GATT.Application):
-    def __init__(self, bus):
+    def __init__(self, bus, config_store, sensor=None):
+        ''' sensor replaces the configured sensors, see sensors.SensorArray '''
         print("Initialising SmartLightApplication object")
         GATT.Application.__init__(self, bus)
+        self.sensors = SensorArray(config_store.config, sensor)
+        # the new config is picked up between two sensor polls
+        config_store.add_listener(self.sensors.apply_config)
+        # rear light or buzzer while a vehicle passes
+        self.alerts = AlertController(config_store.config)
+        config_store.add_listener(self.alerts.apply_config)
+        for channel in self.sensors.channels:
+            channel.monitor.add_listener(self.alerts.listener(channel.name))
+        # violation history for the app
+        self.rollups = RollupStore()
+        for channel in self.sensors.channels:
+            channel.monitor.add_listener(self.rollups)
         print("Adding Distance Service")
-        self.add_service(DistanceService)
+        self.add_service(DistanceService, config_store, self.sensors, self.rollups)
+        print("Adding Diagnostics Service")
+        self.add_service(DiagnosticsService)
+        print("Adding LED Service")
+        self.add_service(LEDService, config_store)
         # Add more services here
+        self.sensors.start()
 
     def quit(self):
-        for serv in self.services:
-            if hasattr(serv,'local_name') and serv.local_name=='DistanceService':
-                for chr in serv.characteristics:
-                    if hasattr(chr,'monitor'):
-                        chr.monitor.shutdown()
+        self.sensors.shutdown()
+        self.alerts.close()
+        self.rollups.close()
         super().quit()
@@ -0,0 +1,156 @@
+#!/usr/bin/python3
+# Streaming statistics in constant memory.
+#
+# RunningStats keeps count, minimum, maximum, mean and variance with
+# Welford's algorithm. P2Quantile estimates a single quantile with the P²
+# algorithm (Jain & Chlamtac, 1985), which tracks five markers instead of
+# keeping the samples. Both are reset in place so one instance can be
+# reused for every event. They are updated on every frame, so they have
+# __slots__ and allocate nothing beyond the floats of the arithmetic.
+
+
+class RunningStats:
+
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.mean = 0.0
+        # sum of squared differences from the mean
+        self.m2 = 0.0
+        self.min = None
+        self.max = None
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta/self.count
+        self.m2 += delta*(x - self.mean)
+        if self.min is None or x < self.min:
+            self.min = x
+        if self.max is None or x > self.max:
+            self.max = x
+
+    @property
+    def variance(self):
+        ''' sample variance, 0 for fewer than two samples '''
+        return self.m2/(self.count - 1) if self.count > 1 else 0.0
+
+
+class P2Quantile:
+    ''' running estimate of the p quantile, 0 < p < 1 '''
+
+    __slots__ = ('p', 'count', 'heights', 'positions', 'desired', 'increments')
+
+    def __init__(self, p):
+        self.p = p
+        # marker heights, actual and desired positions (1 based) and
+        # how far the desired positions move with every sample
+        self.heights = [0.0]*5
+        self.positions = [0]*5
+        self.desired = [0.0]*5
+        self.increments = (0.0, p/2, p, (1 + p)/2, 1.0)
+        self.reset()
+
+    def reset(self):
+        p = self.p
+        self.count = 0
+        for i in range(5):
+            self.positions[i] = i + 1
+        self.desired[0] = 1.0
+        self.desired[1] = 1 + 2*p
+        self.desired[2] = 1 + 4*p
+        self.desired[3] = 3 + 2*p
+        self.desired[4] = 5.0
+
+    def add(self, x):
+        q = self.heights
+        n = self.positions
+        if self.count < 5:
+            q[self.count] = x
+            self.count += 1
+            if self.count == 5:
+                q.sort()
+            return
+        self.count += 1
+
+        # find the cell x falls in, stretching the extremes if needed
+        if x < q[0]:
+            q[0] = x
+            k = 0
+        elif x >= q[4]:
+            q[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= q[k + 1]:
+                k += 1
+        for i in range(k + 1, 5):
+            n[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+
+        # move the middle markers towards their desired positions
+        for i in (1, 2, 3):
+            d = self.desired[i] - n[i]
+            if (d >= 1 and n[i + 1] - n[i] > 1) or (d <= -1 and n[i - 1] - n[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self.parabolic(i, d)
+                if not q[i - 1] < height < q[i + 1]:
+                    height = q[i] + d*(q[i + d] - q[i])/(n[i + d] - n[i])
+                q[i] = height
+                n[i] += d
+
+    def parabolic(self, i, d):
+        q = self.heights
+        n = self.positions
+        return q[i] + d/(n[i + 1] - n[i - 1])*(
+            (n[i] - n[i - 1] + d)*(q[i + 1] - q[i])/(n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d)*(q[i] - q[i - 1])/(n[i] - n[i - 1]))
+
+    def value(self):
+        ''' the estimate, exact while there are five samples or fewer '''
+        if self.count == 0:
+            return None
+        if self.count < 5:
+            samples = sorted(self.heights[:self.count])
+            return samples[round(self.p*(self.count - 1))]
+        if self.count == 5:
+            return self.heights[round(self.p*4)]
+        return self.heights[2]
+
+
+class DistanceStats:
+    ''' everything an event reports about its distances '''
+
+    __slots__ = ('stats', 'median', 'p10')
+
+    def __init__(self):
+        self.stats = RunningStats()
+        self.median = P2Quantile(0.5)
+        self.p10 = P2Quantile(0.1)
+
+    def reset(self):
+        self.stats.reset()
+        self.median.reset()
+        self.p10.reset()
+
+    def add(self, distance):
+        self.stats.add(distance)
+        self.median.add(distance)
+        self.p10.add(distance)
+
+    def summary(self):
+        ''' a dict of the current values, to keep once the event is over '''
+        stats = self.stats
+        return {
+            'min': stats.min,
+            'max': stats.max,
+            'mean': stats.mean,
+            'variance': stats.variance,
+            'median': self.median.value(),
+            'p10': self.p10.value(),
+        }
@@ -0,0 +1,164 @@
+#!/usr/bin/python3
+# Parameter sweep of the DistanceMonitor over recorded traces.
+#
+# usage: python3 sweep.py TRACE_DIR [--threshold 65 73 80] [--debounce 3 5]
+#                         [--confirm 16 24] [--filter none median kalman]
+#                         [--legal-threshold 73]
+#
+# Every trace in TRACE_DIR needs a <trace>.labels.csv ground truth file next
+# to it (simulation.py --save writes both). Every combination of parameters
+# is evaluated on every trace in a multiprocessing.Pool using all cores.
+# Every combination is scored against the same ground truth: labelled passes
+# closer than --legal-threshold are the violations, whatever threshold the
+# detector itself is run with. The traces are loaded once into a single shared memory block which all
+# workers read in place, so adding workers doesn't add copies of the data.
+import argparse
+import functools
+import glob
+import itertools
+import os
+from array import array
+from multiprocessing import Pool, shared_memory
+
+from config import DetectorConfig
+from simulation import run_detector, score
+from traces import load_trace, load_labels, labels_path
+
+# typecodes of the three columns of a trace in shared memory
+TIME_TYPE = 'd'
+DISTANCE_TYPE = 'i'
+STRENGTH_TYPE = 'i'
+
+# set in every worker by init_worker
+_shm = None
+_traces = None
+
+
+def pack_traces(paths):
+    ''' copies every trace into one shared memory block.
+        returns the block and, per trace, (labels, length, offsets) where
+        offsets are the byte offsets of its time, distance and strength columns '''
+    columns = []
+    index = []
+    offset = 0
+    for path in paths:
+        times, distances, strengths = load_trace(path)
+        trace_columns = (array(TIME_TYPE, times), array(DISTANCE_TYPE, distances),
+                         array(STRENGTH_TYPE, strengths))
+        offsets = []
+        for column in trace_columns:
+            offsets.append(offset)
+            offset += len(column)*column.itemsize
+        columns.append(trace_columns)
+        index.append((load_labels(labels_path(path)), len(times), offsets))
+
+    shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for trace_columns, (_, _, offsets) in zip(columns, index):
+        for column, start in zip(trace_columns, offsets):
+            data = column.tobytes()
+            shm.buf[start:start + len(data)] = data
+    return shm, index
+
+
+def init_worker(shm_name, index):
+    ''' attach to the shared traces and build zero-copy views on them '''
+    global _shm, _traces
+    _shm = shared_memory.SharedMemory(name=shm_name)
+    _traces = []
+    for labels, length, offsets in index:
+        views = []
+        for start, typecode in zip(offsets, (TIME_TYPE, DISTANCE_TYPE, STRENGTH_TYPE)):
+            itemsize = array(typecode).itemsize
+            views.append(_shm.buf[start:start + length*itemsize].cast(typecode))
+        _traces.append((labels, views))
+
+
+def evaluate(params, legal_threshold):
+    ''' runs one parameter combination on every trace, returns (params, totals).
+        a labelled pass closer than legal_threshold inches is a violation '''
+    config = DetectorConfig().replace(**params)
+    true_positives = events = violations = 0
+    end_error = 0.0
+    samples = 0
+    elapsed = 0.0
+    for labels, (times, distances, strengths) in _traces:
+        found, seconds = run_detector(times, distances, strengths, config)
+        result = score(found, labels, legal_threshold)
+        true_positives += result['true_positives']
+        events += result['events']
+        violations += result['violations']
+        end_error += result['mean_end_error']*result['true_positives']
+        samples += len(distances)
+        elapsed += seconds
+    precision = true_positives/events if events else 1.0
+    recall = true_positives/violations if violations else 1.0
+    return params, {
+        'precision': precision,
+        'recall': recall,
+        'f1': 2*precision*recall/(precision + recall) if precision + recall else 0.0,
+        # time from the vehicle leaving the beam to the violation being reported
+        'latency': end_error/true_positives if true_positives else 0.0,
+        'samples_per_sec': samples/elapsed if elapsed else 0.0,
+    }
+
+
+def parameter_grid(args):
+    ''' every valid combination of the command line parameters '''
+    grid = []
+    for threshold, debounce, confirm, filter_name in itertools.product(
+            args.threshold, args.debounce, args.confirm, args.filter):
+        params = {
+            'violation_threshold': threshold,
+            'consecutive_readings': debounce,
+            'confirmation_readings': confirm,
+            'filter': filter_name,
+        }
+        try:
+            DetectorConfig().replace(**params)
+        except ValueError as e:
+            print("skipping", params, e)
+            continue
+        grid.append(params)
+    return grid
+
+
+def main():
+    parser = argparse.ArgumentParser(description='rank detector parameters on labelled traces')
+    parser.add_argument('trace_dir')
+    parser.add_argument('--threshold', type=int, nargs='+', default=[73], help='violation distance in inches')
+    parser.add_argument('--debounce', type=int, nargs='+', default=[5], help='consecutive readings to change state')
+    parser.add_argument('--confirm', type=int, nargs='+', default=[24], help='readings to confirm a vehicle')
+    parser.add_argument('--filter', nargs='+', default=['none'], help='signal filters, see filters.py')
+    parser.add_argument('--legal-threshold', type=int, default=DetectorConfig().violation_threshold,
+                        help='passes closer than this many inches are violations in the ground truth')
+    parser.add_argument('--processes', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    paths = sorted(p for p in glob.glob(os.path.join(args.trace_dir, '*.csv'))
+                   if not p.endswith('.labels.csv') and os.path.exists(labels_path(p)))
+    if not paths:
+        parser.error(f"no labelled traces in {args.trace_dir}")
+    grid = parameter_grid(args)
+    print(f"{len(grid)} parameter combinations on {len(paths)} traces")
+
+    shm, index = pack_traces(paths)
+    try:
+        with Pool(args.processes, initializer=init_worker, initargs=(shm.name, index)) as pool:
+            results = pool.map(functools.partial(evaluate, legal_threshold=args.legal_threshold), grid)
+    finally:
+        shm.close()
+        shm.unlink()
+
+    # best F1 first, faster reporting breaks ties
+    results.sort(key=lambda r: (-r[1]['f1'], r[1]['latency']))
+    print(f"{'threshold':>9} {'debounce':>8} {'confirm':>7} {'filter':<8}"
+          f"{'precision':>10}{'recall':>8}{'f1':>7}{'latency ms':>12}{'samples/s':>12}")
+    for params, result in results:
+        print(f"{params['violation_threshold']:>9} {params['consecutive_readings']:>8} "
+              f"{params['confirmation_readings']:>7} {params['filter']:<8}"
+              f"{result['precision']:>10.3f}{result['recall']:>8.3f}{result['f1']:>7.3f}"
+              f"{result['latency']*1000:>12.0f}{result['samples_per_sec']:>12,.0f}")
+
+
+if __name__ == "__main__":
+    main()
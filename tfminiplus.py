@@ -1,68 +1,257 @@
-import serial
+import io
+import os
+import threading
 import time
 import sys
 
+import constants
+import metrics
 
-class TFMini:
-    def __init__(self):
-        self.port = '/dev/ttyAMA'
-        # rpi4 has 4 UART, so we use UART1
-        # rpi3 only has 1 UART plus the mini-uart, so UART0 must be used
-        with open("/proc/cpuinfo") as f:
-            cpuinfo = f.read().lower()
-            model_pos = cpuinfo.find("model")
-            model = cpuinfo[model_pos:].split(':')[1].strip()
-            # note: will not work for raspberry pi 2. Something to keep in mind...
-            self.port += '0' if 'raspberry pi 3' in model else '1'
 
-        self.time_of_reading = None
+def detect_port():
+    ''' picks the UART the sensor is wired to from the rpi model '''
+    port = '/dev/ttyAMA'
+    # rpi4 has 4 UART, so we use UART1
+    # rpi3 only has 1 UART plus the mini-uart, so UART0 must be used
+    with open("/proc/cpuinfo") as f:
+        cpuinfo = f.read().lower()
+        model_pos = cpuinfo.find("model")
+        model = cpuinfo[model_pos:].split(':')[1].strip()
+        # note: will not work for raspberry pi 2. Something to keep in mind...
+        port += '0' if 'raspberry pi 3' in model else '1'
+    return port
 
-        self._ser = serial.Serial(self.port,115200)
-        if not self._ser.is_open:
-            self._ser.open()
 
-        time.sleep(0.1)
+def cached_port(cache_path=constants.PORT_CACHE_PATH):
+    ''' the port only depends on the board, so it is detected once
+        and remembered instead of parsing /proc/cpuinfo on every start.
+        delete the cache file after moving the SD card to another board '''
+    try:
+        with open(cache_path) as f:
+            port = f.read().strip()
+        if port:
+            return port
+    except OSError:
+        pass
+    port = detect_port()
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        with open(cache_path, 'w') as f:
+            f.write(port + '\n')
+    except OSError as e:
+        print("unable to cache sensor port in", cache_path, e)
+    return port
+
+
+# every TFMini Plus frame is 9 bytes:
+# 0x59 0x59 dist_low dist_high strength_low strength_high temp_low temp_high checksum
+FRAME_HEADER = 0x59
+FRAME_SIZE = 9
+# bytes read from the port are kept here, no allocation per read.
+# room for 28 frames, more than ever arrive between two polls
+RX_BUFFER_SIZE = 256
 
+# sensor health, also exported as the smartlight_sensor_health gauge
+HEALTH_STARTING = 0
+HEALTH_OK = 1
+HEALTH_STALLED = 2
+HEALTH_RECONNECTING = 3
+
+
+class TFMini:
+    def __init__(self, port=None, stall_timeout=0.5, reopen_timeout=2.0, max_backoff=30.0):
+        ''' the serial port is opened and probed on a background thread so
+            constructing a TFMini never blocks startup. read_sensor reports
+            -1 until the port is ready.
+
+            read_sensor never waits for the sensor. If no frame arrives for
+            stall_timeout seconds the sensor is reported as stalled, after
+            reopen_timeout seconds the port is closed and reopened on a
+            background thread, backing off up to max_backoff seconds between
+            attempts while the sensor stays silent '''
+        self.port = port if port is not None else cached_port()
+        self.time_of_reading = None
+        self._ser = None
+        # unbuffered view of the port's fd, reads straight into _buffer
+        self._raw = None
+        self._buffer = bytearray(RX_BUFFER_SIZE)
+        self._view = memoryview(self._buffer)
+        # _tails[n] is the free part of _buffer while n bytes hold data,
+        # made once so reading doesn't slice a new memoryview every time
+        self._tails = [self._view[n:] for n in range(RX_BUFFER_SIZE)]
+        # how many bytes of _buffer hold data
+        self._fill = 0
+        # the newest valid frame, set by latest_frame
+        self._frame_cm = 0
+        self._frame_strength = 0
         self._distance = 0
         self._strength = 0
         self.distance_min = 4 # inches
         self.distance_max = 480 # 40 feet
+        self.stall_timeout = stall_timeout
+        self.reopen_timeout = reopen_timeout
+        self.max_backoff = max_backoff
+        self.backoff = stall_timeout
+        self.next_reopen = 0
+        self.last_frame_time = time.monotonic()
+        self.health = HEALTH_STARTING
+        self.ready = threading.Event()
+        self._opening = True
+        self.startup_seconds = None
+        threading.Thread(target=self.open, daemon=True).start()
+
+    def open(self):
+        ''' runs on its own thread, never on the event loop '''
+        start = time.perf_counter()
+        # pyserial is only needed from here on, keep it off the startup path
+        import serial
+        try:
+            # timeout=0 makes every read return straight away with what is there
+            self._ser = serial.Serial(self.port,115200,timeout=0)
+            if not self._ser.is_open:
+                self._ser.open()
+        except serial.SerialException as e:
+            print(f"unable to open sensor at {self.port}: {e}")
+            self.schedule_reopen()
+            self._opening = False
+            return
+
+        time.sleep(0.1)
+
         if self._ser.in_waiting > 0:
             print(f"sensor at {self.port} up and sensing...")
         else:
             print(f"sensor at {self.port} not working...")
+        self.startup_seconds = time.perf_counter() - start
+        # pyserial opens the port non-blocking, readinto returns None when there is nothing
+        self._raw = io.FileIO(self._ser.fileno(), 'rb', closefd=False)
+        self._fill = 0
+        self.last_frame_time = time.monotonic()
+        self.ready.set()
+        self._opening = False
+        metrics.startup.mark('sensor_ready')
+
+    def set_health(self, health):
+        self.health = health
+        metrics.registry.set('smartlight_sensor_health', health)
+
+    def schedule_reopen(self):
+        self.next_reopen = time.monotonic() + self.backoff
+        self.backoff = min(self.backoff*2, self.max_backoff)
+        self.set_health(HEALTH_RECONNECTING)
+
+    def reopen(self):
+        ''' close the port and let a background thread open it again '''
+        print(f"sensor at {self.port} not responding, reopening the port")
+        metrics.registry.inc('smartlight_sensor_reopens_total')
+        self.ready.clear()
+        self.close_port()
+        self.schedule_reopen()
 
+    def watchdog(self):
+        ''' called on every read that produced no frame '''
+        if not self.ready.is_set():
+            if not self._opening and time.monotonic() >= self.next_reopen:
+                self._opening = True
+                threading.Thread(target=self.open, daemon=True).start()
+            return
+        silent = time.monotonic() - self.last_frame_time
+        if silent > self.reopen_timeout:
+            self.reopen()
+        elif silent > self.stall_timeout and self.health != HEALTH_STALLED:
+            print(f"sensor at {self.port} stalled")
+            metrics.registry.inc('smartlight_sensor_stalls_total')
+            self.set_health(HEALTH_STALLED)
 
+    def receive(self):
+        ''' reads what the port has into the receive buffer and parses it.
+            returns True if a valid frame arrived, see latest_frame '''
+        found = False
+        while True:
+            space = RX_BUFFER_SIZE - self._fill
+            count = self._raw.readinto(self._tails[self._fill])
+            if not count:
+                return found
+            self._fill += count
+            found = self.latest_frame() or found
+            if count < space:
+                # the port had no more than fit, nothing left to read
+                return found
+
+    def latest_frame(self):
+        ''' parses every complete frame in the receive buffer and keeps
+            the values of the newest valid one in _frame_cm/_frame_strength.
+            returns True if there was one. bytes that don't start a valid
+            frame are skipped, the trailing partial frame is moved to the
+            start of the buffer '''
+        buf = self._buffer
+        fill = self._fill
+        found = False
+        skipped = 0
+        i = 0
+        while fill - i >= FRAME_SIZE:
+            if buf[i] == FRAME_HEADER and buf[i+1] == FRAME_HEADER:
+                # the low 8 bits of the sum of the first 8 bytes. the bytes
+                # are indexed one by one, struct would make a tuple per frame
+                total = (2*FRAME_HEADER + buf[i+2] + buf[i+3] + buf[i+4]
+                         + buf[i+5] + buf[i+6] + buf[i+7])
+                if total & 0xFF == buf[i+8]:
+                    self._frame_cm = buf[i+2] | buf[i+3] << 8
+                    self._frame_strength = buf[i+4] | buf[i+5] << 8
+                    found = True
+                    metrics.registry.inc('smartlight_frames_read_total')
+                    i += FRAME_SIZE
+                    continue
+            skipped += 1
+            i += 1
+        if i == fill:
+            self._fill = 0
+        elif i:
+            # memoryview assignment copies overlapping ranges safely
+            self._view[:fill - i] = self._view[i:fill]
+            self._fill = fill - i
+        if skipped:
+            metrics.registry.inc('smartlight_header_resync_retries_total', skipped)
+        return found
 
     def read_sensor(self):
         ''' everytime through the loop try to get distance data from sensor
             if hardware error, distance will be -1 (used for error checking)
             if distance reported is less than min or greater than max
-            distance will be truncated to the min or max, respectively
+            distance will be -1 as well.
+            returns straight away: if no new frame has arrived since the
+            last call it returns None and distance, strength and
+            time_of_reading keep the values of the last frame
         '''
         distance = -1
-        strength = -1
-
-        # while distance < self.distance_min or distance > self.distance_max:
-        recv = [0,0]
-        attempts = 10
-        while recv[0] != 0x59 and recv[1] != 0x59 and attempts:
-            count = self._ser.in_waiting
-            while count < 9:
-                count = self._ser.in_waiting
-            recv = self._ser.read(9)
-            self._ser.reset_input_buffer()
-            attempts -= 1
-
-        if attempts:
-            cm_distance = recv[2] + recv[3]*256
-            strength = recv[4] + recv[5]*256
+        found = False
+        if self.ready.is_set():
+            try:
+                found = self.receive()
+            except OSError as e:
+                # pyserial's SerialException is an OSError too
+                print(f"error reading sensor at {self.port}: {e}")
+                metrics.registry.inc('smartlight_error_readings_total')
+                self.reopen()
+
+        if not found:
+            self.watchdog()
+            return None
 
+        self.last_frame_time = time.monotonic()
+        self.backoff = self.stall_timeout
+        if self.health != HEALTH_OK:
+            self.set_health(HEALTH_OK)
+        cm_distance = self._frame_cm
+        strength = self._frame_strength
         # round down to nearest inch
         # keeps distance at -1 in the event of an erroneous reading from the sensor
-        if self.distance_min < cm_distance*0.39 < self.distance_max:
-            # 1 cm = 0.39 inches
-            distance = int(cm_distance*0.39)
+        # 1 cm = 0.39 inches, in integers so no float is created per frame
+        inches_x100 = cm_distance*39
+        if self.distance_min*100 < inches_x100 < self.distance_max*100:
+            distance = inches_x100//100
+        else:
+            metrics.registry.inc('smartlight_out_of_range_readings_total')
 
         self._distance = distance
         self._strength = strength
@@ -71,6 +260,13 @@ class TFMini:
         return distance, strength, self.port
 
 
+    def fileno(self):
+        ''' fd of the open serial port, None while it is closed '''
+        if self.ready.is_set():
+            return self._ser.fileno()
+        return None
+
+
     @property
     def distance(self):
         return self._distance
@@ -82,6 +278,8 @@ class TFMini:
 
 
     def close_port(self):
+        self.ready.clear()
+        self._raw = None
         if self._ser != None and self._ser.is_open:
             self._ser.close()
             print(f"\n\tserial port {self.port} has been closed")
@@ -90,6 +288,8 @@ class TFMini:
 
 if __name__ == "__main__":
     tfmini = TFMini()
+    if not tfmini.ready.wait(5):
+        sys.exit(f"unable to open the sensor at {tfmini.port}")
     try:
         start = time.time()
         prev = 0
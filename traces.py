@@ -0,0 +1,137 @@
+#!/usr/bin/python3
+# Recorded sensor traces.
+#
+# A trace is a CSV file with one sensor frame per line:
+#     time,distance,strength
+# time is in seconds (as returned by time.time()), distance in inches
+# (-1 for an erroneous reading) and strength is the raw TFMini amplitude.
+import csv
+import os
+import time
+
+
+TRACE_HEADER = ['time', 'distance', 'strength']
+
+
+def load_trace(path):
+    ''' returns (times, distances, strengths) lists read from a trace file '''
+    times = []
+    distances = []
+    strengths = []
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if header != TRACE_HEADER:
+            raise ValueError(f"{path} is not a trace file, header is {header}")
+        for row in reader:
+            times.append(float(row[0]))
+            distances.append(int(row[1]))
+            strengths.append(int(row[2]))
+    return times, distances, strengths
+
+
+def save_trace(path, times, distances, strengths):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(TRACE_HEADER)
+        for row in zip(times, distances, strengths):
+            writer.writerow(row)
+
+
+class TraceSensor:
+    ''' stands in for a TFMini by replaying a recorded trace.
+        read_sensor returns one frame per call, exactly like TFMini,
+        so a DistanceMonitor can run on a trace as fast as the CPU allows '''
+
+    def __init__(self, times, distances, strengths, port='trace'):
+        self.port = port
+        self.times = times
+        self.distances = distances
+        self.strengths = strengths
+        self.index = 0
+        self.time_of_reading = None
+        self._distance = 0
+        self._strength = 0
+
+    @classmethod
+    def from_file(cls, path):
+        return cls(*load_trace(path), port=path)
+
+    def exhausted(self):
+        return self.index >= len(self.distances)
+
+    def read_sensor(self):
+        self._distance = self.distances[self.index]
+        self._strength = self.strengths[self.index]
+        self.time_of_reading = self.times[self.index]
+        self.index += 1
+        return self._distance, self._strength, self.port
+
+    @property
+    def distance(self):
+        return self._distance
+
+    @property
+    def strength(self):
+        return self._strength
+
+    def close_port(self):
+        pass
+
+
+class TraceRecorder:
+    ''' wraps a sensor and keeps every frame it reads so it can be saved
+        as a trace, e.g. to record a ride for replaying later '''
+
+    def __init__(self, sensor):
+        self.sensor = sensor
+        self.times = []
+        self.distances = []
+        self.strengths = []
+
+    def __getattr__(self, name):
+        return getattr(self.sensor, name)
+
+    def read_sensor(self):
+        res = self.sensor.read_sensor()
+        if res is None:
+            # no new frame, nothing to keep
+            return res
+        self.times.append(self.sensor.time_of_reading or time.time())
+        self.distances.append(res[0])
+        self.strengths.append(res[1])
+        return res
+
+    def save(self, path):
+        save_trace(path, self.times, self.distances, self.strengths)
+
+
+# Ground truth for a trace lives next to it in <trace>.labels.csv with one
+# vehicle pass per line: begin,end,distance (seconds, seconds, inches)
+LABELS_HEADER = ['begin', 'end', 'distance']
+
+
+def labels_path(trace_path):
+    root, _ = os.path.splitext(trace_path)
+    return root + '.labels.csv'
+
+
+def load_labels(path):
+    ''' returns a list of (begin, end, distance) tuples '''
+    labels = []
+    with open(path, newline='') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        if header != LABELS_HEADER:
+            raise ValueError(f"{path} is not a labels file, header is {header}")
+        for row in reader:
+            labels.append((float(row[0]), float(row[1]), int(row[2])))
+    return labels
+
+
+def save_labels(path, labels):
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(LABELS_HEADER)
+        for row in labels:
+            writer.writerow(row)